@@ -0,0 +1,151 @@
+import os
+import sys
+import time
+import queue
+import pickle
+import argparse
+
+# Benchmarks live in their own folder, make the project modules importable
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+
+
+# Compares the data packets perform_experiment() sends to monitor_experiment() at every point:
+#
+#   · before: a dict with copies of the whole current scan, its errors, all the positions and
+#     the whole live average, O(points) per packet and O(points^2) per scan
+#   · after: a scan start packet carrying positions once and then one small packet per point with
+#     index, value, error and the average at that index
+#
+# Queue.put() passes references so there is no real serialization in the launcher, the pickled size
+# is reported as the payload each packet carries. "GUI" time is how long it takes to apply a packet to
+# the line artists (without canvas.draw(), which costs the same either way).
+#
+# Run from the project folder:
+#   python Benchmarks/benchmark_data_packets.py --points 100 1000 5000
+
+
+def run_legacy(num_points, rng):
+    fig, axes = plt.subplots()
+    line, = axes.plot([], [])
+    average_line, = axes.plot([], [])
+    data_queue = queue.Queue()
+
+    Positions = list(np.arange(num_points, dtype=np.float64))
+    previous_scan = rng.normal(size=num_points)
+    Photodiode_data = []
+    Photodiode_data_errors = []
+
+    payload = 0
+    producer = 0.0
+    consumer = 0.0
+    for index in range(0, num_points):
+        start = time.perf_counter()
+        Photodiode_data.append(float(rng.normal()))
+        Photodiode_data_errors.append(0.1)
+        live_average = ((previous_scan[:index + 1] + Photodiode_data) / 2).tolist() + previous_scan[index + 1:].tolist()
+        data_packet = {
+            "Photodiode data": Photodiode_data.copy(),
+            "Photodiode data errors": Photodiode_data_errors.copy(),
+            "Positions": Positions.copy(),
+            "Scan number": 1,
+            "Live average": live_average,
+        }
+        data_queue.put(data_packet)
+        producer += time.perf_counter() - start
+        payload += len(pickle.dumps(data_packet))
+
+        start = time.perf_counter()
+        data_packet = data_queue.get()
+        positions = data_packet["Positions"]
+        photodiode_data = data_packet["Photodiode data"]
+        line.set_xdata(positions[:len(photodiode_data)])
+        line.set_ydata(photodiode_data)
+        average_line.set_xdata(positions)
+        average_line.set_ydata(data_packet["Live average"])
+        axes.relim()
+        axes.autoscale_view()
+        consumer += time.perf_counter() - start
+
+    plt.close(fig)
+    return payload / num_points, producer / num_points, consumer / num_points
+
+
+def run_delta(num_points, rng):
+    fig, axes = plt.subplots()
+    line, = axes.plot([], [])
+    average_line, = axes.plot([], [])
+    data_queue = queue.Queue()
+
+    positions = np.arange(num_points, dtype=np.float64)
+    previous_scan = rng.normal(size=num_points)
+
+    # The scan start packet is sent once, its cost is spread over the points of the scan
+    start = time.perf_counter()
+    scan_start_packet = {"Packet type": "Scan start", "Scan number": 1, "Positions": positions, "Live average": previous_scan.copy()}
+    data_queue.put(scan_start_packet)
+    producer = time.perf_counter() - start
+    payload = len(pickle.dumps(scan_start_packet))
+
+    start = time.perf_counter()
+    scan_start_packet = data_queue.get()
+    live_scan = {
+        "Positions": np.asarray(scan_start_packet["Positions"], dtype=np.float64),
+        "Photodiode data": np.full(num_points, np.nan),
+        "Photodiode data errors": np.full(num_points, np.nan),
+        "Live average": np.array(scan_start_packet["Live average"], dtype=np.float64),
+    }
+    consumer = time.perf_counter() - start
+
+    for index in range(0, num_points):
+        start = time.perf_counter()
+        value = float(rng.normal())
+        data_packet = {
+            "Packet type": "Point",
+            "Scan number": 1,
+            "Index": index,
+            "Photodiode data": value,
+            "Photodiode data error": 0.1,
+            "Live average": float((previous_scan[index] + value) / 2),
+            "Timestamp": time.time(),
+        }
+        data_queue.put(data_packet)
+        producer += time.perf_counter() - start
+        payload += len(pickle.dumps(data_packet))
+
+        start = time.perf_counter()
+        data_packet = data_queue.get()
+        index = data_packet["Index"]
+        live_scan["Photodiode data"][index] = data_packet["Photodiode data"]
+        live_scan["Photodiode data errors"][index] = data_packet["Photodiode data error"]
+        live_scan["Live average"][index] = data_packet["Live average"]
+        line.set_xdata(live_scan["Positions"][:index + 1])
+        line.set_ydata(live_scan["Photodiode data"][:index + 1])
+        average_line.set_xdata(live_scan["Positions"])
+        average_line.set_ydata(live_scan["Live average"])
+        axes.relim()
+        axes.autoscale_view()
+        consumer += time.perf_counter() - start
+
+    plt.close(fig)
+    return payload / num_points, producer / num_points, consumer / num_points
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Payload and latency per point of the experiment data packets")
+    parser.add_argument("--points", type=int, nargs="+", default=[100, 1000, 5000])
+    args = parser.parse_args()
+
+    print(f"{'points':>7} {'protocol':>8} {'bytes/point':>12} {'engine [us/point]':>18} {'GUI [us/point]':>15}")
+    for num_points in args.points:
+        for name, run in (("before", run_legacy), ("after", run_delta)):
+            payload, producer, consumer = run(num_points, np.random.default_rng(0))
+            print(f"{num_points:>7} {name:>8} {payload:>12.0f} {producer * 1e6:>18.1f} {consumer * 1e6:>15.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+
+# Import time of the launcher and the modules behind it, to catch startup regressions.
+#
+# Every target is imported in a fresh interpreter run with "python -X importtime", which makes Python
+# report how long every single import took (microseconds, "self" and "cumulative" including what it
+# imported in turn). We report the wall time of the import, the slowest imports below it and which of
+# the heavy modules (matplotlib, numpy, pandas, pymeasure) got loaded along the way. The launcher
+# should not load any of them until its main window is up, "launcher + warm up" adds the background
+# import the launcher starts right after that.
+#
+# Run from the project folder:
+#   python Benchmarks/benchmark_import_time.py
+#   python Benchmarks/benchmark_import_time.py --max-ms 150     (exit code 1 if the launcher is slower)
+
+
+project_folder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+heavy_modules = ("matplotlib", "matplotlib.pyplot", "numpy", "pandas", "pymeasure", "serial")
+
+# Code each fresh interpreter runs, {target} is the import being measured
+child_code = """
+import sys, time, json, importlib.util
+sys.path.insert(0, {project_folder!r})
+start = time.perf_counter()
+{target}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"Elapsed": elapsed, "Heavy modules": [name for name in {heavy_modules!r} if name in sys.modules]}}))
+"""
+
+load_launcher = """
+spec = importlib.util.spec_from_file_location("x_waves_launcher", {path!r})
+launcher = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(launcher)
+""".format(path=os.path.join(project_folder, "X-WaveSLauncher.py"))
+
+targets = {
+    "launcher": load_launcher,
+    "launcher + warm up": load_launcher + "launcher.import_heavy_modules()\n",
+    "core_logic": "import core_logic\n",
+    "core_logic_functions": "import core_logic_functions\n",
+    "scan_store": "import scan_store\n",
+    "experiment_container": "import experiment_container\n",
+}
+
+
+def parse_importtime(stderr):
+    """
+    Parses the "-X importtime" report into a list of (cumulative us, self us, module name).
+    """
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        imports.append((int(cumulative_us), int(self_us), name.strip()))
+
+    return imports
+
+
+def measure(target):
+    code = child_code.format(project_folder=project_folder, target=target, heavy_modules=heavy_modules)
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=project_folder,
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        raise Exception(f"Import failed:\n{result.stderr[-2000:]}")
+
+    summary = json.loads(result.stdout.strip().splitlines()[-1])
+    return summary["Elapsed"], summary["Heavy modules"], parse_importtime(result.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import time of the launcher and core modules")
+    parser.add_argument("--targets", nargs="+", default=list(targets), choices=list(targets))
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per target, the fastest one is reported")
+    parser.add_argument("--top", type=int, default=8, help="Slowest imports listed per target")
+    parser.add_argument("--max-ms", type=float, default=None, help="Fail if importing the launcher takes longer")
+    args = parser.parse_args()
+
+    # The interpreter and the measuring code import a few modules on their own, leave those out
+    _, _, baseline_imports = measure("")
+    baseline = {module for _, _, module in baseline_imports}
+
+    launcher_ms = None
+    for name in args.targets:
+        runs = [measure(targets[name]) for _ in range(0, args.repeat)]
+        elapsed, heavy, imports = min(runs, key=lambda run: run[0])
+        elapsed_ms = elapsed * 1e3
+        if name == "launcher":
+            launcher_ms = elapsed_ms
+
+        print(f"\n{name}: {elapsed_ms:.1f}ms, heavy modules loaded: {', '.join(heavy) if heavy else 'none'}")
+
+        imports = [entry for entry in imports if entry[2] not in baseline]
+        for cumulative_us, self_us, module in sorted(imports, reverse=True)[:args.top]:
+            print(f"    ·{module:<45} {cumulative_us / 1e3:8.1f}ms cumulative {self_us / 1e3:8.1f}ms self")
+
+    if args.max_ms is not None and launcher_ms is not None and launcher_ms > args.max_ms:
+        print(f"\nLauncher import took {launcher_ms:.1f}ms, over the {args.max_ms}ms limit")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+import os
+import sys
+import time
+import queue
+import shutil
+import argparse
+
+# Benchmarks live in their own folder, make the project modules importable
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import core_logic
+import core_logic_functions as clfun
+import scan_statistics
+import scan_store
+from sr860_emulator import SR860Emulator
+
+
+# Measures lockin I/O against the SR860 emulator: how many commands per second we get through
+# core_logic_functions and how many points per second a whole scan reaches. The delay stage
+# is taken out of the picture (move_to_position() has ~2.2s of fixed sleeps per point which
+# would dominate everything), the emulator is told the new delay instead.
+#
+# Run from the project folder:
+#   python Benchmarks/benchmark_lockin_io.py --latency 0.005 --jitter 0.001 --timeout 0.05
+
+
+def benchmark_commands(adapter, num_commands):
+    # Queries return a value and go through a full write/read cycle, writes only go one way
+    queries = {
+        "request_R": clfun.request_R,
+        "request_R_noise": clfun.request_R_noise,
+        "request_signal_strength": clfun.request_signal_strength,
+        "find_next_sensitivity": clfun.find_next_sensitivity,
+        "request_R_samples (16)": lambda adapter: clfun.request_R_samples(adapter, 16),
+    }
+    writes = {
+        "autorange": clfun.autorange,
+        "autoscale": clfun.autoscale,
+    }
+
+    results = {}
+    for name, function in {**queries, **writes}.items():
+        start = time.perf_counter()
+        for _ in range(0, num_commands):
+            function(adapter)
+        elapsed = time.perf_counter() - start
+        results[name] = num_commands / elapsed
+
+    return results
+
+
+def benchmark_scan(emulator, adapter, num_points, error_measurement_type, autoranging_type):
+
+    # Replace the stage by telling the emulator where we are, keeps the rest of perform_experiment() untouched
+    original_move_to_position = clfun.move_to_position
+    def emulated_move_to_position(lib, serial_num, channel, delay_ps):
+        emulator.set_delay(delay_ps)
+        return delay_ps
+    clfun.move_to_position = emulated_move_to_position
+
+    core_logic.adapter = adapter
+    core_logic.lib = None
+    core_logic.serial_num = None
+    core_logic.channel = None
+
+    experiment_name = "benchmark_lockin_io"
+    parameters_dict = {
+        "experiment_name": experiment_name,
+        "time_constant": 1e-6,
+        "roll_off": 6,
+        "time_zero": 0.0,
+        "num_scans": 1,
+        "trip_legs": {"0": {"abs time start [ps]": 0.0, "abs time end [ps]": float(num_points - 1), "step [ps]": 1.0}},
+    }
+
+    data_queue = queue.Queue()
+    abort_queue = queue.Queue()
+
+    # perform_experiment() prints every step, keep the terminal readable
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        start = time.perf_counter()
+        # No snapshot renderer (None), scan images aren't part of the lockin I/O we measure
+        core_logic.perform_experiment(parameters_dict, data_queue, abort_queue, None, 0, 1,
+                                      error_measurement_type, autoranging_type, scan_store.ScanStore(), scan_statistics.RunningAverage())
+        elapsed = time.perf_counter() - start
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        clfun.move_to_position = original_move_to_position
+        shutil.rmtree(os.path.join(os.path.dirname(os.path.abspath(core_logic.__file__)), "Output", experiment_name), ignore_errors=True)
+
+    return num_points / elapsed, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Lockin I/O benchmark against the SR860 emulator")
+    parser.add_argument("--latency", type=float, default=0.005, help="Emulated instrument latency [s]")
+    parser.add_argument("--jitter", type=float, default=0.001, help="Emulated latency jitter [s]")
+    parser.add_argument("--timeout", type=float, default=1.0, help="Serial timeout passed to initialize_connection [s]")
+    parser.add_argument("--commands", type=int, default=20, help="Commands sent per function")
+    parser.add_argument("--points", type=int, default=20, help="Points in the benchmark scan")
+    args = parser.parse_args()
+
+    with SR860Emulator(latency=args.latency, jitter=args.jitter, seed=0) as emulator:
+        adapter = clfun.initialize_connection(port=emulator.port, baudrate=115200, timeout=args.timeout)
+        clfun.configure_lockin(adapter)
+
+        print(f"\nCommands per second (latency {args.latency}s, jitter {args.jitter}s, timeout {args.timeout}s):")
+        for name, rate in benchmark_commands(adapter, args.commands).items():
+            print(f"    ·{name:<25} {rate:10.2f} cmd/s")
+
+        print(f"\nScan throughput over {args.points} points:")
+        for error_measurement_type in ["Never", "Once at the start", "At every point", "From R samples"]:
+            for autoranging_type in ["Never", "Once at time zero", "At every point"]:
+                points_per_second, elapsed = benchmark_scan(emulator, adapter, args.points, error_measurement_type, autoranging_type)
+                print(f"    ·errors: {error_measurement_type:<18} autoranging: {autoranging_type:<18} {points_per_second:8.2f} points/s ({elapsed:.2f}s)")
+
+        print(f"\nEmulator answered {emulator.queries_answered} queries out of {emulator.commands_received} commands")
+        clfun.close_connection(adapter)
+
+
+if __name__ == "__main__":
+    main()
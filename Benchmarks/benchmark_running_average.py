@@ -0,0 +1,93 @@
+import os
+import sys
+import time
+import argparse
+
+# Benchmarks live in their own folder, make the project modules importable
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from scan_statistics import RunningAverage, estimators
+
+
+# Per point cost of the live average as the number of scans and points grows. The running average
+# should stay flat, the old recomputation (kept below for comparison) grows with scans x points.
+# --estimators times the other averaging estimators of scan_statistics.py as well.
+#
+# Run from the project folder:
+#   python Benchmarks/benchmark_running_average.py
+
+
+def legacy_average_scans(Completed_scans, new_data):
+    # Same algorithm as the average_scans() that perform_experiment used to call after every point:
+    # cast every scan to an array, sum them up, handle the incomplete current scan by slicing
+    def average_equal_lists(scans_list):
+        scans_array_list = [np.array(scan) for scan in scans_list]
+        averaged_scans = np.zeros_like(scans_array_list[0])
+        for scan in scans_array_list:
+            averaged_scans += scan
+        return (averaged_scans / len(scans_array_list)).tolist()
+
+    Scans_ls = Completed_scans.copy()
+    Scans_ls.append(new_data)
+    if len(Scans_ls[-1]) == len(Scans_ls[-2]):
+        return average_equal_lists(Scans_ls)
+    left_average = average_equal_lists([scan[:len(Scans_ls[-1])] for scan in Scans_ls[:-1]] + [Scans_ls[-1]])
+    right_average = average_equal_lists([scan[len(Scans_ls[-1]):] for scan in Scans_ls[:-1]])
+    return left_average + right_average
+
+
+def time_last_scan(num_scans, num_points, legacy, estimator=RunningAverage):
+    # Fill num_scans - 1 completed scans, then time every point of the last one
+    rng = np.random.default_rng(0)
+    completed = [rng.normal(size=num_points).tolist() for _ in range(0, num_scans - 1)]
+
+    running_average = estimator(num_points)
+    for scan in completed:
+        running_average.update_scan(scan)
+
+    current = []
+    start = time.perf_counter()
+    for index in range(0, num_points):
+        current.append(float(rng.normal()))
+        if legacy:
+            legacy_average_scans(completed, current)
+        else:
+            running_average.update(index, current[-1])
+            running_average.mean(num_points)
+    elapsed = time.perf_counter() - start
+
+    # Sanity check: both give the same live average at the end of the scan
+    if not legacy and estimator is RunningAverage:
+        assert np.allclose(running_average.mean(), legacy_average_scans(completed, current))
+
+    return elapsed / num_points
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per point cost of the live average")
+    parser.add_argument("--scans", type=int, nargs="+", default=[2, 10, 50])
+    parser.add_argument("--points", type=int, nargs="+", default=[100, 1000, 5000])
+    parser.add_argument("--skip-legacy", action="store_true", help="Only time the running average")
+    parser.add_argument("--estimators", action="store_true", help="Also time the other averaging estimators")
+    args = parser.parse_args()
+
+    print(f"{'scans':>6} {'points':>7} {'running [us/point]':>20} {'legacy [us/point]':>19}")
+    for num_scans in args.scans:
+        for num_points in args.points:
+            running = time_last_scan(num_scans, num_points, legacy=False) * 1e6
+            legacy = float("nan") if args.skip_legacy else time_last_scan(num_scans, num_points, legacy=True) * 1e6
+            print(f"{num_scans:>6} {num_points:>7} {running:>20.2f} {legacy:>19.2f}")
+
+    if args.estimators:
+        print(f"\n{'scans':>6} {'points':>7} {'estimator':>27} {'[us/point]':>11}")
+        for num_scans in args.scans:
+            for num_points in args.points:
+                for name, estimator in estimators.items():
+                    per_point = time_last_scan(num_scans, num_points, legacy=False, estimator=estimator) * 1e6
+                    print(f"{num_scans:>6} {num_points:>7} {name:>27} {per_point:>11.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,19 +3,20 @@ from tkinter import ttk
 from tkinter import Toplevel
 from tkinter import messagebox
 import json
-import core_logic
 import threading
 import sys
 import queue
 from functools import partial
-from math import ceil
 from tkinter import simpledialog
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
-import matplotlib.pyplot as plt
+from tkinter import filedialog
 import os
 import datetime
+import time
 import webbrowser
-import numpy as np
+
+import log_view
+import gui_wakeup
+import preset_validation
 
 # Are you trying to troubleshoot with prints but they are redirected to the logs, maybe messagebox errors not verbose enough?
 # Change the following bool to True
@@ -49,120 +50,129 @@ print_on_cmd = False
 # initialization is taking place
 initialized = False
 entries = {}
-previous_scans = []
-line_object = None
-lines_list = []
 prev_scan = 0
-Scans = []
-first_iteration = False
-average_line_object = None
-finishing_time_str = ''
-
-
-# These variables are initialized as None so that we can check if they have 
-# been intialized later on and perform some action (plt.close, join etc) that
-# way we don't risk trying to close a non initialized variable 
-adapter = None
-fig = None
-initialization_thread = None
-experiment_thread = None
-
-cmap = plt.get_cmap('inferno')
-
-# Queue object to send data from experiment thread back 
-experiment_data_queue = queue.Queue()    # Sends data from experiment thread to be graphed at GUI
-abort_queue = queue.Queue()              # Sends abort signal from GUI to experiment thread to end func safely
-error_queue = queue.Queue()              # Sends Exceptions caught in experiment and initialization threads 
-                                   # to be displayed on GUI 
-
-
-
-def average_scans(Completed_scans, new_data):
-    # We want to measure a live average, that is we need to update 
-    # each averaged point in a graph as new points come in, to do so
-    # we use this function which averages multiple lists and deals
-    # with problems where the last scan is incomplete and thus a smaller
-    # length, to do so it splits the averaging like so:
-    #  
-    # We slice completed scans by the len of the uncompleted scan
-    # [a_0, a_1| a_2, a_3, a_4, a_5]
-    # [b_0, b_1| b_2, b_3, b_4, b_5]
-    #
-    # Current scan taking place that is incomplete
-    # [c_0, c_1]
-    #
-    # average left slices: [a_0, a_1], [b_0, b_1], [c_0, c_1]
-    # average right slices: [a_2, a_3, a_4, a_5], [b_2, b_3, b_4, b_5]]
-    #
-    # We splice left and right averages into a final average
-    # [avg_0, avg_1, avg_2, avg_3, avg_4, avg_5]
 
+# Every scan of the running experiment lives in this store (see scan_store.py), the experiment thread
+# writes it and the GUI reads views of it. Point scan_store_directory to a folder to keep the scans in
+# memory mapped files there instead of RAM, useful for long overnight runs
+scan_store_directory = None
+Scan_store = None
+Running_average = None
+Scan_plan = None
+finishing_time_str = ''
 
-    def average_equal_lists(scans_list):
+# Live graph of the monitoring window (see live_plot.py). The figure is created with the first experiment
+# and reused by every following one, live_plot_max_fps caps how often it's redrawn
+Live_plot = None
+live_plot_max_fps = 20
 
-        try:
-            # Takes a list of equal sized lists and returns an 
-            # averaged list
+# Experiments with at least this many scans show a heat map of scan × delay instead of a line per scan,
+# None to always draw lines
+live_heat_map_from_scans = 20
 
-            # Cast lists to arrays for easier element wise addition
-            scans_array_list = []
-            for scan in scans_list:
-                scans_array_list.append(np.array(scan))
-            
-            # Average all scan arrays in list by summing them
-            averaged_scans = np.zeros_like(np.array(scans_array_list[0]))
-            for scan in scans_array_list:
-                averaged_scans += scan
-            
-            # And dividing by amount of arrays
-            averaged_scans = averaged_scans / len(scans_array_list)
-            
-            return averaged_scans.tolist()
-        
-        except ValueError:
-            print(f'An ERROR occured when adding something in the following list:\n{scans_array_list}')
+# Lines of the experiment log kept on screen (see log_view.py)
+log_view_max_lines = 2000
 
-            raise ValueError
+# Images saved with every scan, rendered on a worker thread (see snapshot_renderer.py). With
+# snapshot_defer_until_end they're all rendered once the experiment is over
+Snapshot_renderer = None
+snapshot_format = "png"
+snapshot_dpi = 300
+snapshot_defer_until_end = False
 
-    # Append new data to completed scans
-    Scans_ls = Completed_scans
-    Scans_ls.append(new_data)
+# Experiments run back to back from the "Experiment queue" window (see experiment_queue.py). The queue
+# is kept when the window is closed, its packets come on their own queue
+Experiment_queue = None
+experiment_queue_thread = None
+experiment_queue_data_queue = None
 
-    # Deal with edge case where there are not enough scans to average
-    if len(Scans_ls) > 1:
+# Thread of the "Find time zero" window, it drives the same devices as experiments (see devices_in_use())
+time_zero_search_thread = None
 
-        # Find whether our averaging needs to deal with incompleted scans
-        # by checkin whether the last scan is smaller than the previous one  
-        if len(Scans_ls[-1]) == len(Scans_ls[-2]):
-            return average_equal_lists(Scans_ls)
+# What the GUI knows about the scan being measured, the experiment thread only sends the positions
+# and views of its scan store rows once per scan and then one small packet per point (see perform_experiment())
+live_scan = {}
 
-        else:
 
-            # Compile list of scans sliced to match the length of the 
-            # uncompleted scan
-            left_slices_list = []
-            for scan in Scans_ls[:-1]:
-                left_slices_list.append(scan[:len(Scans_ls[-1])])
-            
-            # Include uncomplete scan
-            left_slices_list.append(Scans_ls[-1])
-            
-            # Compile a second list of the "leftover" right slices
-            right_slices_list = []
-            for scan in Scans_ls[:-1]:
-                right_slices_list.append(scan[len(Scans_ls[-1]):])
-            
-            # Average each of the groups, now with matching length
-            left_average = average_equal_lists(left_slices_list)
-            right_average = average_equal_lists(right_slices_list)
-
-            # Combine them into a final average
-            return left_average + right_average
+# These variables are initialized as None so that we can check if they have 
+# been intialized later on and perform some action (plt.close, join etc) that
+# way we don't risk trying to close a non initialized variable 
+adapter = None
+fig = None
+initialization_thread = None
+experiment_thread = None
 
-    # This return signals that there is no average to plot for only
-    # one scan
-    else:
-        return None
+cmap = None
+
+
+############################### Heavy imports ###############################
+# matplotlib with its Tk backend, numpy and core_logic (which brings pandas and pymeasure along) take
+# most of the startup time but none of them are needed to draw the main window. They are imported on a
+# background thread as soon as the main window is up (see main()) and every function that needs them
+# calls wait_for_heavy_imports() first, which returns straight away once the warm up is done.
+# Run Benchmarks/benchmark_import_time.py to check what the launcher imports at startup.
+core_logic = None
+scan_statistics = None
+scan_store = None
+acquisition_policy = None
+scan_plan = None
+checkpoint = None
+live_plot = None
+snapshot_renderer = None
+experiment_queue = None
+np = None
+plt = None
+FigureCanvasTkAgg = None
+NavigationToolbar2Tk = None
+heavy_imports_done = threading.Event()
+
+
+def import_heavy_modules():
+    global core_logic, scan_statistics, scan_store, acquisition_policy, scan_plan, checkpoint, live_plot, snapshot_renderer, experiment_queue, np, plt, FigureCanvasTkAgg, NavigationToolbar2Tk, cmap
+
+    # Python's import lock makes this safe to run from the warm up thread and the GUI at the same
+    # time, whoever comes second just waits for the module being imported and gets the same object
+    import numpy
+    import matplotlib.pyplot
+    from matplotlib.backends import backend_tkagg
+    import core_logic as core_logic_module
+    import scan_statistics as scan_statistics_module
+    import scan_store as scan_store_module
+    import acquisition_policy as acquisition_policy_module
+    import scan_plan as scan_plan_module
+    import checkpoint as checkpoint_module
+    import live_plot as live_plot_module
+    import snapshot_renderer as snapshot_renderer_module
+    import experiment_queue as experiment_queue_module
+
+    np = numpy
+    plt = matplotlib.pyplot
+    FigureCanvasTkAgg = backend_tkagg.FigureCanvasTkAgg
+    NavigationToolbar2Tk = backend_tkagg.NavigationToolbar2Tk
+    core_logic = core_logic_module
+    scan_statistics = scan_statistics_module
+    scan_store = scan_store_module
+    acquisition_policy = acquisition_policy_module
+    scan_plan = scan_plan_module
+    checkpoint = checkpoint_module
+    live_plot = live_plot_module
+    snapshot_renderer = snapshot_renderer_module
+    experiment_queue = experiment_queue_module
+    cmap = plt.get_cmap('inferno')
+
+    heavy_imports_done.set()
+
+
+def wait_for_heavy_imports():
+    if not heavy_imports_done.is_set():
+        import_heavy_modules()
+
+# Queue object to send data from experiment thread back. The queues the GUI reads wake it up when
+# something is put in them instead of being polled (see gui_wakeup.py)
+experiment_data_queue = gui_wakeup.NotifyingQueue()    # Sends data from experiment thread to be graphed at GUI
+abort_queue = queue.Queue()                            # Sends abort signal from GUI to experiment thread to end func safely
+error_queue = gui_wakeup.NotifyingQueue()              # Sends Exceptions caught in experiment and initialization threads 
+                                                       # to be displayed on GUI 
 
 
 
@@ -246,11 +256,30 @@ def restore_output():
     sys.stderr = sys.__stderr__
 
 
+
+def devices_in_use():
+    """
+    What is driving the lockin and the stage right now. Experiments, the experiment queue and the time
+    zero search all move the stage and change lockin settings, only one of them may run at a time.
+
+    Returns:
+        str: Name of what is running, to tell the user, or None if the devices are free.
+    """
+    if experiment_thread is not None and experiment_thread.is_alive():
+        return "the experiment"
+    if experiment_queue_thread is not None and experiment_queue_thread.is_alive():
+        return "the experiment queue"
+    if time_zero_search_thread is not None and time_zero_search_thread.is_alive():
+        return "the time zero search"
+    return None
+
+
 def initialization_thread_logic():
     
     # Catch exceptions while initializing and display them
     # later to user to aid troubleshooting 
     try:
+        wait_for_heavy_imports()
         core_logic.initialization(Troubleshooting=False)
         #core_logic.initialization_dummy(Troubleshooting=False)
 
@@ -263,25 +292,36 @@ def initialization_thread_logic():
 
 
 
-def experiment_thread_logic(parameters_dict, experiment_data_queue, abort_queue, fig, num_scans, monitoring_window, error_measurement_type, autoranging_type):
+def experiment_thread_logic(parameters_dict, experiment_data_queue, abort_queue, renderer, num_scans, monitoring_window, error_measurement_type, autoranging_type, resume_checkpoint=None):
     
     # Catch exceptions while initializing and display them
     # later to user to aid troubleshooting 
     try:
-        for scan in range(0, num_scans):
+        # The acquisition policy decides how many scans we take and which positions each one measures,
+        # a fixed number of full scans or passes over the points still above the target error (see acquisition_policy.py).
+        # A resumed experiment skips what was already measured (see checkpoint.py)
+        global Scan_store, Running_average, Scan_plan
+        policy = acquisition_policy.create_policy(parameters_dict)
+        experiment_start = checkpoint.experiment_start(resume_checkpoint)
+        for scan, position_indices, start_index in checkpoint.resumed_passes(policy, Running_average, resume_checkpoint, experiment_start):
 
             # Perform experiment and get data at the end
             abort_queue.put(False)  # before we start the experiment we reset the abort flag to false
-            global Scans
             result = core_logic.perform_experiment(parameters_dict, 
                                                    experiment_data_queue, 
                                                    abort_queue, 
-                                                   fig, 
+                                                   renderer, 
                                                    scan, 
                                                    num_scans, 
                                                    error_measurement_type,
                                                    autoranging_type,
-                                                   Scans) 
+                                                   Scan_store,
+                                                   Running_average,
+                                                   position_indices,
+                                                   Scan_plan,
+                                                   start_index,
+                                                   resume_checkpoint,
+                                                   experiment_start) 
 
             # User has chosen to abort experiment and thus we receive an error code instead
             if isinstance(result, int):
@@ -289,25 +329,24 @@ def experiment_thread_logic(parameters_dict, experiment_data_queue, abort_queue,
                 close_window(monitoring_window)
                 return None
 
-            # The scan completed and we store it to compare against the new scan
-            else:
-                # We append the label for this experiment to the dataframe to 
-                # use it as a label when graphing
-                data_df = result
-                data_dict = data_df.to_dict()
-                data_dict["Scan number"] = scan          
-
-                # Preserve data from previous scans to graph with 
-                global previous_scans
-                previous_scans.append(data_dict)
+            # The scan completed, its data is already in Scan_store to compare against the new scan
+            # so there's nothing else to keep around
 
             #core_logic.perform_experiment_dummy(Troubleshooting=False)
 
+        print(policy.stop_reason)
+
+        # Nothing left to resume
+        checkpoint.clear_checkpoint(checkpoint.checkpoint_folder(os.path.join(os.path.dirname(os.path.abspath(__file__)), "Output"),
+                                                                 parameters_dict["experiment_name"]))
+
     # Exceptions dont propagate upwards when using threads, we have to send it to main code through a Queue
     except Exception as e:
         error_queue.put(Exception(f"An error occured during the experiment:\n{e}"))
     
     finally:
+        # Images still rendering, or all of them if they wait for the end of the experiment
+        renderer.finish()
         restore_output()
         
 
@@ -361,7 +400,7 @@ def initialize_button(default_values_delay_stage):
     label.grid(row=1, column=0, padx=20, pady=20, sticky="n")
 
     # Queue for communication between threads
-    output_queue = queue.Queue()
+    output_queue = gui_wakeup.NotifyingQueue()
 
     # Redirect stdout and stderr to the queue
     capture_output(output_queue, print_on_cmd=False)
@@ -380,17 +419,15 @@ def initialize_button(default_values_delay_stage):
     initialization_thread = threading.Thread(target=initialization_thread_logic)
     initialization_thread.start()
 
-    # Function to check for updates from the queue
+    # Function to check for updates from the queue, runs whenever a message arrives
     def check_for_updates():
         while not output_queue.empty():
             new_message = output_queue.get()
             listbox.insert(tk.END, new_message)
             listbox.see(tk.END)  # Auto-scroll to the bottom
 
-        if initialization_thread.is_alive():
-            waiting_window.after(100, check_for_updates)
-
-        else:
+        if not initialization_thread.is_alive():
+            updates_wakeup.stop()
             initialization_thread.join()
             label.config(text="Initialization Complete")
 
@@ -403,8 +440,9 @@ def initialize_button(default_values_delay_stage):
             button = tk.Button(waiting_window, text="Ok", command=partial(close_window, waiting_window))
             button.grid(row=1, column=1, padx=20, pady=20, sticky="s")
 
-    # Start checking for updates
-    #check_for_updates(output_queue, listbox, initialization_thread, waiting_window, label)
+    # Start checking for updates, the fallback poll notices when the thread ends
+    updates_wakeup = gui_wakeup.GuiWakeup(waiting_window, check_for_updates, fallback_ms=500)
+    updates_wakeup.listen(output_queue)
     check_for_updates()
 
 
@@ -419,70 +457,29 @@ def is_value_valid(parameter_name, parameter_value, parameter_rules):
     the user and checks whether the value adheres to certain rules 
     located on a "rules" dict, it returns a True if the value checks 
     all rules or a False whenever oneor more rules are not checked. Additionaly
-    it returns the value correctly casted to it's specified type
+    it returns the value correctly casted to it's specified type.
+    The rules themselves are checked by preset_validation.py, which
+    run_experiment.py uses for presets run without the GUI
     '''
 
     # If there are no rules for this particular value 
     # we break away from this function early
     if not parameter_rules:
         return True, parameter_value
-    
-    # If there rules for it we iterate through the dict of rules
-    for rule_type, rule_value in parameter_rules.items():
-
-        # Some rules check whether the type of data input is correct
-        # They also do the parsing for the following rule checks
-        if rule_type == "type":
-
-            # If the value is expected to be a string but its not
-            # we return a false and inform the user
-            if rule_value == "str":
-                try: 
-                    isinstance(parameter_value, str)
-
-                # If isinstance fails it means there is not a string
-                except ValueError:
-                    return False, None
-
-            # In this case we must first attempt to cast to string since
-            # all values retreived from screen are retreived as strings
-            if rule_value == "float":    
-                
-                try:
-                    parameter_value = float(parameter_value)
 
-                except ValueError:
-                    messagebox.showinfo("Error", f"Parameter {parameter_name} is not a valid floating point number, please use .  as decimal separator")
-                    return False, None
+    # Absolute parameter values are compared against limits relative to time zero
+    # (see help file for an explanation on asolute and relative time)
+    time_zero =  float(entries["time_zero"].get())
+    parsed_value, problem = preset_validation.check_value(parameter_name, parameter_value, parameter_rules, time_zero)
 
-        # Other rules specify a range of values
-
-        # This is kind of hacky but some parameters_values are specified in relative time and others in absolute time
-        # (see help file for an explanation on asolute and relative time) To solve this we gotta substract time_zero to compare
-        # absolute parameter values against relative limit delays. 
-        time_zero =  float(entries["time_zero"].get())
-        if rule_type == "max_abs" and parameter_value > rule_value - time_zero:
-            
-            messagebox.showinfo("Error", f"Parameter {parameter_name} is above maximum limit: {rule_value - time_zero}\n")
-            return False, None
-        
-        if rule_type == "min_abs" and parameter_value < rule_value - time_zero:
-            messagebox.showinfo("Error", f"Parameter {parameter_name} is below minimum limit: {rule_value - time_zero}")
-            return False, None
-        
-        if rule_type == "max_rel" and parameter_value > rule_value:
-            
-            messagebox.showinfo("Error", f"Parameter {parameter_name} is above maximum limit: {rule_value}")
-            return False, None
-        
-        if rule_type == "min_rel" and parameter_value < rule_value:
-            messagebox.showinfo("Error", f"Parameter {parameter_name} is below minimum limit: {rule_value}")
-            return False, None
-    
+    # If the value breaks a rule we inform the user
+    if problem is not None:
+        messagebox.showinfo("Error", problem)
+        return False, None
 
     # After all rules are check we can return a boolean flag indicating
     # a valid value and the correctly parsed value
-    return True, parameter_value
+    return True, parsed_value
 
 
 
@@ -585,6 +582,13 @@ def save_parameters(experiment_preset):
         experiment_preset_save["roll_off"] = int(entries["roll_off"].get())
         experiment_preset_save["error_measurement_type"] = str(entries["error_measurement_type"].get())
         experiment_preset_save["autoranging_type"] = str(entries["autoranging_type"].get())
+        experiment_preset_save["binary_output"] = str(entries["binary_output"].get())
+        experiment_preset_save["averaging_estimator"] = str(entries["averaging_estimator"].get())
+        experiment_preset_save["scan_mode"] = str(entries["scan_mode"].get())
+        experiment_preset_save["adaptive_point_budget"] = int(entries["adaptive_point_budget"].get())
+        experiment_preset_save["acquisition_mode"] = str(entries["acquisition_mode"].get())
+        experiment_preset_save["target_relative_error"] = float(entries["target_relative_error"].get())
+        experiment_preset_save["time_budget_min"] = float(entries["time_budget_min"].get())
         experiment_preset_save["time_zero"] = float(entries["time_zero"].get())
         experiment_preset_save["num_scans"] = int(entries["num_scans"].get())
         experiment_preset_save["trip_legs"] = trip_legs_save
@@ -601,77 +605,475 @@ def save_parameters(experiment_preset):
 
 
 
-def launch_experiment(experiment_data_queue):
+def find_time_zero_button():
+    """
+    Window to search time zero automatically (see time_zero_finder.py). The time zero found goes into
+    the time zero entry and the experiment preset.
+    """
+    global entries
+
+    if not initialized:
+        messagebox.showinfo("Error finding time zero", "Please start/wait for device initialization to complete before searching time zero")
+        return
+
+    search_window = Toplevel(main_window)
+    search_window.title("Find time zero")
+    search_window.geometry("600x500")
 
+    # Search window around the time zero on screen by default
     try:
-        global entries
+        current_time_zero = float(entries["time_zero"].get())
+    except ValueError:
+        current_time_zero = 0.0
+
+    search_entries = {}
+    search_defaults = {"Search start [ps]": current_time_zero - 50.0, "Search end [ps]": current_time_zero + 50.0, "Coarse step [ps]": 1.0}
+    row_num = 0
+    for name, default in search_defaults.items():
+        label = tk.Label(search_window, text=name, anchor="w")
+        label.grid(row=row_num, column=0, padx=10, pady=5, sticky="w")
+        entry = tk.Entry(search_window)
+        entry.grid(row=row_num, column=1, padx=10, pady=5, sticky="w")
+        entry.insert(0, default)
+        search_entries[name] = entry
+        row_num += 1
 
-        if not initialized:
-            messagebox.showinfo("Error launching experiment", "Please start/wait for device initialization to complete before launching experiment")
+    # Edge looks for the rise of a pump probe signal, peak for the maximum of a cross correlation
+    label = tk.Label(search_window, text="Look for", anchor="w")
+    label.grid(row=row_num, column=0, padx=10, pady=5, sticky="w")
+    combo = ttk.Combobox(search_window, values=["Edge", "Peak"], state="readonly")
+    combo.set("Edge")
+    combo.grid(row=row_num, column=1, padx=10, pady=5, sticky="w")
+    search_entries["Mode"] = combo
+    row_num += 1
+
+    # Log of the search
+    listbox = tk.Listbox(search_window, selectmode=tk.SINGLE, height=15, width=80)
+    listbox.grid(row=row_num + 1, column=0, columnspan=2, padx=10, pady=5, sticky="ew")
+
+    def start_search():
+        global time_zero_search_thread
+        running = devices_in_use()
+        if running is not None:
+            messagebox.showinfo("Error finding time zero", f"Please wait for {running} to finish or stop it before searching time zero")
             return
 
-        ### First we'll verify parameters are safe before launching the experiment
-        
-        # Extract references to data we wanna validate
-        Legs_entries = entries["trip_legs"]
+        try:
+            search_start = float(search_entries["Search start [ps]"].get())
+            search_end = float(search_entries["Search end [ps]"].get())
+            coarse_step = float(search_entries["Coarse step [ps]"].get())
+            mode = search_entries["Mode"].get()
+            time_constant = float(entries["time_constant"].get())
+            roll_off = int(entries["roll_off"].get())
+        except ValueError as e:
+            messagebox.showerror("Error", f"Please enter numbers for the search window:\n{e}")
+            return
 
-        # Construct a dict that will store the parsed verified data to later feed to the delay stage
-        experiment_parameters = {
-            "experiment_name": entries["experiment_name"].get(), 
-            "time_constant": float(entries["time_constant"].get()),
-            "roll_off": int(entries["roll_off"].get()),
-            "time_zero":float(entries["time_zero"].get()),
-            "num_scans":int(entries["num_scans"].get()) 
-            }
-        
-        trip_legs_parsed = {}
+        search_button.config(state=tk.DISABLED)
+        wait_for_heavy_imports()
 
+        output_queue = gui_wakeup.NotifyingQueue()
+        result_queue = queue.Queue()
+        capture_output(output_queue, print_on_cmd=False)
+
+        def search_thread_logic():
+            try:
+                result_queue.put(core_logic.search_time_zero(search_start, search_end, coarse_step, mode=mode,
+                                                             time_constant=time_constant, roll_off=roll_off))
+            except Exception as e:
+                error_queue.put(Exception(f"An error occured when searching time zero:\n{e}"))
+            finally:
+                restore_output()
+
+        time_zero_search_thread = threading.Thread(target=search_thread_logic)
+        time_zero_search_thread.start()
+        search_thread = time_zero_search_thread
+
+        def check_for_updates():
+            while not output_queue.empty():
+                listbox.insert(tk.END, output_queue.get())
+                listbox.see(tk.END)
+
+            if search_thread.is_alive():
+                return
+
+            updates_wakeup.stop()
+            search_button.config(state=tk.NORMAL)
+            if result_queue.empty():
+                return
+
+            # Write the time zero found into the entry and the preset, rounded to what the stage can resolve
+            time_zero = round(result_queue.get()["Time zero [ps]"], 4)
+            experiment_preset_file_path = 'Utils\experiment_preset.json'
+            entries["time_zero"].delete(0, tk.END)
+            entries["time_zero"].insert(0, time_zero)
+            try:
+                with open(experiment_preset_file_path, "r") as json_file:
+                    experiment_preset_save = json.load(json_file)
+                experiment_preset_save["time_zero"] = time_zero
+                with open(experiment_preset_file_path, "w") as json_file:
+                    json.dump(experiment_preset_save, json_file)
+            except Exception as e:
+                messagebox.showerror("Error", f"Time zero was found at {time_zero}ps but couldn't be saved to {experiment_preset_file_path}:\n{e}")
+                return
+
+            messagebox.showinfo("Time zero found", f"Time zero found at {time_zero}ps, it was written to the experiment preset")
+
+        # Runs whenever the search prints something, the fallback poll notices when it's done
+        updates_wakeup = gui_wakeup.GuiWakeup(search_window, check_for_updates, fallback_ms=500)
+        updates_wakeup.listen(output_queue)
+        check_for_updates()
+
+    search_button = tk.Button(search_window, text="Search", command=start_search)
+    search_button.grid(row=row_num, column=0, padx=10, pady=5, sticky="w")
+
+
+
+def experiment_queue_button():
+    """
+    Window to queue experiments and run them back to back on the initialized devices (see experiment_queue.py).
+    Jobs come from the parameters on screen or from preset files, the queue is kept when the window is closed.
+    """
+    global Experiment_queue, experiment_queue_data_queue
+
+    if not initialized:
+        messagebox.showinfo("Error opening experiment queue", "Please start/wait for device initialization to complete before running an experiment queue")
+        return
+
+    wait_for_heavy_imports()
+    if Experiment_queue is None:
+        Experiment_queue = experiment_queue.ExperimentQueue()
+        experiment_queue_data_queue = gui_wakeup.NotifyingQueue()
+
+    queue_window = Toplevel(main_window)
+    queue_window.title("Experiment queue")
+    queue_window.geometry("1100x700")
+    queue_window.grid_rowconfigure(1, weight=1)
+    queue_window.grid_columnconfigure(0, weight=1)
+
+    ### Status of every job, in the order they run
+    columns = ("Experiment", "Time constant [s]", "Roll-off [dB/oct]", "Points", "Scans", "Status", "Finishing at")
+    job_table = ttk.Treeview(queue_window, columns=columns, show="headings", height=10)
+    for column in columns:
+        job_table.heading(column, text=column)
+        job_table.column(column, width=220 if column in ("Experiment", "Finishing at") else 110, anchor="w")
+    job_table.grid(row=0, column=0, padx=10, pady=10, sticky="nsew")
+
+    # Log of the running job, every job also has its own experiment.log
+    log_frame = tk.Frame(queue_window)
+    log_frame.grid(row=1, column=0, padx=10, sticky="nsew")
+    log_frame.grid_rowconfigure(0, weight=1)
+    log_frame.grid_columnconfigure(0, weight=1)
+    listbox = tk.Listbox(log_frame, selectmode=tk.SINGLE, height=15)
+    scrollbar = tk.Scrollbar(log_frame, orient=tk.VERTICAL, command=listbox.yview)
+    listbox.config(yscrollcommand=scrollbar.set)
+    listbox.grid(row=0, column=0, sticky="nsew")
+    scrollbar.grid(row=0, column=1, sticky="ns")
+    queue_log_view = log_view.LogView(listbox, Experiment_queue.log, max_lines=log_view_max_lines, level="Info")
+
+    status_label = tk.Label(queue_window, text="", anchor="w")
+    status_label.grid(row=2, column=0, padx=10, pady=5, sticky="ew")
+
+    buttons_frame = tk.Frame(queue_window)
+    buttons_frame.grid(row=3, column=0, padx=10, pady=10, sticky="w")
+
+
+    def update_queue_view():
+        # Packets only feed the finishing times, the queue thread writes the data
+        while True:
+            try:
+                Experiment_queue.update(experiment_queue_data_queue.get_nowait())
+            except queue.Empty:
+                break
+        queue_log_view.update()
+
+        rows = []
+        for job, finishing_time in Experiment_queue.finishing_times():
+            time_constant, roll_off = job["Lockin settings"]
+            finishing_str = finishing_time.strftime("%d/%m/%Y %H:%M") if finishing_time is not None else job["Message"]
+            rows.append((str(id(job)), (job["Experiment name"], time_constant, roll_off, job["Points"], job["Parameters"]["num_scans"],
+                                         job["Status"], finishing_str)))
+
+        # Rows are updated in place so the selection stays
+        row_ids = [row_id for row_id, _ in rows]
+        for row_id in job_table.get_children():
+            if row_id not in row_ids:
+                job_table.delete(row_id)
+        for index, (row_id, values) in enumerate(rows):
+            if job_table.exists(row_id):
+                job_table.item(row_id, values=values)
+                job_table.move(row_id, "", index)
+            else:
+                job_table.insert("", index, iid=row_id, values=values)
+
+        running = experiment_queue_thread is not None and experiment_queue_thread.is_alive()
+        if running:
+            status_label.config(text=Experiment_queue.message() or "Starting experiment queue...")
+        else:
+            waiting = [job for job in Experiment_queue.jobs if job["Status"] == "Waiting"]
+            status_label.config(text=f"{len(waiting)} experiments waiting")
+        run_button.config(state=tk.DISABLED if running else tk.NORMAL)
+        stop_button.config(state=tk.NORMAL if running else tk.DISABLED)
+
+
+    def add_screen_experiment():
+        experiment_parameters = get_parse_validate_screen_experiment()
+        if experiment_parameters is None:
+            return
+        try:
+            job = Experiment_queue.add(experiment_parameters)
+        except ValueError as e:
+            messagebox.showerror("Error", f"The trip legs don't make a valid scan:\n{e}")
+            return
+        if job["Experiment name"] != experiment_parameters["experiment_name"]:
+            messagebox.showinfo("Experiment queued", f"{experiment_parameters['experiment_name']} is taken, the experiment will be saved as {job['Experiment name']}")
+        update_queue_view()
+
+
+    def add_preset_files():
+        file_paths = filedialog.askopenfilenames(parent=queue_window, title="Experiment presets", initialdir="Utils",
+                                                 filetypes=[("Experiment presets", "*.json")])
+        if not file_paths:
+            return
 
-        ### We first validate that the time zero parameter is safe (all absolute parameters reference time zero)
         validation_rules_file_path = 'Utils/validation_rules.json'
         try:
             with open(validation_rules_file_path, "r") as json_file:
                 validation_rules = json.load(json_file)
         except Exception as e:
-            raise Exception(f"An error occured when opening {validation_rules_file_path}\n{e}")
+            messagebox.showerror("Error", f"An error occured when opening {validation_rules_file_path}\n{e}")
+            return
 
+        for file_path in file_paths:
+            try:
+                with open(file_path, "r") as json_file:
+                    preset = json.load(json_file)
+                problems = preset_validation.preset_problems(preset, validation_rules)
+                if not problems:
+                    Experiment_queue.add(preset)
+            except Exception as e:
+                problems = [str(e)]
+            if problems:
+                messagebox.showerror("Error", f"{os.path.basename(file_path)} can't be queued:\n" + "\n".join(problems))
+        update_queue_view()
+
+
+    def remove_selected():
+        jobs = {str(id(job)): job for job in Experiment_queue.jobs}
+        for row_id in job_table.selection():
+            try:
+                Experiment_queue.remove(jobs[row_id])
+            except (KeyError, ValueError) as e:
+                messagebox.showinfo("Error", f"{e}")
+        update_queue_view()
 
-        valid_parameter, _ = is_value_valid("time_zero", 
-                                                       entries["time_zero"].get(), 
-                                                       validation_rules["time_zero"])
-        if not valid_parameter:
-                return
 
-        ### We then proceed to validate all other risky parameters
+    def set_keep_order():
+        Experiment_queue.keep_order = keep_order_variable.get()
 
-        # Validate and parse iteratively
-        for leg_number, leg_entries in Legs_entries.items():
 
-            # For each leg parameters we estimate and accumulate it's duration
-            # First get parameters from screen and verify they are valid
-            valid_parameters, parsed_values = get_parse_validate_screen_params(leg_entries)
+    def run_queue():
+        global experiment_queue_thread
+        running = devices_in_use()
+        if running is not None:
+            messagebox.showinfo("Error", f"Please wait for {running} to finish or stop it before running the experiment queue")
+            return
 
-            if valid_parameters:
-                trip_legs_parsed[leg_number] = parsed_values
-            
-            else:
-                return
+        if not any(job["Status"] == "Waiting" for job in Experiment_queue.jobs):
+            messagebox.showinfo("Error", "There are no experiments waiting in the queue")
+            return
+
+        global Snapshot_renderer
+        if Snapshot_renderer is None:
+            Snapshot_renderer = snapshot_renderer.SnapshotRenderer(snapshot_format, snapshot_dpi, snapshot_defer_until_end)
+
+        def experiment_queue_thread_logic():
+            try:
+                # The first experiment is the one that starts closest to where the stage is now
+                Experiment_queue.run(experiment_queue_data_queue, abort_queue, Snapshot_renderer,
+                                     core_logic.current_delay_ps(), scan_store_directory)
+            except Exception as e:
+                error_queue.put(Exception(f"An error occured while running the experiment queue:\n{e}"))
+            finally:
+                restore_output()
+                queue_wakeup.notify()
+
+        # Prints go to the queue's log and the log file of the running experiment
+        Experiment_queue.log.capture_output()
+        experiment_queue_thread = threading.Thread(target=experiment_queue_thread_logic)
+        experiment_queue_thread.start()
+        update_queue_view()
+
+
+    def stop_queue():
+        messagebox.showinfo("Wait", f"Stopping the experiment queue after the current point\nThe experiments left stay in the queue")
+        Experiment_queue.stop(abort_queue)
+
+
+    tk.Button(buttons_frame, text="Add experiment on screen", command=add_screen_experiment).grid(row=0, column=0, padx=5, sticky="w")
+    tk.Button(buttons_frame, text="Add preset files", command=add_preset_files).grid(row=0, column=1, padx=5, sticky="w")
+    tk.Button(buttons_frame, text="Remove selected", command=remove_selected).grid(row=0, column=2, padx=5, sticky="w")
+    run_button = tk.Button(buttons_frame, text="Run queue", command=run_queue)
+    run_button.grid(row=0, column=3, padx=5, sticky="w")
+    stop_button = tk.Button(buttons_frame, text="Stop queue", command=stop_queue)
+    stop_button.grid(row=0, column=4, padx=5, sticky="w")
+
+    # Unticked, the experiments waiting are reordered to change the lockin settings and move the stage as little as possible
+    keep_order_variable = tk.BooleanVar(value=Experiment_queue.keep_order)
+    tk.Checkbutton(buttons_frame, text="Keep queue order", variable=keep_order_variable, command=set_keep_order).grid(row=0, column=5, padx=5, sticky="w")
+
+    # Packets and log lines wake the view up, the fallback poll moves the finishing times along
+    queue_wakeup = gui_wakeup.GuiWakeup(queue_window, update_queue_view, fallback_ms=1000)
+    queue_wakeup.listen(experiment_queue_data_queue)
+    Experiment_queue.log.on_line = queue_wakeup.notify
+
+    # The queue goes on running with the window closed, opening it again shows where it is
+    def close_queue_window():
+        queue_wakeup.stop()
+        Experiment_queue.log.on_line = None
+        close_window(queue_window)
+
+    queue_window.protocol("WM_DELETE_WINDOW", close_queue_window)
+    update_queue_view()
+
+
+
+def get_parse_validate_screen_experiment():
+    '''
+    Gets the experiment parameters on screen into a dict like the experiment presets, parsed and validated.
+    Returns None if any parameter is not valid, the user has been told which one.
+    '''
+    global entries
+
+    # Extract references to data we wanna validate
+    Legs_entries = entries["trip_legs"]
+
+    # Construct a dict that will store the parsed verified data to later feed to the delay stage
+    experiment_parameters = {
+        "experiment_name": entries["experiment_name"].get(), 
+        "time_constant": float(entries["time_constant"].get()),
+        "roll_off": int(entries["roll_off"].get()),
+        "error_measurement_type": str(entries["error_measurement_type"].get()),
+        "autoranging_type": str(entries["autoranging_type"].get()),
+        "time_zero":float(entries["time_zero"].get()),
+        "num_scans":int(entries["num_scans"].get()),
+        "binary_output": str(entries["binary_output"].get()),
+        "averaging_estimator": str(entries["averaging_estimator"].get()),
+        "scan_mode": str(entries["scan_mode"].get()),
+        "adaptive_point_budget": int(entries["adaptive_point_budget"].get()),
+        "acquisition_mode": str(entries["acquisition_mode"].get()),
+        "target_relative_error": float(entries["target_relative_error"].get()),
+        "time_budget_min": float(entries["time_budget_min"].get())
+        }
+    
+    trip_legs_parsed = {}
+
+
+    ### We first validate that the time zero parameter is safe (all absolute parameters reference time zero)
+    validation_rules_file_path = 'Utils/validation_rules.json'
+    try:
+        with open(validation_rules_file_path, "r") as json_file:
+            validation_rules = json.load(json_file)
+    except Exception as e:
+        raise Exception(f"An error occured when opening {validation_rules_file_path}\n{e}")
+
+
+    valid_parameter, _ = is_value_valid("time_zero", 
+                                                   entries["time_zero"].get(), 
+                                                   validation_rules["time_zero"])
+    if not valid_parameter:
+        return None
+
+    ### We then proceed to validate all other risky parameters
+
+    # Validate and parse iteratively
+    for leg_number, leg_entries in Legs_entries.items():
+
+        # First get parameters from screen and verify they are valid
+        valid_parameters, parsed_values = get_parse_validate_screen_params(leg_entries)
+
+        if valid_parameters:
+            trip_legs_parsed[leg_number] = parsed_values
         
-        experiment_parameters["trip_legs"] = trip_legs_parsed
+        else:
+            return None
+    
+    experiment_parameters["trip_legs"] = trip_legs_parsed
+
+    return experiment_parameters
+
+
+
+def launch_experiment(experiment_data_queue):
+
+    try:
+        global entries, experiment_thread
+
+        if not initialized:
+            messagebox.showinfo("Error launching experiment", "Please start/wait for device initialization to complete before launching experiment")
+            return
+
+        # The queue and the time zero search use the same devices, one thing at a time
+        running = devices_in_use()
+        if running is not None:
+            messagebox.showinfo("Error launching experiment", f"Please wait for {running} to finish or stop it before launching an experiment")
+            return
+
+        ### First we'll verify parameters are safe before launching the experiment
+        experiment_parameters = get_parse_validate_screen_experiment()
+        if experiment_parameters is None:
+            return
 
         # Then we check whether an output folder of the same name is in danger of being overwritten
         current_dir = os.path.dirname(os.path.abspath(__file__))
         output_folder = os.path.join(current_dir, "Output")
         data_folder = os.path.join(output_folder, entries["experiment_name"].get())
 
+        # Unless it's an experiment that was interrupted, then we offer to resume it from its checkpoint (see checkpoint.py)
+        resume_checkpoint = None
         if os.path.exists(data_folder):
 
-            messagebox.showerror("Error", "Choosing the same experiment file name will overwrite the data for the previous experiment with the same name\nPlease change experiment file name")
-            return 
+            wait_for_heavy_imports()
+            resume_checkpoint = checkpoint.load_checkpoint(checkpoint.checkpoint_folder(output_folder, entries["experiment_name"].get()))
+            if resume_checkpoint is None:
+                messagebox.showerror("Error", "Choosing the same experiment file name will overwrite the data for the previous experiment with the same name\nPlease change experiment file name")
+                return 
+
+            resume = messagebox.askyesno("Resume experiment", f"This experiment was interrupted at scan {resume_checkpoint['Current scan']} "
+                                                              f"after {resume_checkpoint['Points measured']} of its points (saved on {resume_checkpoint['Saved on']})\n\n"
+                                                              f"Resume it with the parameters it was launched with?")
+            if not resume:
+                return
+
+            # The experiment goes on with its own parameters, whatever is on screen
+            experiment_parameters = resume_checkpoint["Experiment parameters"]
+            create_experiment_gui_from_dict(experiment_parameters)
                 
 
         ### Once parameters are verified and parsed we proceed with the experiment launch
 
+        # Usually the warm up thread finished long ago, this only waits if the user was really quick
+        wait_for_heavy_imports()
+
+        # The positions are compiled once from the trip legs and shared by every scan (see scan_plan.py)
+        global Scan_store, Running_average, Scan_plan
+        try:
+            Scan_plan = scan_plan.compile_plan(experiment_parameters["trip_legs"])
+        except ValueError as e:
+            messagebox.showerror("Error", f"The trip legs don't make a valid scan:\n{e}")
+            return
+
+        # Every experiment starts with an empty scan store and average, averaged with the estimator picked in the preset.
+        # A resumed experiment gets back the scans it measured before it was interrupted
+        Scan_store = scan_store.ScanStore(scan_store_directory)
+        Running_average = scan_statistics.create_estimator(experiment_parameters["averaging_estimator"])
+        if resume_checkpoint is not None:
+            try:
+                Scan_plan = checkpoint.restore_checkpoint(resume_checkpoint, Scan_store, Running_average)
+            except ValueError as e:
+                messagebox.showerror("Error", f"The experiment can't be resumed:\n{e}")
+                return
+
         ### Create a window to monitor experiment
         monitoring_window = Toplevel(main_window)
         monitoring_window.title("Experiment in progress")
@@ -702,23 +1104,55 @@ def launch_experiment(experiment_data_queue):
         label = tk.Label(monitoring_window, text="Please wait while the experiment takes place...")
         label.grid(padx=20, pady=20)
 
+        # The log keeps the newest log_view_max_lines lines on screen and everything in Output/<experiment>/experiment.log
+        # (see log_view.py), lines below the level picked here are hidden
+        experiment_log = log_view.ExperimentLog(os.path.join(os.path.dirname(os.path.abspath(__file__)), "Output",
+                                                             experiment_parameters["experiment_name"], log_view.log_file_name))
+        experiment_log_view = log_view.LogView(listbox, experiment_log, max_lines=log_view_max_lines)
+
+        log_level_frame = tk.Frame(monitoring_window)
+        log_level_frame.grid(row=2, column=0, padx=20, sticky="w")
+        tk.Label(log_level_frame, text="Show log from level").grid(row=0, column=0, sticky="w")
+        log_level_combobox = ttk.Combobox(log_level_frame, values=log_view.log_levels, state="readonly", width=10)
+        log_level_combobox.set(experiment_log_view.level)
+        log_level_combobox.grid(row=0, column=1, padx=5, sticky="w")
+        log_level_combobox.bind("<<ComboboxSelected>>", lambda event: experiment_log_view.set_level(log_level_combobox.get()))
 
 
-        ### Create live graph
 
-        # Create figure and axes
-        fig, axes = plt.subplots(figsize=(10, 5), dpi=100)
-        axes.set_xlabel('t [ps]')
-        axes.set_ylabel('PD [Vrms]')
+        ### Create live graph
 
-        # Create an empty graph to grab a reference for the line object, this is the curve on the graph
-        # and we'll update it for every new data point, we do this because updating preserves user 
-        # zoom and pan on the graph. Simply redrawing the whole graph would reset them
-        global line_object, lines_list, cmap
-        line_object, = axes.plot([], [], linestyle='-', color=cmap(0), label="scan 0")
-        lines_list.append(line_object)
-        axes.set_xlabel('t [ps]')
-        axes.set_ylabel('PD [Vrms]')
+        # The figure and its lines are created once and reused by every experiment, the lines are updated
+        # for every new data point instead of redrawing the whole graph, which preserves user zoom and pan.
+        # It isn't a pyplot figure so nothing has to close it. When the number of samples per point changes
+        # from point to point (target relative error acquisition mode) it's shown on a second y axis.
+        # Experiments with many scans get the heat map, one row per scan instead of one line each
+        global Live_plot, cmap
+        if Live_plot is None:
+            Live_plot = live_plot.LivePlot(plt.Figure(figsize=(10, 5), dpi=100), max_fps=live_plot_max_fps)
+        num_scans = int(experiment_parameters["num_scans"])
+        heat_map_positions = None
+        if live_heat_map_from_scans is not None and num_scans >= live_heat_map_from_scans:
+            heat_map_positions = Scan_plan.positions
+        Live_plot.reset(show_sample_counts=experiment_parameters.get("acquisition_mode", "Fixed number of scans") != "Fixed number of scans",
+                        heat_map_positions=heat_map_positions, num_scans=num_scans)
+        Live_plot.start_scan(cmap(0), "scan 0")
+
+        # A resumed experiment shows the scans it measured before it was interrupted
+        if Live_plot.heat_map and resume_checkpoint is not None:
+            for row in range(min(resume_checkpoint["Current scan"] + 1, Scan_store.shape[0])):
+                measured = ~np.isnan(Scan_store.positions[row]) & ~np.isnan(Scan_store.data[row])
+                grid_indices = acquisition_policy.grid_indices(Scan_plan.positions, Scan_store.positions[row][measured])
+                for grid_index, value in zip(grid_indices, Scan_store.data[row][measured]):
+                    if grid_index >= 0:
+                        Live_plot.set_heat_map_point(row, int(grid_index), value)
+        fig = Live_plot.figure
+
+        # The images saved with every scan are rendered apart from the live graph
+        global Snapshot_renderer
+        if Snapshot_renderer is None:
+            Snapshot_renderer = snapshot_renderer.SnapshotRenderer(snapshot_format, snapshot_dpi, snapshot_defer_until_end)
+        Snapshot_renderer.start_experiment()
 
         # Frame for Graph
         graph_frame = tk.Frame(monitoring_window)
@@ -727,6 +1161,7 @@ def launch_experiment(experiment_data_queue):
         # Canvas for Matplotlib
         canvas = FigureCanvasTkAgg(fig, master=graph_frame)
         canvas.get_tk_widget().grid(row=0, column=0, sticky="nsew")
+        Live_plot.attach(canvas)
 
         # Add Navigation Toolbar for Zoom and Scroll on it's own 
         # toolbar because NavigationToolbar2Tk() internally uses pack() which conflicts
@@ -752,14 +1187,10 @@ def launch_experiment(experiment_data_queue):
             messagebox.showinfo("Wait", f"Stopping experiment\nThis may take a couple steps\nPlease wait while experiment closes window safely before launching a new experiment.")
             abort_queue.put(True)
 
-            # Close figure
-            plt.close(fig)
-
             # Clear previous data
-            '''global previous_scans, Scans'''
-            global previous_scans, Scans, finishing_time_str
-            previous_scans = []
-            Scans = []
+            global Scan_store, Running_average, finishing_time_str
+            Scan_store = scan_store.ScanStore(scan_store_directory)
+            Running_average = scan_statistics.RunningAverage()
             finishing_time_str = ''
 
 
@@ -768,59 +1199,108 @@ def launch_experiment(experiment_data_queue):
 
 
 
-        # Queue for reading prints from core_logic functions and displaying them on listbox
-        output_queue = queue.Queue()
-
-        # Redirect stdout and stderr to the queue. We capture prints that would go into the command line
-        # and redirect them to the experiment log
-        capture_output(output_queue, print_on_cmd=False)
+        # Redirect stdout and stderr to the experiment log. We capture prints that would go into the command line
+        # and show them on the listbox
+        experiment_log.capture_output()
 
         # Run experiment on a different thread
-        num_scans = int(entries["num_scans"].get())
-        error_measurement_type = str(entries["error_measurement_type"].get())
-        autoranging_type = str(entries["autoranging_type"].get())
+        error_measurement_type = str(experiment_parameters["error_measurement_type"])
+        autoranging_type = str(experiment_parameters["autoranging_type"])
         experiment_thread = threading.Thread(target=experiment_thread_logic, 
                                                 args=(experiment_parameters, 
                                                       experiment_data_queue, 
                                                       abort_queue, 
-                                                      fig, 
+                                                      Snapshot_renderer, 
                                                       num_scans, 
                                                       monitoring_window, 
                                                       error_measurement_type,
-                                                      autoranging_type))
+                                                      autoranging_type,
+                                                      resume_checkpoint))
         experiment_thread.start()
 
         global prev_scan
         prev_scan = 0
+        show_sample_counts = experiment_parameters.get("acquisition_mode", "Fixed number of scans") != "Fixed number of scans"
+
+        # How far behind the experiment the window is: packets that were waiting at the last tick and how
+        # old the newest point on screen was when it got drawn
+        monitor_metrics_label = tk.Label(graph_frame, text="", anchor="w")
+        monitor_metrics_label.grid(padx=20, row=3, column=0, sticky="ew")
+        monitor_metrics = {"Queue depth": 0, "Largest queue depth": 0, "Display lag [ms]": 0.0, "Newest point timestamp": None}
+
+        def show_live_scan():
+            """
+            Hands the current state of live_scan to the live plot, drawn with the next frame.
+            """
+            if live_scan.get("Measured points", 0) == 0:
+                return
+            measured_points = live_scan["Measured points"]
+
+            # We update only the line of the current scan, the curves for the previous
+            # scans are untouched
+            Live_plot.set_scan_data(live_scan["Positions"][:measured_points], live_scan["Photodiode data"][:measured_points])
+
+            # We then update the average if there is one to average
+            if live_scan["Live average"] is not None:
+                Live_plot.set_average(live_scan["Average positions"], live_scan["Live average"])
+
+            # Samples behind every point of the average, on their own axis
+            if show_sample_counts:
+                Live_plot.set_sample_counts(live_scan["Average positions"], live_scan["Sample counts"])
 
         # Function to check for updates from the queue.
         # Proceed with caution, this is one of the hackiest most convoluted functions in this project...
         # If you have to troubleshoot this... well Im sorry for you.
         def monitor_experiment():
 
-            global line_object, lines_list, prev_scan, cmap, first_iteration, average_line_object
+            global prev_scan, cmap
 
-            # First we wait for a command print from perform_experiment()
-            # once we receive it we print it in the log and continue with graphing
-            while not output_queue.empty():
-                new_message = output_queue.get()
-                listbox.insert(tk.END, new_message)
-                listbox.see(tk.END)  # Auto-scroll to the bottom
-            
-            # Update GUI as long as the experiment is taking place
-            if experiment_thread.is_alive():
+            # First we take every command print from perform_experiment() that arrived since the
+            # last tick and add them to the log in one go
+            experiment_log_view.update()
 
-                # Only update graph whenever new data is acquired
-                if not experiment_data_queue.empty():
+            # Then every data packet that's waiting. Points can arrive faster than we draw, so instead of
+            # one packet per tick (the queue backed up and the graph fell further and further behind
+            # the stage) we apply them all to live_scan and draw the newest state once
+            queue_depth = 0
+            points_pending = False
+            while True:
+                try:
+                    data_packet = experiment_data_queue.get_nowait()
+                except queue.Empty:
+                    break
+                queue_depth += 1
+                scan_number = int(data_packet["Scan number"])
+
+                # A scan start packet carries the positions for the whole scan, views of the scan
+                # store rows the experiment thread is filling and the average of the completed scans.
+                # Every point is written to the store before its packet is sent, so the point packets
+                # only tell us how far into the rows we can read
+                if data_packet["Packet type"] == "Scan start":
+
+                    # Points of the previous scan still waiting go to its own line first
+                    if points_pending:
+                        show_live_scan()
+                        points_pending = False
+
+                    live_scan["Positions"] = np.asarray(data_packet["Positions"], dtype=np.float64)
+                    live_scan["Photodiode data"] = data_packet["Scan data"]
+                    live_scan["Photodiode data errors"] = data_packet["Scan errors"]
+                    live_scan["Measured points"] = 0
 
-                    # Get data from experiment thread
-                    data_packet = experiment_data_queue.get()
-                    positions = data_packet["Positions"]
-                    photodiode_data = data_packet["Photodiode data"]
-                    photodiode_data_errors = data_packet["Photodiode data errors"]
-                    scan_number = int(data_packet["Scan number"])
                     live_average = data_packet["Live average"]
+                    live_scan["Live average"] = None if live_average is None else np.array(live_average, dtype=np.float64)
 
+                    # The average and the sample counts cover the whole grid, the scan itself might only
+                    # revisit some of its positions (target relative error acquisition mode)
+                    live_scan["Average positions"] = np.asarray(data_packet["Average positions"], dtype=np.float64)
+                    live_scan["Sample counts"] = np.array(data_packet["Sample counts"], dtype=np.float64)
+                    if show_sample_counts:
+                        Live_plot.set_sample_counts(live_scan["Average positions"], live_scan["Sample counts"])
+
+                    # The heat map follows the averaging grid (adaptive experiments refine it after the pilot scan)
+                    if Live_plot.heat_map:
+                        Live_plot.set_heat_map_grid(live_scan["Average positions"])
 
                     # If we detect that arriving data corresponds to a new scan we
                     # create a new line object to draw on a different curve
@@ -831,75 +1311,79 @@ def launch_experiment(experiment_data_queue):
                         color_fraction = scan_number / max_scans
                         new_color = cmap(color_fraction)
 
-                        # We then generate a new line object and append it to the list
-                        new_line_object, = axes.plot([], [], linestyle='-', color=new_color, label=f"scan {scan_number}")
-                        lines_list.append(new_line_object)
-                        line_object = new_line_object
+                        # The live plot hands out a line for it, the line of the previous scan is final
+                        Live_plot.start_scan(new_color, f"scan {scan_number}")
                         prev_scan = scan_number
 
-                        # And generate a new line object for the average, but we only need to draw one
-                        # average so
-                        
-                        if first_iteration:
-                            average_line_object, = axes.plot([], [], linestyle='--', linewidth=3, color="deepskyblue", label=f"Average")
-
-                            # Make sure we don't create any new average line objects on the following scans
-                            first_iteration = False
-
-                    
-                    # We update only the last line, corresponding to current scan data
-                    # that way we keep the curves for the previous scans untouched
-                    line_to_update = lines_list[-1]
-
-                    # Update graph with new data
-                    line_to_update.set_xdata(positions[:len(photodiode_data)])
-                    line_to_update.set_ydata(photodiode_data)
-
-                    # We then update the average if there is one to average
-                    if average_line_object is not None and live_average is not None:
-                        average_line_object.set_xdata(positions)
-                        average_line_object.set_ydata(live_average)
-
-                    axes.relim()           # Recompute the data limits based on current data
-                    axes.autoscale_view()  # Auto-adjust the view to the new limits
-                    axes.legend()
-
-                    # Update Canvas
-                    canvas.draw()
-
-
-                # Update the monitoring window at 10ms intervals
-                monitoring_window.after(10, monitor_experiment)
-
+                # A point packet only carries the new point and the average at that same position,
+                # the average has to take every one of them but the line only needs the last
+                elif data_packet["Packet type"] == "Point":
+                    live_scan["Measured points"] = data_packet["Index"] + 1
+                    average_index = data_packet["Average index"]
+                    if live_scan["Live average"] is not None and data_packet["Live average"] is not None:
+                        live_scan["Live average"][average_index] = data_packet["Live average"]
+                    live_scan["Sample counts"][average_index] = data_packet["Sample count"]
+                    monitor_metrics["Newest point timestamp"] = data_packet["Timestamp"]
+
+                    # One cell of the heat map per point, it costs the same however many scans there are
+                    if Live_plot.heat_map:
+                        Live_plot.set_heat_map_point(scan_number, average_index, data_packet["Photodiode data"], data_packet["Live average"])
+                    points_pending = True
+
+            if points_pending:
+                show_live_scan()
+
+            # Draws what changed since the last frame, at most live_plot_max_fps times per second.
+            # Updates skipped by the frame cap get drawn once it allows
+            frame_drawn = Live_plot.render()
+            next_frame_in = Live_plot.next_frame_in()
+            if next_frame_in is not None:
+                monitor_wakeup.schedule(next_frame_in)
+
+            monitor_metrics["Queue depth"] = queue_depth
+            monitor_metrics["Largest queue depth"] = max(monitor_metrics["Largest queue depth"], queue_depth)
+            if frame_drawn and monitor_metrics["Newest point timestamp"] is not None:
+                monitor_metrics["Display lag [ms]"] = 1000 * (time.time() - monitor_metrics["Newest point timestamp"])
+            if queue_depth > 0 or frame_drawn:
+                monitor_metrics_label.config(text=f"Queue depth: {monitor_metrics['Queue depth']} packets (largest {monitor_metrics['Largest queue depth']})"
+                                                  f"    Display lag: {round(monitor_metrics['Display lag [ms]'])}ms")
+
+            # Close experiment thread after it's done. While it runs monitor_experiment() is woken up
+            # by the packets and log lines it sends
+            if not experiment_thread.is_alive():
+                monitor_wakeup.stop()
+                experiment_thread.join()
 
+                # The thread gave stdout back, the last lines go to the file before its writer stops
+                experiment_log_view.update()
+                experiment_log.close()
 
-            # Close experiment thread after it's done
-            else:
-                experiment_thread.join()
                 label.config(text="Experiment completed")
 
                 # Clear previous data
-                global previous_scans, Scans, finishing_time_str
-                previous_scans = []
-                Scans = []
+                global Scan_store, Running_average, finishing_time_str
+                Scan_store = scan_store.ScanStore(scan_store_directory)
+                Running_average = scan_statistics.RunningAverage()
+
                 finishing_time_str = ''
 
                 # Remove stop early button from screen
                 Stop_early_button.destroy()
 
-                # Close figure
-                plt.close(fig)
+                # Last points that the frame cap held back
+                Live_plot.render(force=True)
 
 
-        # Start monitoring the experiment
-        global first_iteration
-        first_iteration = True
+        # Start monitoring the experiment. Packets and log lines wake it up, the fallback poll notices
+        # when the experiment thread is over
+        monitor_wakeup = gui_wakeup.GuiWakeup(monitoring_window, monitor_experiment, fallback_ms=250)
+        monitor_wakeup.listen(experiment_data_queue)
+        experiment_log.on_line = monitor_wakeup.notify
         monitor_experiment()
         
 
     except Exception as e:
         messagebox.showerror("Error", f"An error occurred:\n{e}")
-        plt.close(fig)
         
 
 
@@ -915,8 +1399,7 @@ def estimate_experiment_timespan(GUIless=False):
         time_constant = float(entries["time_constant"].get())
         roll_off = int(entries["roll_off"].get())
         num_scans = int(entries["num_scans"].get())
-        settling_time = core_logic.request_settling_time(time_constant, filter_slope=roll_off, verbose=False)
-        estimated_duration = 0
+        wait_for_heavy_imports()
 
 
         ### We first validate that the time zero parameter is safe (all absolute parameters reference time zero)
@@ -937,60 +1420,37 @@ def estimate_experiment_timespan(GUIless=False):
         ### We then proceed to validate all other risky parameters
 
         # Iterate through dict containing all trip legs
-        for leg_entries in Legs_entries.values():
+        trip_legs_parsed = {}
+        for leg_number, leg_entries in Legs_entries.items():
 
-            # For each leg parameters we estimate and accumulate it's duration
             # First get parameters from screen and verify they are valid
             valid_parameters, screen_values = get_parse_validate_screen_params(leg_entries)
 
-            if valid_parameters:
-                
-                ### Calculate time speint on each step 
-
-                # Get the relevant parameters
-                start_position = screen_values["abs time start [ps]"]
-                end_position = screen_values["abs time end [ps]"]
-                step_size = screen_values["step [ps]"]
-
-                average_step_duration_sec = 2.2 + settling_time # Moving + settling time
-                average_step_duration_sec += 1.1 # Capturing data
-                
-                # Add up time to every step depending on step configuration
-                error_measurement_type = entries["error_measurement_type"].get()
-                if error_measurement_type == "At every point":
-                    average_step_duration_sec += 2.2
-
-                autoranging_type = entries["autoranging_type"].get()
-                if autoranging_type == "At every point":
-                    # Autoscale
-                    average_step_duration_sec += 1.2
-
-                    # Autorange
-                    average_step_duration_sec += 0.1
-
-                ### Accumulate for all steps on each leg                
-                num_steps = ceil( (end_position - start_position) / step_size )
-                estimated_duration += int(average_step_duration_sec * num_steps )
-
             if not valid_parameters:
                 return None
 
-        # Finally multiply times the amount of scans selected
-        estimated_duration = estimated_duration * num_scans
-
-        # Add up one final time at the end when the user asks to only measure errors once
-        error_measurement_type = entries["error_measurement_type"].get()
-        if error_measurement_type == "Once at the start":
-            estimated_duration += 2.2
+            trip_legs_parsed[leg_number] = screen_values
 
-        autoranging_type = entries["autoranging_type"].get()
-        if autoranging_type == "Once at time zero":
- 
-            # Autoscale
-            estimated_duration += 1.2
+        ### Accumulate for all the points of the scan plan, the same positions the experiment measures
+        # (see scan_plan.py) so repeated positions of overlapping legs are only counted once
+        try:
+            plan = scan_plan.compile_plan(trip_legs_parsed)
+        except ValueError as e:
+            messagebox.showerror("Error", f"The trip legs don't make a valid scan:\n{e}")
+            return None
 
-            # Autorange
-            estimated_duration += 0.1
+        # The time every step takes is added up by core_logic, the experiment queue estimates its jobs with it too
+        estimated_duration = core_logic.estimate_experiment_duration({
+                                                                        "time_constant": time_constant,
+                                                                        "roll_off": roll_off,
+                                                                        "num_scans": num_scans,
+                                                                        "error_measurement_type": entries["error_measurement_type"].get(),
+                                                                        "autoranging_type": entries["autoranging_type"].get(),
+                                                                        "scan_mode": entries["scan_mode"].get(),
+                                                                        "adaptive_point_budget": int(entries["adaptive_point_budget"].get()),
+                                                                        "acquisition_mode": entries["acquisition_mode"].get(),
+                                                                        "time_budget_min": float(entries["time_budget_min"].get()),
+                                                                     }, plan)
 
         # At the end of the estimation we create a message for the user
         estimation_message = ""
@@ -1030,6 +1490,12 @@ def estimate_experiment_timespan(GUIless=False):
             finishing_time_str = str(finishing_time.strftime("%d/%m/%Y, %H"))
             estimation_message = f"above {estimated_duration_days} days\nFinishing the " + finishing_time_str + "h\nDon't you think you are pushing it just a little?..."
         
+        # Preview of the scan plan so the user can check the legs do what they meant
+        estimation_message += f"\n\nEvery scan measures {plan.summary()}"
+        if len(plan) > 0:
+            stage_positions_mm = plan.stage_positions_mm(float(entries["time_zero"].get()))
+            estimation_message += f"\nThe stage travels between {round(float(stage_positions_mm.min()), 4)}mm and {round(float(stage_positions_mm.max()), 4)}mm"
+
         if not GUIless:
             messagebox.showinfo("Estimation", f"Experiment is estimated to take {estimation_message}")
 
@@ -1051,6 +1517,15 @@ def create_experiment_gui_from_dict(parameters_dict):
     time_zero = parameters_dict["time_zero"]
     trip_legs = parameters_dict["trip_legs"]
     num_scans = parameters_dict["num_scans"]
+
+    # Presets saved before the binary output existed don't have this key
+    binary_output = parameters_dict.get("binary_output", "Off")
+    averaging_estimator = parameters_dict.get("averaging_estimator", "Mean")
+    scan_mode = parameters_dict.get("scan_mode", "Uniform")
+    adaptive_point_budget = parameters_dict.get("adaptive_point_budget", 0)
+    acquisition_mode = parameters_dict.get("acquisition_mode", "Fixed number of scans")
+    target_relative_error = parameters_dict.get("target_relative_error", 0.01)
+    time_budget_min = parameters_dict.get("time_budget_min", 0)
      
 
     experiment_parameters_frame = Screens["Experiment screen"]["Child frame"]
@@ -1104,7 +1579,7 @@ def create_experiment_gui_from_dict(parameters_dict):
     row_num += 1
 
     # Create Combobox to select how to measure errors
-    error_measurement_table = ["Never", "Once at the start", "At every point"]
+    error_measurement_table = ["Never", "Once at the start", "At every point", "From R samples"]
     label = tk.Label(experiment_parameters_frame, text="Error measurement type", anchor="w")
     label.grid(row=row_num, column=0, padx=10, pady=5, sticky="w")
     combo = ttk.Combobox(experiment_parameters_frame, values=error_measurement_table, state="readonly")
@@ -1123,6 +1598,74 @@ def create_experiment_gui_from_dict(parameters_dict):
     entries["autoranging_type"] = combo
     row_num += 1
 
+    # Create Combobox to select whether to also store all scans in a binary container
+    binary_output_table = ["Off", "Memory-mapped .npy"]
+    label = tk.Label(experiment_parameters_frame, text="Binary output (all scans in one file)", anchor="w")
+    label.grid(row=row_num, column=0, padx=10, pady=5, sticky="w")
+    combo = ttk.Combobox(experiment_parameters_frame, values=binary_output_table, state="readonly")
+    combo.set(binary_output)  # Default value
+    combo.grid(row=row_num, column=1, padx=10, pady=5, sticky="w")
+    entries["binary_output"] = combo
+    row_num += 1
+
+    # Create Combobox to select how scans are averaged, see scan_statistics.py
+    averaging_estimator_table = ["Mean", "Inverse-variance weighted", "Sigma-clipped", "Median of means"]
+    label = tk.Label(experiment_parameters_frame, text="Averaging of scans", anchor="w")
+    label.grid(row=row_num, column=0, padx=10, pady=5, sticky="w")
+    combo = ttk.Combobox(experiment_parameters_frame, values=averaging_estimator_table, state="readonly")
+    combo.set(averaging_estimator)  # Default value
+    combo.grid(row=row_num, column=1, padx=10, pady=5, sticky="w")
+    entries["averaging_estimator"] = combo
+    row_num += 1
+
+    # Create Combobox to select the scan mode, adaptive refines the grid after a first pilot scan (see adaptive_grid.py)
+    scan_mode_table = ["Uniform", "Adaptive"]
+    label = tk.Label(experiment_parameters_frame, text="Scan mode", anchor="w")
+    label.grid(row=row_num, column=0, padx=10, pady=5, sticky="w")
+    combo = ttk.Combobox(experiment_parameters_frame, values=scan_mode_table, state="readonly")
+    combo.set(scan_mode)  # Default value
+    combo.grid(row=row_num, column=1, padx=10, pady=5, sticky="w")
+    entries["scan_mode"] = combo
+    row_num += 1
+
+    # Points per scan after the pilot in adaptive mode, 0 keeps as many as the trip legs give
+    label = tk.Label(experiment_parameters_frame, text="Adaptive point budget (0 = same as trip legs)", anchor="w")
+    label.grid(row=row_num, column=0, padx=10, pady=5, sticky="w")
+    entry = tk.Entry(experiment_parameters_frame)
+    entry.grid(row=row_num, column=1, padx=10, pady=5, sticky="w")
+    entry.insert(0, adaptive_point_budget)
+    entries["adaptive_point_budget"] = entry
+    row_num += 1
+
+    # Create Combobox to select when the experiment stops, "Target relative error" keeps revisiting
+    # the points that are still noisy until they reach the target (see acquisition_policy.py)
+    acquisition_mode_table = ["Fixed number of scans", "Target relative error"]
+    label = tk.Label(experiment_parameters_frame, text="Acquisition mode", anchor="w")
+    label.grid(row=row_num, column=0, padx=10, pady=5, sticky="w")
+    combo = ttk.Combobox(experiment_parameters_frame, values=acquisition_mode_table, state="readonly")
+    combo.set(acquisition_mode)  # Default value
+    combo.grid(row=row_num, column=1, padx=10, pady=5, sticky="w")
+    entries["acquisition_mode"] = combo
+    row_num += 1
+
+    # Relative standard error every point should reach in target relative error mode
+    label = tk.Label(experiment_parameters_frame, text="Target relative error (0.01 = 1%)", anchor="w")
+    label.grid(row=row_num, column=0, padx=10, pady=5, sticky="w")
+    entry = tk.Entry(experiment_parameters_frame)
+    entry.grid(row=row_num, column=1, padx=10, pady=5, sticky="w")
+    entry.insert(0, target_relative_error)
+    entries["target_relative_error"] = entry
+    row_num += 1
+
+    # No new scan is started after this long in target relative error mode
+    label = tk.Label(experiment_parameters_frame, text="Time budget [min] (0 = no limit)", anchor="w")
+    label.grid(row=row_num, column=0, padx=10, pady=5, sticky="w")
+    entry = tk.Entry(experiment_parameters_frame)
+    entry.grid(row=row_num, column=1, padx=10, pady=5, sticky="w")
+    entry.insert(0, time_budget_min)
+    entries["time_budget_min"] = entry
+    row_num += 1
+
     # Time zero input
     label = tk.Label(experiment_parameters_frame, text="rel time zero [ps]", anchor="w")
     label.grid(row=row_num, column=0, padx=10, pady=5, sticky="w")
@@ -1243,6 +1786,13 @@ def edit_trip_legs():
         autoranging_type = str(entries["autoranging_type"].get())
         time_zero = float(entries["time_zero"].get())
         num_scans = int(entries["num_scans"].get())
+        binary_output = str(entries["binary_output"].get())
+        averaging_estimator = str(entries["averaging_estimator"].get())
+        scan_mode = str(entries["scan_mode"].get())
+        adaptive_point_budget = int(entries["adaptive_point_budget"].get())
+        acquisition_mode = str(entries["acquisition_mode"].get())
+        target_relative_error = float(entries["target_relative_error"].get())
+        time_budget_min = float(entries["time_budget_min"].get())
 
         new_experiment_dict = {"experiment_name": str(experiment_name), 
                                "time_constant": str(time_constant), 
@@ -1250,7 +1800,14 @@ def edit_trip_legs():
                                "error_measurement_type": str(error_measurement_type), 
                                "autoranging_type": str(autoranging_type), 
                                "time_zero": str(time_zero), 
-                               "num_scans": str(num_scans)}
+                               "num_scans": str(num_scans),
+                               "binary_output": str(binary_output),
+                               "averaging_estimator": str(averaging_estimator),
+                               "scan_mode": str(scan_mode),
+                               "adaptive_point_budget": str(adaptive_point_budget),
+                               "acquisition_mode": str(acquisition_mode),
+                               "target_relative_error": str(target_relative_error),
+                               "time_budget_min": str(time_budget_min)}
         
         # We now append as many trip legs as requested
         new_legs = {}
@@ -1503,27 +2060,35 @@ def main():
         button = tk.Button(Experiment_screen, text="Launch experiment", command=partial(launch_experiment, experiment_data_queue))
         button.grid(row=0, column=3, padx=10, pady=5, sticky="w")
 
+        # Search time zero automatically instead of with test scans
+        button = tk.Button(Experiment_screen, text="Find time zero", command=find_time_zero_button)
+        button.grid(row=0, column=4, padx=10, pady=5, sticky="w")
+
+        # Run several experiments back to back without launching every one by hand
+        button = tk.Button(Experiment_screen, text="Experiment queue", command=experiment_queue_button)
+        button.grid(row=0, column=5, padx=10, pady=5, sticky="w")
+
         # Check for errors from thread
         def check_for_errors():
             """Check for errors in the queue and show them in a messagebox."""
-            try:
-                
-                # get_nowait() attempts to immediately get an error from queue
-                # but it throws an empty queue error if the queue is empty
-                error = error_queue.get_nowait()
+            while True:
+                try:
+                    
+                    # get_nowait() attempts to immediately get an error from queue
+                    # but it throws an empty queue error if the queue is empty
+                    error = error_queue.get_nowait()
+
+                # No errors left, we'll be woken up when the next one arrives
+                except queue.Empty:
+                    return
 
                 # If the queue is not empty it means we received an error and 
                 # the try block will not exit early allowing us to run the following line
                 messagebox.showerror("Error", str(error))
 
-                # Continue listening for more future errors
-                main_window.after(100, check_for_errors)
-
-            # If we receive no error message we check for errors again after 100ms
-            except queue.Empty:
-                main_window.after(100, check_for_errors)
-
-        # Start checking for errors
+        # Threads putting an error in the queue wake this up, the fallback poll is only a safety net
+        errors_wakeup = gui_wakeup.GuiWakeup(main_window, check_for_errors, fallback_ms=2000)
+        errors_wakeup.listen(error_queue)
         check_for_errors()
 
 
@@ -1544,6 +2109,9 @@ def main():
 
         main_window.config(menu=menubar)
 
+        # The main window is ready, import the heavy modules in the background while the user gets going
+        threading.Thread(target=import_heavy_modules, daemon=True).start()
+
         # Call the main window to draw the GUI
         main_window.mainloop()
 
@@ -1563,8 +2131,18 @@ def main():
         
         if experiment_thread is not None:
             if experiment_thread.is_alive():
+                abort_queue.put(True)
                 experiment_thread.join()
 
+        if experiment_queue_thread is not None:
+            if experiment_queue_thread.is_alive():
+                Experiment_queue.stop(abort_queue)
+                experiment_queue_thread.join()
+
+        if time_zero_search_thread is not None:
+            if time_zero_search_thread.is_alive():
+                time_zero_search_thread.join()
+
         if initialization_thread is not None:
             if initialization_thread.is_alive():
                 initialization_thread.join()
@@ -1575,4 +2153,5 @@ def main():
         return None
 
 
-main()
+if __name__ == "__main__":
+    main()
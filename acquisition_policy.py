@@ -0,0 +1,159 @@
+import time
+import numpy as np
+
+
+# Decides which positions every pass (scan) of an experiment measures and when the experiment stops.
+#
+# "Fixed number of scans" is what the launcher always did: num_scans passes over every position.
+#
+# "Target relative error" keeps going until every point is good enough: after min_passes full passes it
+# looks at the standard error of the running average at every position and schedules the next pass only
+# over the positions still above the target relative error, so the averaging time goes where the signal
+# is weak instead of revisiting points that are done. It stops once every point reaches the target, after
+# num_scans passes or when the time budget runs out (a pass that already started is finished).
+#
+# The relative error is taken against max(|average|, noise_floor_fraction * largest |average|), otherwise
+# points before time zero, where the signal is ~0, would never converge.
+#
+# Usage, a pass of None means every position:
+#   policy = acquisition_policy.create_policy(parameters_dict)
+#   for scan, position_indices in enumerate(policy.passes(Running_average)):
+#       perform_experiment(..., scan, ..., position_indices=position_indices)
+#   print(policy.stop_reason)
+#
+# first_pass skips the passes an interrupted experiment already measured and start is when the time
+# budget started counting (see checkpoint.py).
+
+
+class FixedScansPolicy:
+    """
+    num_scans passes over every position.
+    """
+
+    name = "Fixed number of scans"
+
+    def __init__(self, num_scans):
+        self.num_scans = num_scans
+        self.stop_reason = ""
+
+
+    def passes(self, Running_average, first_pass=0, start=None):
+        for _ in range(first_pass, self.num_scans):
+            yield None
+        self.stop_reason = f"All {self.num_scans} scans completed"
+
+
+
+class TargetErrorPolicy:
+    """
+    Passes over the positions whose relative standard error is still above target, see module comment.
+
+    Parameters:
+        target_relative_error: float - e.g. 0.01 for 1%.
+        max_passes: int - Passes at most, usually num_scans.
+        time_budget_s: float - Seconds after which no new pass is started, 0 or less for no limit.
+        min_passes: int - Full passes before positions start being skipped, at least 2 to have a standard error.
+        noise_floor_fraction: float - See module comment.
+    """
+
+    name = "Target relative error"
+
+    def __init__(self, target_relative_error, max_passes, time_budget_s=0, min_passes=2, noise_floor_fraction=0.05):
+        self.target_relative_error = target_relative_error
+        self.max_passes = max_passes
+        self.time_budget_s = time_budget_s
+        self.min_passes = max(min_passes, 2)
+        self.noise_floor_fraction = noise_floor_fraction
+        self.stop_reason = ""
+
+
+    def relative_error(self, Running_average):
+        """
+        Relative standard error at every measured position, inf where there aren't 2 samples yet.
+        """
+        measured = np.count_nonzero(Running_average.count > 0)
+        average = np.abs(np.asarray(Running_average.mean(measured)))
+        standard_error = Running_average.standard_error(measured)
+
+        scale = np.maximum(average, self.noise_floor_fraction * (np.max(average) if measured > 0 else 0.0))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            relative_error = standard_error / scale
+        return np.where(np.isfinite(relative_error), relative_error, np.inf)
+
+
+    def passes(self, Running_average, first_pass=0, start=None):
+        # A resumed experiment counts the time it ran before it was interrupted (see checkpoint.py)
+        if start is None:
+            start = time.time()
+        for pass_number in range(first_pass, self.max_passes):
+
+            if self.time_budget_s > 0 and time.time() - start >= self.time_budget_s:
+                self.stop_reason = f"Time budget of {round(self.time_budget_s / 60, 1)}min ran out after {pass_number} passes"
+                return
+
+            if pass_number < self.min_passes:
+                yield None
+                continue
+
+            relative_error = self.relative_error(Running_average)
+            pending = np.flatnonzero(relative_error > self.target_relative_error)
+            if len(pending) == 0:
+                self.stop_reason = f"Every point reached the target relative error of {self.target_relative_error} after {pass_number} passes"
+                return
+
+            print(f"Next pass measures the {len(pending)}/{len(relative_error)} points above the target relative error")
+            yield pending
+
+        self.stop_reason = f"Reached the maximum of {self.max_passes} passes"
+
+
+
+def create_policy(parameters_dict):
+    """
+    Policy selected with "acquisition_mode" in the experiment preset. Presets without it get the fixed
+    number of scans.
+    """
+    acquisition_mode = parameters_dict.get("acquisition_mode", FixedScansPolicy.name)
+    num_scans = int(parameters_dict["num_scans"])
+
+    if acquisition_mode == FixedScansPolicy.name:
+        return FixedScansPolicy(num_scans)
+
+    if acquisition_mode == TargetErrorPolicy.name:
+        return TargetErrorPolicy(float(parameters_dict.get("target_relative_error", 0.01)),
+                                 max_passes=num_scans,
+                                 time_budget_s=60 * float(parameters_dict.get("time_budget_min", 0)))
+
+    raise ValueError(f"Unknown acquisition mode '{acquisition_mode}'")
+
+
+
+def grid_indices(grid_positions, positions, tolerance=1e-6):
+    """
+    Index of every position in grid_positions, -1 for positions that aren't on the grid. Used to put
+    the points of a partial pass back in their place when scans are averaged after the experiment.
+
+    Parameters:
+        grid_positions: array like - Positions of the whole grid in ps, any order.
+        positions: array like - Positions of a scan in ps.
+        tolerance: float - Largest distance in ps between a position and the grid point it matches.
+
+    Returns:
+        numpy int array: Same length as positions.
+    """
+    grid_positions = np.asarray(grid_positions, dtype=np.float64)
+    positions = np.asarray(positions, dtype=np.float64)
+    indices = np.full(len(positions), -1, dtype=np.int64)
+    if len(grid_positions) == 0 or len(positions) == 0:
+        return indices
+
+    # Nearest grid point to every position, looked up on the sorted grid
+    order = np.argsort(grid_positions, kind="stable")
+    sorted_grid = grid_positions[order]
+    right = np.clip(np.searchsorted(sorted_grid, positions), 0, len(sorted_grid) - 1)
+    left = np.clip(right - 1, 0, len(sorted_grid) - 1)
+    nearest = np.where(np.abs(sorted_grid[left] - positions) <= np.abs(sorted_grid[right] - positions), left, right)
+
+    on_grid = np.abs(sorted_grid[nearest] - positions) <= tolerance
+    indices[on_grid] = order[nearest[on_grid]]
+    return indices
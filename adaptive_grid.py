@@ -0,0 +1,128 @@
+import numpy as np
+
+
+# Adaptive delay grid.
+#
+# Trip legs are uniform grids, so to resolve the fast rise around time zero people add legs with tiny
+# steps and end up oversampling the flat regions as well. In adaptive scan mode ("scan_mode" in the
+# experiment preset) the first scan is a coarse pilot over the trip legs, then refine_grid() moves the
+# points to where the pilot shows curvature and every later scan uses that grid.
+#
+# Linear interpolation between two points h apart misses the signal by about h^2/8 * |y''|, so to stay
+# below a tolerance the point density must be at least sqrt(|y''| / (8 * tolerance)) points per ps. We
+# build that density from the curvature of the pilot, never let it drop below a floor (flat regions
+# still get points, at most max_stretch times the coarsest pilot step apart) and place the point budget
+# so that every interval gets the same share of it. The result lies within the span of the pilot, which
+# was already validated against the stage travel limits.
+
+
+# Smallest step the validation rules allow ("step [ps]" in Utils/validation_rules.json), refined
+# points are never closer than this
+minimum_step_ps = 6.68E-4
+
+
+def curvature(positions, signal):
+    """
+    Second derivative of the signal on a non uniform grid (second divided differences), the end
+    points copy their neighbours.
+    """
+    h = np.diff(positions)
+    slopes = np.diff(signal) / h
+    second_derivative = np.empty(len(positions))
+    second_derivative[1:-1] = 2 * np.diff(slopes) / (h[1:] + h[:-1])
+    second_derivative[0] = second_derivative[1]
+    second_derivative[-1] = second_derivative[-2]
+    return second_derivative
+
+
+def interval_curvature(positions, signal):
+    """
+    Largest |y''| at the ends of each interval, widened by one neighbour on each side. Curvature
+    from measured data is noisy, it's better to over refine a little than to miss the rise.
+    """
+    magnitude = np.abs(curvature(positions, signal))
+    widened = magnitude.copy()
+    widened[1:] = np.maximum(widened[1:], magnitude[:-1])
+    widened[:-1] = np.maximum(widened[:-1], magnitude[1:])
+    return np.maximum(widened[:-1], widened[1:])
+
+
+def interpolation_error(positions, signal):
+    """
+    Estimated linear interpolation error of every interval of the grid.
+    """
+    return np.diff(positions) ** 2 / 8 * interval_curvature(positions, signal)
+
+
+def default_tolerance(signal, errors=None):
+    """
+    The noise of the pilot if we measured it (no point resolving the signal much better than we can
+    measure it), 1% of the signal swing otherwise.
+    """
+    if errors is not None:
+        errors = np.asarray(errors, dtype=np.float64)
+        usable = errors[np.isfinite(errors) & (errors > 0)]
+        if len(usable) > 0:
+            return float(np.median(usable))
+
+    return 0.01 * float(np.ptp(signal))
+
+
+def refine_grid(positions, signal, num_points=None, tolerance=None, errors=None, max_stretch=2.0, min_step=minimum_step_ps):
+    """
+    Places num_points delays between the first and last pilot position, dense where the pilot signal
+    curves and sparse where it's flat (see module comment).
+
+    Parameters:
+        positions, signal: array like - Pilot scan, positions in ps relative to time zero.
+        num_points: int or None - Point budget of the refined grid, None keeps the pilot's.
+        tolerance: float or None - Interpolation error we aim for, see default_tolerance().
+        errors: array like or None - Pilot errors, used for the default tolerance.
+        max_stretch: float - Flat regions get points at most max_stretch times the coarsest pilot step apart.
+        min_step: float - Smallest distance between refined points in ps.
+
+    Returns:
+        numpy array: Sorted refined positions. The pilot positions if there's nothing to refine.
+    """
+    positions = np.asarray(positions, dtype=np.float64)
+    signal = np.asarray(signal, dtype=np.float64)
+    measured = np.isfinite(positions) & np.isfinite(signal)
+    order = np.argsort(positions[measured], kind="stable")
+    positions = positions[measured][order]
+    signal = signal[measured][order]
+    if errors is not None:
+        errors = np.asarray(errors, dtype=np.float64)[measured][order]
+
+    # Repeated positions would give zero width intervals
+    positions, unique_index = np.unique(positions, return_index=True)
+    signal = signal[unique_index]
+
+    if num_points is None:
+        num_points = len(positions)
+    if len(positions) < 3 or num_points < 2:
+        return positions
+
+    if tolerance is None:
+        tolerance = default_tolerance(signal, errors)
+    if tolerance <= 0:
+        return positions
+
+    # The pilot grid is already good enough and we aren't asked for a different budget
+    if num_points == len(positions) and np.all(interpolation_error(positions, signal) <= tolerance):
+        return positions
+
+    # Points per ps needed on every interval to stay within tolerance, with a floor for flat regions
+    h = np.diff(positions)
+    density = np.sqrt(interval_curvature(positions, signal) / (8 * tolerance))
+    density = np.maximum(density, 1 / (max_stretch * np.max(h)))
+
+    # Give every new interval the same share of the integrated density
+    cumulative = np.concatenate([[0.0], np.cumsum(density * h)])
+    targets = np.linspace(0.0, cumulative[-1], num_points)
+    refined = np.interp(targets, cumulative, positions)
+
+    # Keep the refined points on a min_step grid anchored at the first position, this also merges
+    # points that would be closer than the stage can tell apart
+    refined = positions[0] + np.round((refined - positions[0]) / min_step) * min_step
+    refined[-1] = positions[-1]
+    return np.unique(refined)
@@ -0,0 +1,239 @@
+import os
+import time
+import json
+import shutil
+from datetime import datetime
+import numpy as np
+
+import scan_plan
+import scan_store
+import acquisition_policy
+
+
+# Checkpoints to resume long experiments.
+#
+# A COM port hiccup twelve hours into an overnight run used to mean starting over from scan 0. While
+# the experiment runs perform_experiment() saves a checkpoint in Output/<experiment>/checkpoint every
+# checkpoint_every_s seconds, at the end of every scan and when a scan is aborted or crashes. It holds:
+#   checkpoint.json: experiment parameters, positions of the scan plan, which scan was running and how
+#       many of its points were measured, the positions of the pass, the lockin settings and how long the
+#       experiment has been running (the time budget of acquisition_policy.py goes on from there)
+#   scans.npz: positions, data and errors rows of the scan store up to the running scan, plus the stage
+#       readbacks and timestamps of the running scan, which only its ScanRecord holds
+#
+# Launching an experiment whose folder has a checkpoint offers to resume it. restore_checkpoint() puts
+# the scans back in the scan store, rebuilds the running average by feeding it the stored points in the
+# order they were measured (the same state the estimator had, whichever it is, see scan_statistics.py)
+# and resumed_passes() continues the acquisition policy from the next unmeasured point, with the clock of
+# experiment_start(). The checkpoint
+# is removed once the experiment finishes.
+#
+# Both files are written to a temporary file first and moved in place, the json goes last and is what
+# says how far the experiment got.
+
+
+checkpoint_folder_name = "checkpoint"
+checkpoint_file_name = "checkpoint.json"
+scans_file_name = "scans.npz"
+
+
+def checkpoint_folder(output_folder, experiment_name):
+    return os.path.join(output_folder, experiment_name, checkpoint_folder_name)
+
+
+
+def save_checkpoint(folder, parameters_dict, plan, Scan_store, scan, points_measured, position_indices=None, lockin_settings=None,
+                    elapsed_s=0.0, stage_readbacks=None, timestamps=None):
+    """
+    Saves where the experiment is, see module comment.
+
+    Parameters:
+        folder: str - Checkpoint folder, see checkpoint_folder().
+        parameters_dict: dict - Experiment parameters as given to perform_experiment().
+        plan: ScanPlan - Positions of the experiment (see scan_plan.py).
+        Scan_store: ScanStore - Store holding the scans (see scan_store.py).
+        scan: int - Scan that is running, or the next one to run when points_measured is 0.
+        points_measured: int - Points of that scan already in its store row.
+        position_indices: array like or None - Grid positions measured by that pass, None for all of them.
+        lockin_settings: dict or None - Lockin configuration the scan runs with.
+        elapsed_s: float - Seconds the experiment has been running, over every resume.
+        stage_readbacks, timestamps: array like or None - Those of the running scan (see scan_record.py).
+    """
+    os.makedirs(folder, exist_ok=True)
+
+    # Only the rows up to the running scan hold anything
+    rows = min(scan + 1, Scan_store.shape[0])
+    scans_path = os.path.join(folder, scans_file_name)
+    arrays = {"positions": Scan_store.positions[:rows], "data": Scan_store.data[:rows], "errors": Scan_store.errors[:rows]}
+    if stage_readbacks is not None:
+        arrays["stage_readbacks"] = stage_readbacks
+    if timestamps is not None:
+        arrays["timestamps"] = timestamps
+    with open(scans_path + ".tmp", "wb") as file:
+        np.savez(file, **arrays)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(scans_path + ".tmp", scans_path)
+
+    checkpoint = {
+        "Saved on": datetime.now().isoformat(timespec="seconds"),
+        "Experiment parameters": parameters_dict,
+        "Plan positions": plan.positions.tolist(),
+        "Scans completed": Scan_store.scans_completed,
+        "Current scan": int(scan),
+        "Points measured": int(points_measured),
+        "Position indices": None if position_indices is None else np.asarray(position_indices).tolist(),
+        "Lockin settings": lockin_settings if lockin_settings is not None else {},
+        "Elapsed time [s]": float(elapsed_s),
+    }
+    checkpoint_path = os.path.join(folder, checkpoint_file_name)
+    with open(checkpoint_path + ".tmp", "w") as json_file:
+        json.dump(checkpoint, json_file, indent=4, default=str)
+        json_file.flush()
+        os.fsync(json_file.fileno())
+    os.replace(checkpoint_path + ".tmp", checkpoint_path)
+
+
+
+def load_checkpoint(folder):
+    """
+    Reads a checkpoint, None if the folder doesn't have a complete one.
+
+    Returns:
+        dict: The checkpoint.json contents plus "Positions", "Data" and "Errors" arrays, and the
+        "Stage readbacks" and "Timestamps" arrays of the running scan (None if it had none).
+    """
+    checkpoint_path = os.path.join(folder, checkpoint_file_name)
+    scans_path = os.path.join(folder, scans_file_name)
+    if not (os.path.exists(checkpoint_path) and os.path.exists(scans_path)):
+        return None
+
+    with open(checkpoint_path, "r") as json_file:
+        checkpoint = json.load(json_file)
+
+    with np.load(scans_path) as scans:
+        checkpoint["Positions"] = scans["positions"]
+        checkpoint["Data"] = scans["data"]
+        checkpoint["Errors"] = scans["errors"]
+        checkpoint["Stage readbacks"] = scans["stage_readbacks"] if "stage_readbacks" in scans.files else None
+        checkpoint["Timestamps"] = scans["timestamps"] if "timestamps" in scans.files else None
+
+    # scans.npz is written first, if we died in between it can hold a few points the json doesn't
+    # know about. They'll be measured again
+    current_scan = checkpoint["Current scan"]
+    if current_scan < len(checkpoint["Data"]):
+        checkpoint["Data"][current_scan, checkpoint["Points measured"]:] = np.nan
+        checkpoint["Errors"][current_scan, checkpoint["Points measured"]:] = np.nan
+    for name in ("Stage readbacks", "Timestamps"):
+        if checkpoint[name] is not None:
+            checkpoint[name][checkpoint["Points measured"]:] = np.nan
+
+    return checkpoint
+
+
+
+def restore_checkpoint(checkpoint, Scan_store, Running_average):
+    """
+    Puts a checkpoint back into an empty scan store and running average.
+
+    Returns:
+        ScanPlan: The plan of the experiment, compiled again from its trip legs.
+
+    Raises:
+        ValueError: If the trip legs no longer compile to the positions the experiment was measuring.
+    """
+    parameters_dict = checkpoint["Experiment parameters"]
+    plan = scan_plan.compile_plan(parameters_dict["trip_legs"])
+    if len(plan) != len(checkpoint["Plan positions"]) or not np.allclose(plan.positions, checkpoint["Plan positions"]):
+        raise ValueError("The trip legs of the checkpoint don't give the positions the experiment was measuring")
+
+    positions = checkpoint["Positions"]
+    data = checkpoint["Data"]
+    errors = checkpoint["Errors"]
+    rows, columns = data.shape
+    num_scans, num_positions = scan_store.experiment_shape(parameters_dict, len(plan))
+    Scan_store.reserve(max(num_scans, rows), max(num_positions, columns))
+    Scan_store.positions[:rows, :columns] = positions
+    Scan_store.data[:rows, :columns] = data
+    Scan_store.errors[:rows, :columns] = errors
+    Scan_store.scans_completed = checkpoint["Scans completed"]
+
+    # Adaptive experiments average on the refined grid of scan 1 and leave the pilot out (see
+    # adaptive_grid.py), every other experiment averages on the plan
+    current_scan = checkpoint["Current scan"]
+    grid_positions = plan.positions
+    first_row = 0
+    if parameters_dict.get("scan_mode", "Uniform") == "Adaptive" and current_scan >= 1:
+        first_row = 1
+        if rows > 1:
+            grid_positions = positions[1][~np.isnan(positions[1])]
+
+    # Feed the stored points in the order they were measured, that leaves every estimator in the
+    # state it had when the checkpoint was saved
+    Running_average.reserve(len(grid_positions))
+    for row in range(first_row, min(rows, current_scan + 1)):
+        measured = ~np.isnan(positions[row]) & ~np.isnan(data[row])
+        indices = acquisition_policy.grid_indices(grid_positions, positions[row][measured])
+        for grid_index, value, error in zip(indices, data[row][measured], errors[row][measured]):
+            if grid_index >= 0:
+                Running_average.update(int(grid_index), value, error)
+
+    print(f"Resuming from scan {current_scan} with {checkpoint['Points measured']} of its points measured, checkpoint saved on {checkpoint['Saved on']}")
+    for setting, value in checkpoint["Lockin settings"].items():
+        print(f"    ·{setting} was {value}")
+
+    return plan
+
+
+
+def experiment_start(checkpoint=None):
+    """
+    When the experiment would have started had it never been interrupted, time.time() for a new one.
+    Time spent interrupted doesn't count towards the time budget of the acquisition policy.
+    """
+    if checkpoint is None:
+        return time.time()
+    return time.time() - checkpoint.get("Elapsed time [s]", 0.0)
+
+
+
+def resumed_stage_readbacks(checkpoint, points_measured):
+    """
+    Stage readbacks and timestamps of the first points_measured points of the interrupted scan, NaN for
+    checkpoints saved without them.
+    """
+    arrays = []
+    for name in ("Stage readbacks", "Timestamps"):
+        if checkpoint is None or checkpoint.get(name) is None:
+            arrays.append(np.full(points_measured, np.nan))
+        else:
+            arrays.append(np.asarray(checkpoint[name][:points_measured], dtype=np.float64))
+    return tuple(arrays)
+
+
+
+def resumed_passes(policy, Running_average, checkpoint=None, start=None):
+    """
+    Passes of an acquisition policy (see acquisition_policy.py) as (scan, position indices, first point),
+    picking up where a checkpoint left off: the interrupted scan first, from its next unmeasured point,
+    then the policy from the scan after it. start is the experiment_start() the time budget counts from.
+    """
+    first_pass = 0
+    if checkpoint is not None:
+        first_pass = checkpoint["Current scan"]
+        if checkpoint["Points measured"] > 0:
+            position_indices = checkpoint["Position indices"]
+            yield first_pass, None if position_indices is None else np.asarray(position_indices, dtype=np.int64), checkpoint["Points measured"]
+            first_pass += 1
+
+    for offset, position_indices in enumerate(policy.passes(Running_average, first_pass=first_pass, start=start)):
+        yield first_pass + offset, position_indices, 0
+
+
+
+def clear_checkpoint(folder):
+    """
+    Removes the checkpoint once the experiment finished.
+    """
+    if os.path.isdir(folder):
+        shutil.rmtree(folder, ignore_errors=True)
@@ -3,10 +3,30 @@ import numpy as np
 import os
 import sys
 from ctypes import *
-import pandas as pd
 from datetime import datetime
 import json
 import core_logic_functions as clfun
+import noise_estimation
+import scan_store
+import scan_writer
+import experiment_container
+import adaptive_grid
+import scan_plan
+import checkpoint
+import time_zero_finder
+
+
+# Number of R samples grabbed at every point when error_measurement_type is "From R samples".
+# More samples give a better error bar but each one costs a query to the lockin
+noise_samples_per_point = 16
+
+# Seconds a single SNAP? of the R samples takes to come back, the answer is read as soon as its line
+# arrives so it's the serial round trip and not the timeout (see request_R_samples())
+snapshot_query_sec = 0.05
+
+# Seconds between checkpoints while a scan runs, they are also saved at the end of every scan and
+# when a scan is aborted or crashes (see checkpoint.py)
+checkpoint_every_s = 60
 
 
 # Dummy functios to test development on machines that are not connected to experiment devices
@@ -26,119 +46,290 @@ def perform_experiment_dummy(Troubleshooting):
 
 
 
-def average_scans(Completed_scans, new_data):
-    # We want to measure a live average, that is we need to update 
-    # each averaged point in a graph as new points come in, to do so
-    # we use this function which averages multiple lists and deals
-    # with problems where the last scan is incomplete and thus a smaller
-    # length, to do so it splits the averaging like so:
-    #  
-    # We slice completed scans by the len of the uncompleted scan
-    # [a_0, a_1| a_2, a_3, a_4, a_5]
-    # [b_0, b_1| b_2, b_3, b_4, b_5]
-    #
-    # Current scan taking place that is incomplete
-    # [c_0, c_1]
-    #
-    # average left slices: [a_0, a_1], [b_0, b_1], [c_0, c_1]
-    # average right slices: [a_2, a_3, a_4, a_5], [b_2, b_3, b_4, b_5]]
-    #
-    # We splice left and right averages into a final average
-    # [avg_0, avg_1, avg_2, avg_3, avg_4, avg_5]
+# --- Request Settling Time ---
+def request_settling_time(time_constant, filter_slope, verbose=False):
+    """
+    Queries the current filter slope setting and time constant 
+    to calculate the settling time to achieve 99.9% after a step response
+    according to table 1 in "Zurich Instruments – White Paper: Principles of 
+    lock-in detection and the state of the art".
+    """
+
+    # Keys in this dict correspond to filter roll-off and values are 
+    # the settling time in multiples of tau that one should wait to achieve
+    # 99.9% precision after a step change in signal on the lockin input
+    settling_time_tau_multiples = {"6":6.91, "12":9.23, "18":11.23, "24":13.06}
+
+    settling_time_seconds = time_constant * settling_time_tau_multiples[str(filter_slope)]
 
+    # Inform the user, use fomratting to write only 2 significant digits
+    if verbose:
+        print(f"Lockin has been configured to time constant {float('%2g'%time_constant)}s and filter roll-off {filter_slope}dB/oct")
+        print(f"This calls for a settling time of {float('%2g'%settling_time_seconds)}s to settle to 99.9% after a step response")
 
-    def average_equal_lists(scans_list):
+    return settling_time_seconds
 
-        try:
-            # Takes a list of equal sized lists and returns an 
-            # averaged list
 
-            # Cast lists to arrays for easier element wise addition
-            scans_array_list = []
-            for scan in scans_list:
-                scans_array_list.append(np.array(scan))
-            
-            # Average all scan arrays in list by summing them
-            averaged_scans = np.zeros_like(np.array(scans_array_list[0]))
-            for scan in scans_array_list:
-                averaged_scans += scan
-            
-            # And dividing by amount of arrays
-            averaged_scans = averaged_scans / len(scans_array_list)
-            
-            return averaged_scans.tolist()
-        
-        except ValueError:
-            print(f'An ERROR occured when adding something in the following list:\n{scans_array_list}')
 
-            raise ValueError
+def request_sample_interval(time_constant, filter_slope):
+    """
+    Time between R samples for them to be roughly independent. The output filter gives its noise a
+    correlation time of 1/(2*ENBW), samples read closer than that repeat each other and their spread
+    says nothing about the error bar (see noise_estimation.py).
+    """
 
-    # Append new data to completed scans
-    Scans_ls = Completed_scans.copy()
-    Scans_ls.append(new_data)
+    # Keys in this dict correspond to filter roll-off and values are the equivalent
+    # noise bandwidth of the output filter in multiples of 1/tau
+    noise_bandwidth_tau_multiples = {"6":1/4, "12":1/8, "18":3/32, "24":5/64}
 
-    # Deal with edge case where there are not enough scans to average
-    if len(Scans_ls) > 1:
+    return time_constant / (2 * noise_bandwidth_tau_multiples[str(filter_slope)])
 
-        # Find whether our averaging needs to deal with incompleted scans
-        # by checkin whether the last scan is smaller than the previous one  
-        if len(Scans_ls[-1]) == len(Scans_ls[-2]):
-            return average_equal_lists(Scans_ls)
 
-        else:
 
-            # Compile list of scans sliced to match the length of the 
-            # uncompleted scan
-            left_slices_list = []
-            for scan in Scans_ls[:-1]:
-                left_slices_list.append(scan[:len(Scans_ls[-1])])
-            
-            # Include uncomplete scan
-            left_slices_list.append(Scans_ls[-1])
-            
-            # Compile a second list of the "leftover" right slices
-            right_slices_list = []
-            for scan in Scans_ls[:-1]:
-                right_slices_list.append(scan[len(Scans_ls[-1]):])
-            
-            # Average each of the groups, now with matching length
-            left_average = average_equal_lists(left_slices_list)
-            right_average = average_equal_lists(right_slices_list)
+def estimate_experiment_duration(parameters_dict, plan=None):
+    """
+    Rough duration of an experiment in seconds, from the time moving the stage, settling the filter
+    and querying the lockin take at every point on the lab setup.
 
-            # Combine them into a final average
-            return left_average + right_average
+    Parameters:
+        parameters_dict: dict - Experiment parameters, as given to perform_experiment().
+        plan: ScanPlan or None - Positions of the experiment, compiled from the trip legs if not given.
 
-    # This return signals that there is no average to plot for only
-    # one scan
+    Returns:
+        float
+    """
+    if plan is None:
+        plan = scan_plan.compile_plan(parameters_dict["trip_legs"])
+    num_scans = int(parameters_dict["num_scans"])
+    error_measurement_type = parameters_dict["error_measurement_type"]
+    autoranging_type = parameters_dict["autoranging_type"]
+    settling_time = request_settling_time(float(parameters_dict["time_constant"]), filter_slope=int(parameters_dict["roll_off"]), verbose=False)
+
+    ### Calculate time spent on each step
+    average_step_duration_sec = 2.2 + settling_time # Moving + settling time
+
+    # Capturing data. The R samples replace the single R query, every one of them is a query of its own
+    # and they are spread out so they don't repeat each other (with long time constants that's the longest part)
+    if error_measurement_type == "From R samples":
+        sample_interval = request_sample_interval(float(parameters_dict["time_constant"]), filter_slope=int(parameters_dict["roll_off"]))
+        average_step_duration_sec += noise_samples_per_point * snapshot_query_sec + (noise_samples_per_point - 1) * sample_interval
     else:
-        return None
+        average_step_duration_sec += 1.1
 
+    # Add up time to every step depending on step configuration
+    if error_measurement_type == "At every point":
+        average_step_duration_sec += 2.2
 
+    if autoranging_type == "At every point":
+        # Autoscale
+        average_step_duration_sec += 1.2
 
+        # Autorange
+        average_step_duration_sec += 0.1
 
+    ### Accumulate for all the points of the scan plan, repeated positions of overlapping legs are only counted once
+    estimated_duration = int(average_step_duration_sec * len(plan))
 
-# --- Request Settling Time ---
-def request_settling_time(time_constant, filter_slope, verbose=False):
+    # Finally multiply times the amount of scans selected, in adaptive mode the scans after
+    # the pilot measure the point budget instead if there is one
+    adaptive_point_budget = int(parameters_dict.get("adaptive_point_budget", 0))
+    if parameters_dict.get("scan_mode", "Uniform") == "Adaptive" and adaptive_point_budget > 0:
+        estimated_duration = estimated_duration + int(average_step_duration_sec * adaptive_point_budget) * (num_scans - 1)
+    else:
+        estimated_duration = estimated_duration * num_scans
+
+    # In target relative error mode num_scans is only the most we take, the time budget stops
+    # new scans from starting so we end at most one scan after it runs out
+    time_budget_sec = 60 * float(parameters_dict.get("time_budget_min", 0))
+    if parameters_dict.get("acquisition_mode", "Fixed number of scans") == "Target relative error" and time_budget_sec > 0:
+        estimated_duration = min(estimated_duration, int(time_budget_sec + estimated_duration / max(num_scans, 1)))
+
+    # Add up one final time at the end when the user asks to only measure errors once
+    if error_measurement_type == "Once at the start":
+        estimated_duration += 2.2
+
+    if autoranging_type == "Once at time zero":
+
+        # Autoscale
+        estimated_duration += 1.2
+
+        # Autorange
+        estimated_duration += 0.1
+
+    return estimated_duration
+
+
+
+def current_delay_ps():
     """
-    Queries the current filter slope setting and time constant 
-    to calculate the settling time to achieve 99.9% after a step response
-    according to table 1 in "Zurich Instruments – White Paper: Principles of 
-    lock-in detection and the state of the art".
+    Absolute delay the stage is at in ps, devices must be initialized.
     """
+    return clfun.request_position(lib, serial_num, channel)
 
-    # Keys in this dict correspond to filter roll-off and values are 
-    # the settling time in multiples of tau that one should wait to achieve
-    # 99.9% precision after a step change in signal on the lockin input
-    settling_time_tau_multiples = {"6":6.91, "12":9.23, "18":11.23, "24":13.06}
 
-    settling_time_seconds = time_constant * settling_time_tau_multiples[str(filter_slope)]
+def delay_stage_error_ps():
+    # To find the positional error we'll need to convert position error from mm to ps
+    # According to the datasheet for the ODL600M delay stage used in this experiment the "absolute on 
+    # axis error" is +/-12um, this is a lower limit for the actual error I would expect
+    # since error (the way I understand it) accumulates for larger distances. Oh well... ThorLabs you
+    # did it again you sly dog
+    light_speed_vacuum = 299792458 # m/s
+    refraction_index_air = 1.0003
+    mm_to_ps = (refraction_index_air * (1E9)) / light_speed_vacuum
+    return 12E-3 * mm_to_ps
 
-    # Inform the user, use fomratting to write only 2 significant digits
-    if verbose:
-        print(f"Lockin has been configured to time constant {float('%2g'%time_constant)}s and filter roll-off {filter_slope}dB/oct")
-        print(f"This calls for a settling time of {float('%2g'%settling_time_seconds)}s to settle to 99.9% after a step response")
 
-    return settling_time_seconds
+
+def build_scan_dataframe(Positions, Position_errors, Photodiode_data, Photodiode_data_errors, live_average, error_measurement_type, signal_type_str, sample_counts=None):
+    """
+    Builds the DataFrame we save as CSV for every scan. Columns depend on how errors were measured
+    and on whether there's an average of previous scans to store. The arrays are used as they are,
+    without copying them. Sample counts (samples averaged at every point) go in a last column if given.
+    """
+    # pandas is only needed here, importing it lazily keeps it out of the launcher's startup
+    import pandas as pd
+
+
+    # So sorry for this hack but it's my last day working here and it's 7pm
+    if live_average is not None:
+        if error_measurement_type in ("At every point", "From R samples"):
+            data_df = pd.DataFrame({
+                "Absolute Time [ps]": Positions,
+                "Time absolute On-axis error [+/-ps] (placeholder data)": Position_errors,
+                "Signal level st current scan" + signal_type_str: Photodiode_data,
+                "Signal error " + signal_type_str: Photodiode_data_errors,
+                "Average of previous scans" + signal_type_str: live_average
+            }, copy=False)
+        
+        if error_measurement_type == "Once at the start":
+            data_df = pd.DataFrame({
+                "Absolute Time [ps]": Positions,
+                "Time absolute On-axis error [+/-ps] (placeholder data)": Position_errors,
+                "Signal level " + signal_type_str: Photodiode_data,
+                "Signal error (at the start)" + signal_type_str: Photodiode_data_errors,
+                "Average of previous scans" + signal_type_str: live_average
+            }, copy=False)
+        
+        elif error_measurement_type == "Never":
+            data_df = pd.DataFrame({
+                "Absolute Time [ps]": Positions,
+                "Time absolute On-axis error [+/-ps] (placeholder data)": Position_errors,
+                "Signal level " + signal_type_str: Photodiode_data,
+                "Average of previous scans" + signal_type_str: live_average
+            }, copy=False)
+
+    else:
+        if error_measurement_type in ("At every point", "From R samples"):
+            data_df = pd.DataFrame({
+                "Absolute Time [ps]": Positions,
+                "Time absolute On-axis error [+/-ps] (placeholder data)": Position_errors,
+                "Signal level st current scan" + signal_type_str: Photodiode_data,
+                "Signal error " + signal_type_str: Photodiode_data_errors,
+            }, copy=False)
+        
+        if error_measurement_type == "Once at the start":
+            data_df = pd.DataFrame({
+                "Absolute Time [ps]": Positions,
+                "Time absolute On-axis error [+/-ps] (placeholder data)": Position_errors,
+                "Signal level " + signal_type_str: Photodiode_data,
+                "Signal error (at the start)" + signal_type_str: Photodiode_data_errors
+            }, copy=False)
+        
+        elif error_measurement_type == "Never":
+            data_df = pd.DataFrame({
+                "Absolute Time [ps]": Positions,
+                "Time absolute On-axis error [+/-ps] (placeholder data)": Position_errors,
+                "Signal level " + signal_type_str: Photodiode_data,
+            }, copy=False)
+
+    if sample_counts is not None:
+        data_df["Samples averaged"] = sample_counts
+
+    return data_df
+
+
+
+def adaptive_positions(parameters_dict, scan, Scan_store, Running_average, resuming=False):
+    """
+    Positions for scan number scan (> 0) in adaptive scan mode. Scan 1 refines the grid from the pilot
+    scan stored in row 0 of the scan store, later scans reuse the positions of scan 1, and so does
+    scan 1 itself when it's resumed from a checkpoint.
+    """
+    if scan > 1 or resuming:
+        refined_positions = Scan_store.positions[1]
+        return list(refined_positions[~np.isnan(refined_positions)])
+
+    pilot_positions = Scan_store.positions[0]
+    pilot_data = Scan_store.data[0]
+    measured = ~np.isnan(pilot_positions) & ~np.isnan(pilot_data)
+
+    # A budget of 0 keeps the number of points of the pilot
+    point_budget = int(parameters_dict.get("adaptive_point_budget", 0))
+    if point_budget <= 0:
+        point_budget = int(np.count_nonzero(measured))
+
+    refined_positions = adaptive_grid.refine_grid(pilot_positions[measured], pilot_data[measured],
+                                                  num_points=point_budget, errors=Scan_store.errors[0][measured])
+    steps = np.diff(refined_positions)
+    print(f"Adaptive scan: refined the grid from {np.count_nonzero(measured)} pilot points to {len(refined_positions)} points")
+    if len(steps) > 0:
+        print(f"    ·Steps now go from {round(float(np.min(steps)), 4)}ps to {round(float(np.max(steps)), 4)}ps\n")
+
+    # The average so far was taken on the pilot grid, positions don't line up anymore so start over
+    Running_average.reset()
+
+    return list(refined_positions)
+
+
+
+def search_time_zero(search_start_ps, search_end_ps, coarse_step_ps, mode="Edge", time_constant=1e-6, roll_off=6):
+    """
+    Looks for time zero on the real devices (see time_zero_finder.py), the coarse sweep uses a time
+    constant ten times shorter than time_constant and the refinement time_constant itself. Devices must
+    be initialized. The lockin is left at time_constant.
+
+    Returns:
+        dict: See time_zero_finder.find_time_zero().
+    """
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    with open(os.path.join(current_dir, "Utils", "validation_rules.json"), "r") as json_file:
+        validation_rules = json.load(json_file)
+
+    # Clip the window before anything moves, the stage goes to search_end_ps right away to range the lockin
+    limits = time_zero_finder.search_limits(validation_rules)
+    search_start_ps, search_end_ps = time_zero_finder.clip_search_window(search_start_ps, search_end_ps, limits)
+
+    def configure(stage_time_constant, delay_ps):
+        # Range the lockin where the search is at, the signal level of the sweep is unknown beforehand
+        clfun.set_time_constant(adapter, stage_time_constant)
+        clfun.set_filter_slope(adapter, roll_off)
+        clfun.move_to_position(lib, serial_num, channel, delay_ps=delay_ps)
+        clfun.set_sensitivity(adapter, clfun.find_next_sensitivity(adapter))
+        clfun.autorange(adapter)
+        return request_settling_time(stage_time_constant, filter_slope=roll_off, verbose=True)
+
+    def measure(delay_ps, settling_time):
+        clfun.move_to_position(lib, serial_num, channel, delay_ps=delay_ps)
+        time.sleep(settling_time)
+        return clfun.request_R(adapter)
+
+    coarse_settling_time = configure(time_zero_finder.coarse_time_constant(time_constant), search_end_ps)
+
+    # The lockin switches to the experiment's time constant when the refinement starts
+    fine_settling_time = None
+    def measure_fine(delay_ps):
+        nonlocal fine_settling_time
+        if fine_settling_time is None:
+            fine_settling_time = configure(time_constant, delay_ps)
+        return measure(delay_ps, fine_settling_time)
+
+    try:
+        return time_zero_finder.find_time_zero(lambda delay_ps: measure(delay_ps, coarse_settling_time), measure_fine,
+                                               search_start_ps, search_end_ps, coarse_step_ps, mode=mode,
+                                               limits=limits)
+    finally:
+        clfun.set_time_constant(adapter, time_constant)
+
 
 
 ####################################### MAIN CODE #######################################
@@ -404,10 +595,14 @@ def initialization(Troubleshooting):
 
     
     
-def perform_experiment(parameters_dict, experiment_data_queue, abort_queue, fig, scan, num_scans, error_measurement_type, autoranging_type, Scans):
+def perform_experiment(parameters_dict, experiment_data_queue, abort_queue, snapshot_renderer, scan, num_scans, error_measurement_type, autoranging_type, Scan_store, Running_average, position_indices=None, plan=None, start_index=0, resume_checkpoint=None, experiment_start=None):
 
     global adapter
 
+    # Checkpoints save how long the experiment has run, a resumed one counts from checkpoint.experiment_start()
+    if experiment_start is None:
+        experiment_start = time.time()
+
     print("------------------------------------------")
     print(f"Scan number {scan}/{num_scans}")
 
@@ -427,64 +622,118 @@ def perform_experiment(parameters_dict, experiment_data_queue, abort_queue, fig,
     clfun.set_filter_slope(adapter, roll_off)
 
     settling_time = request_settling_time(time_constant, filter_slope=roll_off, verbose=True)
+    sample_interval = request_sample_interval(time_constant, filter_slope=roll_off)
 
 
 
     ########################### Build scan positions list ###########################
 
-    # Create a list of positions where the delay stage will move through
-    Positions = []
-
-    # Add values to the list for every leg
-    for leg_number, leg_parameters in parameters_dict["trip_legs"].items():
-
-        # Extract scan parameters for each leg
-        start_position = leg_parameters["abs time start [ps]"]
-        end_position = leg_parameters["abs time end [ps]"]
-        step_size = leg_parameters["step [ps]"]
+    # The positions come from the scan plan compiled from the trip legs (see scan_plan.py). The launcher
+    # compiles it once for the whole experiment, when called on its own we compile it here
+    if plan is None:
+        plan = scan_plan.compile_plan(parameters_dict["trip_legs"])
+    Positions = plan.positions
+    if scan == 0:
+        print(f"Scan plan: {plan.summary()}\n")
+
+
+    # In adaptive mode the first scan is a coarse pilot over the trip legs and every later scan uses
+    # a grid refined where the pilot curves (see adaptive_grid.py)
+    if parameters_dict.get("scan_mode", "Uniform") == "Adaptive" and scan > 0:
+        Positions = adaptive_positions(parameters_dict, scan, Scan_store, Running_average, resuming=start_index > 0)
+
+    # Passes of the "Target relative error" acquisition mode only revisit some of the positions
+    # (see acquisition_policy.py). Grid_indices maps the points of this scan to the whole grid,
+    # which is what the running average is indexed by
+    Grid_positions = np.array(Positions, dtype=np.float64)
+    if position_indices is None:
+        Grid_indices = np.arange(len(Grid_positions))
+    else:
+        Grid_indices = np.asarray(position_indices, dtype=np.int64)
+        Positions = list(Grid_positions[Grid_indices])
+        print(f"    ·Measuring {len(Positions)} out of {len(Grid_positions)} positions in this pass\n")
+
+    delay_stage_error = delay_stage_error_ps()
+
+    # The running average is shared between scans, make room for every position of the grid
+    Running_average.reserve(len(Grid_positions))
+
+    # The captured data and error values are written straight into this scan's row of the scan store
+    # shared with the GUI (see scan_store.py), room for every scan is made up front so the rows never move,
+    # adaptive scans included.
+    # The record keeps the rest of the scan (see scan_record.py), the profiling timings are stored on it as well
+    # A scan resumed from a checkpoint already has its first start_index points in the store row
+    # (see checkpoint.py), they are put back in the record after it resets the row. The stage readbacks
+    # and timestamps aren't in the store, they come from the checkpoint itself
+    Scan_store.reserve(*scan_store.experiment_shape(parameters_dict, len(plan)))
+    resumed_data = Scan_store.data[scan, :start_index].copy()
+    resumed_errors = Scan_store.errors[scan, :start_index].copy()
+    record = Scan_store.record(scan, Positions, position_error=delay_stage_error)
+    if start_index > 0:
+        record.resume(resumed_data, resumed_errors, *checkpoint.resumed_stage_readbacks(resume_checkpoint, start_index))
+        print(f"    ·Resuming the scan at step {start_index + 1} of {len(Positions)}\n")
 
-        Position_within_limtis = True
+    # Create a folder to store data into
 
-        # Edge case: First position is computed outside the loop
-        new_position = start_position
+    # Get the directory of the current script
+    current_dir = os.path.dirname(os.path.abspath(__file__))
 
-        # Check that the new computed position is whithin stage travel limits
-        if (start_position <= new_position <= end_position):
-            Positions.append(new_position)
+    # Define the Output folder path
+    output_folder = os.path.join(current_dir, "Output")
 
-        # Following positions will be computed on the loop
-        while(Position_within_limtis):
+    # Create the Output folder if it doesn't exist
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+        print(f"Created folder: {output_folder}")
 
-            new_position = new_position + step_size
+    # Create a subfolder at Output to store the experiment data
+    experiment_name = parameters_dict["experiment_name"]
+    data_folder = os.path.join(output_folder, experiment_name)
+    data_folder = os.path.join(data_folder, str("scan_number_" + str(scan)))
+    
+    # Only create the data folder if it does not exist
+    if not os.path.exists(data_folder):
+        os.makedirs(data_folder)
 
-            # Check that the new computed position is whithin stage travel limits
-            if (start_position <= new_position <= end_position):
-                Positions.append(new_position)
-            
-            # If not within limits then we stop adding new steps
-            else:
-                Position_within_limtis = False
+    file_name = parameters_dict["experiment_name"]  + "_scan_number_" + str(scan) + ".csv"
+    file_path = os.path.join(data_folder, file_name)
 
-                # Add end position if not in list already
-                if (end_position not in Positions):
-                    Positions.append(end_position)
+    # Every point is written to disk as soon as it's measured, if the scan crashes or is
+    # aborted whatever was measured stays in the partial file (see scan_writer.py)
+    writer = scan_writer.StreamingScanWriter(file_path + ".partial")
+    for index in range(0, start_index):
+        writer.write_record_point(record, index)
+
+    # Optionally all scans also go into a single binary container for the whole experiment
+    # (see experiment_container.py), filled point by point as well. Adaptive scans may have more
+    # points than the pilot, the container makes room for the point budget from the start
+    container = None
+    if parameters_dict.get("binary_output", "Off") != "Off":
+        container = experiment_container.ExperimentContainer.open_or_create(
+                        experiment_container.container_path(os.path.join(output_folder, experiment_name), experiment_name),
+                        num_scans, max(len(Positions), int(parameters_dict.get("adaptive_point_budget", 0))), parameters_dict)
+
+    # Checkpoints to resume the experiment if it's interrupted, with the lockin settings the scan runs with
+    checkpoint_folder = checkpoint.checkpoint_folder(output_folder, experiment_name)
+    lockin_settings = {
+                        "Time constant [s]": clfun.request_time_constant(adapter),
+                        "Filter slope [dB/Oct]": clfun.request_filter_slope(adapter),
+                        "Input range": clfun.request_range(adapter).strip(),
+                      }
 
+    def save_checkpoint(next_scan, points_measured):
+        running = next_scan == scan
+        checkpoint.save_checkpoint(checkpoint_folder, parameters_dict, plan, Scan_store, next_scan, points_measured,
+                                   position_indices if running else None, lockin_settings, time.time() - experiment_start,
+                                   record.stage_readbacks if running else None, record.timestamps if running else None)
 
-    # We create empty lists to hold the captured data and error values
-    Photodiode_data = []
-    Photodiode_data_errors = []
-    Position_errors = []
+    save_checkpoint(scan, start_index)
+    last_checkpoint_timestamp = time.time()
 
     # Raise this flag if you want to profile how much each step in the scanning loop takes
     profiling = True
     if profiling:
-        moving = []
-        settling = []
-        autoscaling = []
-        autoranging = []
-        capturing = []
-        estimating = []
-        total = []
+        scan_start_peak_memory = scan_store.peak_memory_bytes()
 
     if error_measurement_type == "Once at the start":
                 print(f"    ·Measuring error only at the start\n")
@@ -497,152 +746,217 @@ def perform_experiment(parameters_dict, experiment_data_queue, abort_queue, fig,
                 clfun.set_sensitivity(adapter, clfun.find_next_sensitivity(adapter))
                 clfun.autorange(adapter)
 
+    # Let the GUI know a new scan starts. Positions and the average of the completed scans only
+    # travel once per scan, the packets sent at every point below just carry what changed.
+    # "Scan data" and "Scan errors" are views of the scan store rows we're filling, the GUI
+    # reads them instead of keeping a copy. The average covers the whole grid even when this pass
+    # only measures part of it, together with how many samples every position has so far
+    live_average = None
+    if scan > 0 and np.any(Running_average.count[:len(Grid_positions)] > 0):
+        live_average = Running_average.mean(len(Grid_positions)).copy()
+
+    scan_start_packet = {
+                        "Packet type": "Scan start",
+                        "Scan number": scan,
+                        "Positions": record.positions,
+                        "Scan data": record.data,
+                        "Scan errors": record.errors,
+                        "Average positions": Grid_positions,
+                        "Live average": live_average,
+                        "Sample counts": Running_average.count[:len(Grid_positions)].copy(),
+                      }
+    experiment_data_queue.put(scan_start_packet)
+
     ########################### Scan and Measure at list of positions ###########################
-    for index in range(0, len(Positions)):
+    try:
+        for index in range(start_index, len(Positions)):
         
-        # Evaluate whether the user has pressed the abort button on the GUI
-        try:
-            abort_experiment = abort_queue.get_nowait()
+            # Evaluate whether the user has pressed the abort button on the GUI
+            try:
+                abort_experiment = abort_queue.get_nowait()
         
-        # Throws an error when queue is empty
-        except Exception as e:
-            abort_experiment = False
+            # Throws an error when queue is empty
+            except Exception as e:
+                abort_experiment = False
         
-        if abort_experiment:
+            if abort_experiment:
+
+                # Keep what we measured so far on disk
+                writer.close()
+                if container is not None:
+                    container.flush()
+                save_checkpoint(scan, record.cursor)
+                print(f"Scan aborted, measured points were kept at {writer.file_path}")
             
-            # Return an error code to let experiment_thread_logic() there is no data to store
-            # and we should close the GUI
-            return 1
+                # Return an error code to let experiment_thread_logic() there is no data to store
+                # and we should close the GUI
+                return 1
         
-        # Register the timestamp when the iteration starts
-        if profiling:
-            startup_timestamp = time.time()
+            # Register the timestamp when the iteration starts
+            if profiling:
+                startup_timestamp = time.time()
 
-        print(f"Measurement at step: {index+1} of {len(Positions)}")
+            print(f"Measurement at step: {index+1} of {len(Positions)}")
         
         
-        ### Moving stage
-        position_ps = clfun.move_to_position(lib, serial_num, channel, delay_ps=Positions[index] + time_zero)
-        print(f"    ·Delay set to {round(position_ps - time_zero, 2)}ps")
+            ### Moving stage
+            position_ps = clfun.move_to_position(lib, serial_num, channel, delay_ps=Positions[index] + time_zero)
+            print(f"    ·Delay set to {round(position_ps - time_zero, 2)}ps")
 
-        # For every function ran in the loop we store how much time it takes to run it
-        if profiling:
-            moved_timestamp = time.time()
-            moving.append(moved_timestamp - startup_timestamp)
-
-
-        ### Awaiting for filter settling
-        print(f"    ·Awaiting {settling_time}s for filter settling")
-        time.sleep(settling_time)
-        if profiling:
-            settled_timestamp = time.time()
-            settling.append(settled_timestamp - moved_timestamp)
+            # For every function ran in the loop we store how much time it takes to run it
+            if profiling:
+                moved_timestamp = time.time()
+                record.record_timing(index, "Moving", moved_timestamp - startup_timestamp)
 
 
-        ### Capturing data
-        print(f"    ·Capturing data")
-        if autoranging_type == "At every point":
-            clfun.set_sensitivity(adapter, clfun.find_next_sensitivity(adapter))
+            ### Awaiting for filter settling
+            print(f"    ·Awaiting {settling_time}s for filter settling")
+            time.sleep(settling_time)
             if profiling:
-                autoscaled_timestamp = time.time()
-                autoscaling.append(autoscaled_timestamp - settled_timestamp)
+                settled_timestamp = time.time()
+                record.record_timing(index, "Settling", settled_timestamp - moved_timestamp)
 
-            clfun.autorange(adapter)
-            if profiling:
-                autoranged_timestamp = time.time()
-                autoranging.append(autoranged_timestamp - autoscaled_timestamp)
-    
-            if profiling:
-                data_captured_timestamp = time.time()
-                capturing.append(data_captured_timestamp - autoranged_timestamp)
 
-        Photodiode_data.append(clfun.request_R(adapter))
+            ### Capturing data
+            print(f"    ·Capturing data")
+            if autoranging_type == "At every point":
+                clfun.set_sensitivity(adapter, clfun.find_next_sensitivity(adapter))
+                if profiling:
+                    autoscaled_timestamp = time.time()
+                    record.record_timing(index, "Autoscaling", autoscaled_timestamp - settled_timestamp)
 
+                clfun.autorange(adapter)
+                if profiling:
+                    autoranged_timestamp = time.time()
+                    record.record_timing(index, "Autoranging", autoranged_timestamp - autoscaled_timestamp)
+
+            # When estimating errors from samples the burst replaces the single R query,
+            # the mean of the burst is the data point and its spread gives the error bar
+            if error_measurement_type == "From R samples":
+                R_samples = np.array(clfun.request_R_samples(adapter, noise_samples_per_point, interval=sample_interval))[:, 2]
+                Photodiode_datum = float(np.mean(R_samples))
+            else:
+                Photodiode_datum = clfun.request_R(adapter)
 
-        ### Measuring errors
-        if error_measurement_type == "At every point":
-            print(f"    ·Measuring error\n")
-            Photodiode_data_errors.append(clfun.request_R_noise(adapter))
+            # The capture timestamp is needed by the error estimation profiling below even when we don't autorange
             if profiling:
-                error_estimated_timestamp = time.time()
-                estimating.append(error_estimated_timestamp - data_captured_timestamp)
+                data_captured_timestamp = time.time()
+                if autoranging_type == "At every point":
+                    record.record_timing(index, "Capturing", data_captured_timestamp - autoranged_timestamp)
+
+
+            ### Measuring errors
+            Photodiode_datum_error = np.nan
+            if error_measurement_type == "At every point":
+                print(f"    ·Measuring error\n")
+                Photodiode_datum_error = clfun.request_R_noise(adapter)
+                if profiling:
+                    error_estimated_timestamp = time.time()
+                    record.record_timing(index, "Estimating", error_estimated_timestamp - data_captured_timestamp)
         
-        elif error_measurement_type == "Once at the start":
-                Photodiode_data_errors.append(Photodiode_data_error)
+            elif error_measurement_type == "Once at the start":
+                    Photodiode_datum_error = Photodiode_data_error
+
+            elif error_measurement_type == "From R samples":
+                Photodiode_datum_error = float(noise_estimation.autocorrelation_corrected_error(R_samples))
+
+            # Data and error are stored together once both are known, that way the views
+            # we hand out below always have matching lengths
+            record.append(Photodiode_datum, Photodiode_datum_error, stage_readback=position_ps - time_zero, timestamp=time.time())
+            writer.write_record_point(record, index)
+            if container is not None:
+                container.write_record_point(record, index)
         
 
-        ### Rounding up total elapsed time
-        if profiling:
-            total_timestamp = time.time() - startup_timestamp
-            total.append(total_timestamp)
-
-        # After every data point acquisition we calculate the live average 
-        # (do so only if there is something to average)
-        live_average = None
-        if scan > 0:
-            live_average = average_scans(Completed_scans=Scans, new_data=Photodiode_data)
-
-        # Send data through queue to the GUI script to draw it. Do it with copies or else
-        # we'll pass references to the local lists "Photodiode_data" and the GUI will
-        # be able to access them and attempt to draw from them, this leads to an error
-        # where the error bar has not been calculated but the photodiode data has been
-        # acquired leading to an incorrect size error when plotting.
-        # Passing the scan number will allow perform_experiment() to signal monitor_experiment()
-        # That a new curve needs to be drawn
-        data_packet = {
-                        "Photodiode data": Photodiode_data.copy(), 
-                        "Photodiode data errors": Photodiode_data_errors.copy(),
-                        "Positions": Positions.copy(),
-                        "Scan number": scan,
-                        "Live average": live_average,
-                      }
-        experiment_data_queue.put(data_packet)
+            ### Rounding up total elapsed time
+            if profiling:
+                total_timestamp = time.time() - startup_timestamp
+                record.record_timing(index, "Total", total_timestamp)
+                record.record_peak_memory(index, scan_store.peak_memory_bytes())
+
+            # After every data point acquisition we update the live average, only the
+            # new point is added so this doesn't get slower as scans pile up.
+            # Adding a point only changes the average at that same position
+            # (send it only if there is something to average)
+            grid_index = int(Grid_indices[index])
+            Running_average.update(grid_index, Photodiode_datum, Photodiode_datum_error)
+            average_at_index = None
+            if scan > 0:
+                average_at_index = float(Running_average.mean()[grid_index])
+
+            # Send the new point through the queue to the GUI script to draw it. The GUI keeps its own
+            # arrays for the current scan (filled from the scan start packet) so we only send what
+            # changed: a handful of numbers instead of the whole scan at every point.
+            # The timestamp lets the GUI measure how far behind the experiment it's drawing
+            data_packet = {
+                            "Packet type": "Point",
+                            "Scan number": scan,
+                            "Index": index,
+                            "Photodiode data": Photodiode_datum,
+                            "Photodiode data error": Photodiode_datum_error,
+                            "Average index": grid_index,
+                            "Live average": average_at_index,
+                            "Sample count": int(Running_average.count[grid_index]),
+                            "Timestamp": time.time(),
+                          }
+            experiment_data_queue.put(data_packet)
+
+            if time.time() - last_checkpoint_timestamp >= checkpoint_every_s:
+                save_checkpoint(scan, record.cursor)
+                last_checkpoint_timestamp = time.time()
+
+    # Make sure whatever was measured reaches the disk before the exception travels up
+    except Exception:
+        writer.close()
+        if container is not None:
+            container.flush()
+        save_checkpoint(scan, record.cursor)
+        raise
 
     print(f"Experiment is finished\n")
 
     # Report to user the average percentage of total iteration time spent on each function
     if profiling:
+        average_total = record.mean_timing("Total")
         print(f"The average time and percentage spent on each step for every action taken was:")
-        print(f'    ·Moving stage : {round((sum(moving)/len(moving)), 1)}s and {round( 100 * (sum(moving)/len(moving)) / (sum(total)/len(total)), 1)}% of total\n')
-        print(f'    ·Settling filter : {round((sum(settling)/len(settling)), 1)}s and {round( 100 * (sum(settling)/len(settling)) / (sum(total)/len(total)), 1)}%\n')
+        print(f'    ·Moving stage : {round(record.mean_timing("Moving"), 1)}s and {round( 100 * record.mean_timing("Moving") / average_total, 1)}% of total\n')
+        print(f'    ·Settling filter : {round(record.mean_timing("Settling"), 1)}s and {round( 100 * record.mean_timing("Settling") / average_total, 1)}%\n')
     
         if error_measurement_type == "At every point":
-            print(f'    ·Estimating error from lockin : {round((sum(estimating)/len(estimating)), 1)}s and {round( 100 * (sum(estimating)/len(estimating)) / (sum(total)/len(total)), 1)}%\n')
+            print(f'    ·Estimating error from lockin : {round(record.mean_timing("Estimating"), 1)}s and {round( 100 * record.mean_timing("Estimating") / average_total, 1)}%\n')
 
         if autoranging_type == "At every point":
-            print(f'    ·Autoscaling lockin : {round((sum(autoscaling)/len(autoscaling)), 1)}s and {round( 100 * (sum(autoscaling)/len(autoscaling)) / (sum(total)/len(total)), 1)}%\n')
-            print(f'    ·Autoranging lockin : {round((sum(autoranging)/len(autoranging)), 1)}s and {round( 100 * (sum(autoranging)/len(autoranging)) / (sum(total)/len(total)), 1)}%\n')
-            print(f'    ·Capturing data : {round((sum(capturing)/len(capturing)), 1)}s and {round( 100 * (sum(capturing)/len(capturing)) / (sum(total)/len(total)), 1)}%\n')
-        
-    
-    # To find the positional error we'll need to convert position error from mm to ps
-    # According to the datasheet for the ODL600M delay stage used in this experiment the "absolute on 
-    # axis error" is +/-12um, this is a lower limit for the actual error I would expect
-    # since error (the way I understand it) accumulates for larger distances. Oh well... ThorLabs you
-    # did it again you sly dog
-    light_speed_vacuum = 299792458 # m/s
-    refraction_index_air = 1.0003
-    mm_to_ps = (refraction_index_air * (1E9)) / light_speed_vacuum
-    delay_stage_error = 12E-3 * mm_to_ps
-    for index in range(0, len(Positions)):
-        Position_errors.append(delay_stage_error)
+            print(f'    ·Autoscaling lockin : {round(record.mean_timing("Autoscaling"), 1)}s and {round( 100 * record.mean_timing("Autoscaling") / average_total, 1)}%\n')
+            print(f'    ·Autoranging lockin : {round(record.mean_timing("Autoranging"), 1)}s and {round( 100 * record.mean_timing("Autoranging") / average_total, 1)}%\n')
+            print(f'    ·Capturing data : {round(record.mean_timing("Capturing"), 1)}s and {round( 100 * record.mean_timing("Capturing") / average_total, 1)}%\n')
+
+        # Peak memory of the whole process (GUI included), it should stay flat from scan to scan
+        peak_memory = record.peak_memory[:record.cursor]
+        if len(peak_memory) > 0 and not np.all(np.isnan(peak_memory)):
+            point_growth = np.diff(peak_memory, prepend=scan_start_peak_memory)
+            print(f"The peak memory was {round(np.nanmax(peak_memory) / 1e6, 1)}MB at the end of the scan:")
+            print(f"    ·Grew {round(np.nansum(point_growth) / 1e6, 2)}MB during this scan and at most {round(np.nanmax(point_growth) / 1e6, 2)}MB in a single point\n")
+            store_kind = "memory mapped" if Scan_store.is_memory_mapped else "in RAM"
+            print(f"    ·Scan store holds {Scan_store.shape[0]} scans x {Scan_store.shape[1]} positions in {round(Scan_store.nbytes / 1e6, 2)}MB ({store_kind})\n")
+
+    # The export below reads views of the record, no copies (except for the average of a partial pass)
+    if scan > 0:
+        live_average = Running_average.mean(len(Grid_positions))
+        if position_indices is not None:
+            live_average = live_average[Grid_indices]
+
+    # Samples behind every point, only saved when they differ from point to point
+    sample_counts = None
+    if parameters_dict.get("acquisition_mode", "Fixed number of scans") != "Fixed number of scans":
+        sample_counts = Running_average.count[Grid_indices]
+    Positions = record.positions
+    Photodiode_data = record.measured_data
+    Photodiode_data_errors = record.measured_errors
+    Position_errors = record.position_errors
 
 
     ########################### Store and display data ###########################
     print("Saving Data")
-    # Create a folder to store data into
-
-    # Get the directory of the current script
-    current_dir = os.path.dirname(os.path.abspath(__file__))
-
-    # Define the Output folder path
-    output_folder = os.path.join(current_dir, "Output")
-
-    # Create the Output folder if it doesn't exist
-    if not os.path.exists(output_folder):
-        os.makedirs(output_folder)
-        print(f"Created folder: {output_folder}")
-
     print(f"Writting CSV file")
 
     # Note the type of measurement that we just took 
@@ -656,91 +970,46 @@ def perform_experiment(parameters_dict, experiment_data_queue, abort_queue, fig,
             signal_type_str = "[Arms]"
 
     # Create a DataFrame with headers
-    # So sorry for this hack but it's my last day working here and it's 7pm
-    if live_average is not None:
-        if error_measurement_type == "At every point":
-            data_df = pd.DataFrame({
-                "Absolute Time [ps]": Positions,
-                "Time absolute On-axis error [+/-ps] (placeholder data)": Position_errors,
-                "Signal level st current scan" + signal_type_str: Photodiode_data,
-                "Signal error " + signal_type_str: Photodiode_data_errors,
-            })
-        
-        if error_measurement_type == "Once at the start":
-            data_df = pd.DataFrame({
-                "Absolute Time [ps]": Positions,
-                "Time absolute On-axis error [+/-ps] (placeholder data)": Position_errors,
-                "Signal level " + signal_type_str: Photodiode_data,
-                "Signal error (at the start)" + signal_type_str: Photodiode_data_errors,
-                "Average of previous scans" + signal_type_str: live_average
-            })
-        
-        elif error_measurement_type == "Never":
-            data_df = pd.DataFrame({
-                "Absolute Time [ps]": Positions,
-                "Time absolute On-axis error [+/-ps] (placeholder data)": Position_errors,
-                "Signal level " + signal_type_str: Photodiode_data,
-                "Average of previous scans" + signal_type_str: live_average
-            })
-
-    else:
-        if error_measurement_type == "At every point":
-            data_df = pd.DataFrame({
-                "Absolute Time [ps]": Positions,
-                "Time absolute On-axis error [+/-ps] (placeholder data)": Position_errors,
-                "Signal level st current scan" + signal_type_str: Photodiode_data,
-                "Signal error " + signal_type_str: Photodiode_data_errors,
-            })
-        
-        if error_measurement_type == "Once at the start":
-            data_df = pd.DataFrame({
-                "Absolute Time [ps]": Positions,
-                "Time absolute On-axis error [+/-ps] (placeholder data)": Position_errors,
-                "Signal level " + signal_type_str: Photodiode_data,
-                "Signal error (at the start)" + signal_type_str: Photodiode_data_errors
-            })
-        
-        elif error_measurement_type == "Never":
-            data_df = pd.DataFrame({
-                "Absolute Time [ps]": Positions,
-                "Time absolute On-axis error [+/-ps] (placeholder data)": Position_errors,
-                "Signal level " + signal_type_str: Photodiode_data,
-            })
+    data_df = build_scan_dataframe(Positions, Position_errors, Photodiode_data, Photodiode_data_errors,
+                                   live_average, error_measurement_type, signal_type_str, sample_counts)
 
     # Get current date as a string
     date_string = datetime.now().strftime("%Hh_%Mmin_%dd_%mm_%Yy")
 
-    # Create a subfolder at Output to store the experiment data
-    experiment_name = parameters_dict["experiment_name"]
-    data_folder = os.path.join(output_folder, experiment_name)
-    data_folder = os.path.join(data_folder, str("scan_number_" + str(scan)))
-    
-    # Only create the data folder if it does not exist
-    if not os.path.exists(data_folder):
-        os.makedirs(data_folder)
-
-    file_name = parameters_dict["experiment_name"]  + "_scan_number_" + str(scan) + ".csv"
-    file_path = os.path.join(data_folder, file_name)
-
     # Create a string storing relevant experiment data
-    experiment_params = str(f"Date: {date_string},Experiment parameters\n  time zero: {time_zero}ps,time constant: {time_constant}s,Filter slope: {clfun.request_filter_slope(adapter)}dB/Oct,Input range: {clfun.request_range(adapter)}")
-
-    # Write the parameters and data to a CSV file
-
-    # Add the parameters as a comment line
-    with open(file_path, "w") as file:
-        file.write(f"# {experiment_params}\n")  
-
-    # Append the rest of the data to the csv
-    data_df.to_csv(file_path, index=False, mode="a", lineterminator="\n")
-
-    # Save live graph aswell
-    file_name = parameters_dict["experiment_name"] + "_scan_number_" + str(scan) + ".png"
-    file_path = os.path.join(data_folder, file_name)
-    fig.savefig(file_path, dpi=300)  # Save with high resolution
-
-    # Append completed scan to global list
-    Scans.append(Photodiode_data)
+    filter_slope = clfun.request_filter_slope(adapter)
+    input_range = clfun.request_range(adapter)
+    experiment_params = str(f"Date: {date_string},Experiment parameters\n  time zero: {time_zero}ps,time constant: {time_constant}s,Filter slope: {filter_slope}dB/Oct,Input range: {input_range}")
+
+    # Write the parameters as a comment line and the data to a CSV file, this replaces
+    # the partial file that was streamed while scanning
+    writer.finalize(file_path, experiment_params, data_df)
+
+    # The container keeps the header and lockin settings as metadata so the CSV can be regenerated from it
+    if container is not None:
+        container.finalize_scan(scan, experiment_params, {
+                                    "Time constant [s]": time_constant,
+                                    "Filter slope [dB/Oct]": filter_slope,
+                                    "Input range": input_range.strip(),
+                                    "Signal type": signal_type_str,
+                                    "Error measurement type": error_measurement_type,
+                                })
+
+    # Save an image of the scans so far aswell. The render worker takes copies of the data and renders
+    # them on its own figure, the acquisition doesn't wait for it (see snapshot_renderer.py)
+    if snapshot_renderer is not None:
+        average = None
+        if scan > 0:
+            average = Running_average.mean(len(Grid_positions))
+        sample_counts = None
+        if parameters_dict.get("acquisition_mode", "Fixed number of scans") != "Fixed number of scans":
+            sample_counts = Running_average.count[:len(Grid_positions)]
+        snapshot_renderer.submit_scan(os.path.join(data_folder, parameters_dict["experiment_name"] + "_scan_number_" + str(scan)),
+                                      scan, num_scans, Scan_store, Grid_positions, average, sample_counts)
+
+    # The scan's row in the store is complete, averaging and the GUI can treat it as a finished scan
+    Scan_store.complete_scan(scan)
+    save_checkpoint(scan + 1, 0)
 
     return data_df
 
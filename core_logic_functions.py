@@ -1,6 +1,5 @@
 import time
 from ctypes import *
-from pymeasure.adapters import SerialAdapter
 from math import sqrt, pow
 
 
@@ -113,18 +112,25 @@ def evaluate_status_bits(serial_num, channel, lib):
             print(f"{description_0}")  # Bit is not set
 
 
-def move_to_position(lib, serial_num, channel, delay_ps):
-    
-    # Convert position from picoseconds to real units [mm]
-    light_speed_vacuum = 299792458 # m/s
-    refraction_index_air = 1.0003
-    ps_to_mm = light_speed_vacuum / (refraction_index_air * (1E9))
-    distance_mm = delay_ps * ps_to_mm
+# Convert position from picoseconds to real units [mm]
+light_speed_vacuum = 299792458 # m/s
+refraction_index_air = 1.0003
+ps_to_mm = light_speed_vacuum / (refraction_index_air * (1E9))
+
 
+def delay_ps_to_stage_mm(delay_ps):
+    """
+    Stage position in mm for a delay in ps, works on single values and numpy arrays alike.
+    """
     # Since light moves back and forth through the delay stage 
     # the position the stage needs to travel to is only half the distance
     # of the desired optical path
-    position = distance_mm / 2
+    return delay_ps * ps_to_mm / 2
+
+
+def move_to_position(lib, serial_num, channel, delay_ps):
+
+    position = delay_ps_to_stage_mm(delay_ps)
 
     # Convert from real units to device units [steps]
     new_pos_real = c_double(position)  # in real units
@@ -180,6 +186,16 @@ def move_to_position(lib, serial_num, channel, delay_ps):
 
     ########################### Read final position ###########################
 
+    # Return achieved delay after displacement
+    return request_position(lib, serial_num, channel)
+
+
+
+def request_position(lib, serial_num, channel):
+    """
+    Delay the stage is at in ps, without moving it.
+    """
+
     # Ask the device to evaluate it's current position 
     # (both polling and this funciton will suppousedly prompt the device to evaluate it)
     result = lib.BMC_RequestPosition(serial_num, channel)
@@ -206,7 +222,7 @@ def move_to_position(lib, serial_num, channel, delay_ps):
     mm_to_ps = 1 / ps_to_mm
     #print(f'     Arrived at position: {round(real_pos.value * mm_to_ps, 2)}ps')
 
-    # Return achieved delay after displacement
+    # Light goes back and forth through the stage, the delay is twice the stage position
     return 2 * real_pos.value * mm_to_ps
 
 
@@ -245,8 +261,13 @@ def initialize_connection(port="COM5", baudrate=115200, timeout=1):
     Initializes the RS232 connection using PyMeasure's SerialAdapter.
     Returns the initialized adapter.
     """
+    # pymeasure is only needed once we connect, importing it here keeps it out of the launcher's startup
+    from pymeasure.adapters import SerialAdapter
+
     try:
-        adapter = SerialAdapter(port=port, baudrate=baudrate, timeout=timeout)
+        # The lockin ends every answer with a line feed, reads return as soon as it arrives instead
+        # of waiting for the timeout
+        adapter = SerialAdapter(port=port, baudrate=baudrate, timeout=timeout, read_termination="\n")
         adapter.connection.reset_input_buffer()
         print(f"    ·RS232 communication initialized successfully")
         return adapter
@@ -686,13 +707,53 @@ def request_R_noise(adapter):
         R_noise = sqrt( pow(X_noise, 2) + pow(Y_noise, 2) )
 
         return R_noise
-    
+
     except Exception as e:
         raise Exception(f"Error requesting R: {e}")
         return None
 
 
 
+# --- Request a burst of X, Y and R samples ---
+def request_R_samples(adapter, num_samples, interval=0.0):
+    """
+    Requests num_samples simultaneous snapshots of X, Y and R with SNAP? so that the error bar can be
+    estimated on our side (see noise_estimation.py) instead of querying X noise and Y noise.
+
+    Snapshots read back to back fall within one time constant and are nearly identical, so they are
+    spaced by interval (see request_sample_interval() in core_logic.py). Each answer is read as soon as
+    its line arrives (see read_termination in initialize_connection()), the wait between snapshots is
+    only the interval.
+
+    Parameters:
+        adapter: PyMeasure SerialAdapter object for communication.
+        num_samples: int - Number of snapshots in the burst.
+        interval: float - Seconds between snapshots, 0 reads them as fast as the lockin answers.
+
+    Returns:
+        list: num_samples tuples of floats (X, Y, R) in Vrms.
+    """
+    try:
+        command = "SNAP? 0, 1, 2\n"  # 0, 1 and 2 select X, Y and R
+        samples = []
+        for sample in range(0, num_samples):
+            if sample > 0 and interval > 0:
+                time.sleep(interval)
+            adapter.write(command)
+            response = adapter.read().strip()
+            if not response:
+                raise Exception(f"No answer to snapshot {sample + 1} of {num_samples}")
+            X, Y, R = (float(value) for value in response.split(","))
+            samples.append((X, Y, R))
+
+        return samples
+
+    except Exception as e:
+        raise Exception(f"Error requesting R samples: {e}")
+        return None
+
+
+
 # --- Request input signal type ---
 def request_signal_type(adapter):
     """
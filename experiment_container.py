@@ -0,0 +1,212 @@
+import os
+import json
+import numpy as np
+
+import scan_statistics
+import acquisition_policy
+
+
+# Binary container holding every scan of an experiment.
+#
+# The usual output is one folder per scan with a CSV and a PNG, so loading a 50 scan experiment for
+# analysis means parsing 50 text files. When enabled, perform_experiment() also fills this container:
+# a folder Output/<experiment>/<experiment>.experiment with one .npy file per dataset, each a
+# scans x positions float64 array, plus a metadata.json with the experiment parameters and the lockin
+# settings.
+#
+# The .npy files are opened as memory maps, so points are written straight into the file as they are
+# measured and readers (load_experiment()) can slice whatever scans or positions they need without
+# loading everything. Each scan is a contiguous row, which plays the role of a chunk. There's no
+# compression, the arrays are meant to be mapped, not unpacked.
+#
+# Layout:
+#   data.npy        scans x positions  signal level, NaN where not measured
+#   errors.npy      scans x positions  signal error
+#   positions.npy   scans x positions  scan positions relative to time zero [ps]
+#   readbacks.npy   scans x positions  where the stage reported it ended up [ps]
+#   timestamps.npy  scans x positions  seconds since the epoch
+#   metadata.json   parameters, lockin settings and the CSV header of every finished scan
+
+
+datasets = ("data", "errors", "positions", "readbacks", "timestamps")
+
+
+def container_path(experiment_folder, experiment_name):
+    return os.path.join(experiment_folder, experiment_name + ".experiment")
+
+
+
+class ExperimentContainer:
+    """
+    Memory mapped scans x positions datasets for one experiment, see module comment.
+
+    Use ExperimentContainer.open_or_create() rather than the constructor.
+    """
+
+    def __init__(self, path, arrays, metadata):
+        self.path = path
+        self.arrays = arrays
+        self.metadata = metadata
+        self._unflushed = 0
+
+
+    @classmethod
+    def open_or_create(cls, path, num_scans, num_positions, parameters=None):
+        """
+        Opens the container at path for writing, creating it for num_scans x num_positions if it
+        doesn't exist yet. NaN marks everything that hasn't been measured.
+        """
+        if os.path.exists(os.path.join(path, "metadata.json")):
+            container = cls.open(path, mode="r+")
+            if container.arrays["data"].shape[1] < num_positions:
+                raise ValueError(f"Experiment container {path} holds {container.arrays['data'].shape[1]} positions per scan but this scan has {num_positions}")
+            return container
+
+        os.makedirs(path, exist_ok=True)
+        arrays = {}
+        for name in datasets:
+            array = np.lib.format.open_memmap(os.path.join(path, name + ".npy"), mode="w+", dtype=np.float64, shape=(num_scans, num_positions))
+            array[:] = np.nan
+            arrays[name] = array
+
+        metadata = {
+            "Experiment parameters": parameters if parameters is not None else {},
+            "Lockin settings": {},
+            "Scan headers": {},
+            "Points per scan": [0] * num_scans,
+        }
+        container = cls(path, arrays, metadata)
+        container.flush()
+        return container
+
+
+    @classmethod
+    def open(cls, path, mode="r"):
+        """
+        Opens an existing container, mode "r" for readers and "r+" for writers.
+        """
+        with open(os.path.join(path, "metadata.json"), "r") as json_file:
+            metadata = json.load(json_file)
+
+        arrays = {}
+        for name in datasets:
+            arrays[name] = np.load(os.path.join(path, name + ".npy"), mmap_mode=mode)
+
+        return cls(path, arrays, metadata)
+
+
+    @property
+    def num_scans(self):
+        return self.arrays["data"].shape[0]
+
+
+    # --- Writing ---
+    def write_point(self, scan, index, position, value, error=np.nan, readback=np.nan, timestamp=np.nan, flush_every=10):
+        self.arrays["positions"][scan, index] = position
+        self.arrays["data"][scan, index] = value
+        self.arrays["errors"][scan, index] = error
+        self.arrays["readbacks"][scan, index] = readback
+        self.arrays["timestamps"][scan, index] = timestamp
+        self.metadata["Points per scan"][scan] = max(self.metadata["Points per scan"][scan], index + 1)
+
+        self._unflushed += 1
+        if self._unflushed >= flush_every:
+            self.flush()
+
+
+    def write_record_point(self, record, index):
+        """
+        Copies point index of a ScanRecord (see scan_record.py) into the container.
+        """
+        self.write_point(record.scan_number, index, record.positions[index], record.data[index], record.errors[index],
+                         record.stage_readbacks[index], record.timestamps[index])
+
+
+    def finalize_scan(self, scan, header_comment, lockin_settings=None):
+        """
+        Stores the CSV header comment of a finished scan and the lockin settings it was measured with.
+        """
+        self.metadata["Scan headers"][str(scan)] = header_comment
+        if lockin_settings is not None:
+            self.metadata["Lockin settings"][str(scan)] = lockin_settings
+        self.flush()
+
+
+    def flush(self):
+        for array in self.arrays.values():
+            if isinstance(array, np.memmap) and array.mode != "r":
+                array.flush()
+
+        # Write the metadata next to the old one and swap them, a crash never leaves it half written
+        metadata_path = os.path.join(self.path, "metadata.json")
+        with open(metadata_path + ".tmp", "w") as json_file:
+            json.dump(self.metadata, json_file, indent=4, default=str)
+        os.replace(metadata_path + ".tmp", metadata_path)
+        self._unflushed = 0
+
+
+    # --- Reading ---
+    def scan(self, scan):
+        """
+        Views of the measured part of a scan: dict of dataset name to 1D array.
+        """
+        num_points = self.metadata["Points per scan"][scan]
+        return {name: array[scan, :num_points] for name, array in self.arrays.items()}
+
+
+    def export_csv(self, scan, csv_path, error_measurement_type="Never", signal_type_str="[Vrms]"):
+        """
+        Writes a scan in the same CSV layout perform_experiment() writes, including the average of the
+        scans up to it, so CSVs can be regenerated from the container on demand.
+        """
+        # Imported here, readers that only need the arrays shouldn't pay for pandas and the lockin code
+        import core_logic
+
+        scan_data = self.scan(scan)
+        num_points = len(scan_data["data"])
+
+        # Average the scans up to this one with the estimator the experiment used (see scan_statistics.py)
+        live_average = None
+        if scan > 0:
+            estimator_name = self.metadata["Experiment parameters"].get("averaging_estimator", "Mean")
+            estimator = scan_statistics.create_estimator(estimator_name, num_points)
+            for previous_scan in range(0, scan + 1):
+                measured = self.metadata["Points per scan"][previous_scan]
+
+                previous_positions = self.arrays["positions"][previous_scan, :measured]
+                previous_data = self.arrays["data"][previous_scan, :measured]
+                previous_errors = self.arrays["errors"][previous_scan, :measured]
+                if measured <= num_points and np.allclose(previous_positions, scan_data["positions"][:measured]):
+                    estimator.update_scan(previous_data, previous_errors)
+                    continue
+
+                # Passes of the target relative error mode measure part of the grid, their points go
+                # where their positions match (see acquisition_policy.py). The pilot of an adaptive
+                # experiment was measured on another grid and is left out (see adaptive_grid.py)
+                indices = acquisition_policy.grid_indices(scan_data["positions"], previous_positions)
+                on_grid = indices >= 0
+                partial_pass = np.all(on_grid) or np.all(acquisition_policy.grid_indices(previous_positions, scan_data["positions"]) >= 0)
+                if not partial_pass:
+                    continue
+                for grid_index, value, error in zip(indices[on_grid], previous_data[on_grid], previous_errors[on_grid]):
+                    estimator.update(grid_index, value, error)
+            live_average = estimator.mean(num_points)
+
+        # Same placeholder on axis error perform_experiment() writes
+        position_errors = np.full(num_points, core_logic.delay_stage_error_ps())
+
+        data_df = core_logic.build_scan_dataframe(scan_data["positions"], position_errors, scan_data["data"],
+                                                  scan_data["errors"], live_average, error_measurement_type, signal_type_str)
+
+        with open(csv_path, "w") as file:
+            file.write(f"# {self.metadata['Scan headers'].get(str(scan), '')}\n")
+            data_df.to_csv(file, index=False, lineterminator="\n")
+
+
+
+def load_experiment(path):
+    """
+    Opens a container read only for analysis. The arrays are memory maps, slicing them only reads
+    the part of the file that's needed.
+    """
+    return ExperimentContainer.open(path, mode="r")
@@ -0,0 +1,430 @@
+import os
+import sys
+import json
+import time
+import queue
+import datetime
+import argparse
+import threading
+
+import log_view
+import preset_validation
+import core_logic
+import scan_plan
+import run_experiment
+
+
+# Runs a series of experiment presets back to back on devices initialized once, e.g. overnight.
+#
+# Every job of the queue:
+#   · Gets its own folder under Output/: its experiment name, or name_2, name_3... when a folder or an
+#     earlier job has it already, so nothing gets overwritten (launch_experiment() refuses the name instead)
+#   · Runs through run_experiment.run_experiment(), the same scans the launcher and the headless runner do
+#   · Writes its log to the experiment.log of its folder
+#
+# Unless keep_order is set, the waiting jobs are reordered every time one starts: the next job is one
+# that keeps the time constant and roll-off of the lockin (a new time constant means waiting for the
+# filter and ranging anew) and, among those, the one that starts closest to where the stage is. The first
+# job starts from wherever the stage was left when the queue started. It's a greedy order, but a queue is
+# a handful of jobs.
+#
+# The finishing time adds up core_logic.estimate_experiment_duration() for the waiting jobs, scaled by
+# how long the jobs done so far took against their own estimate, and what the running job has left at
+# the pace it's measuring.
+#
+# The launcher shows the queue in its "Experiment queue" window. Without the GUI, from the project folder:
+#   python experiment_queue.py Utils/preset_a.json Utils/preset_b.json
+#   python experiment_queue.py Utils/preset_*.json --keep-order --no-images
+
+
+job_statuses = ("Waiting", "Running", "Done", "Stopped", "Failed")
+
+
+def lockin_settings(parameters_dict):
+    """
+    What the lockin is set to for an experiment, jobs with the same settings don't change it.
+    """
+    return float(parameters_dict["time_constant"]), int(parameters_dict["roll_off"])
+
+
+
+def stage_path(parameters_dict, plan=None):
+    """
+    Absolute delay in ps the stage goes to first in an experiment and the one it's left at.
+    """
+    if plan is None:
+        plan = scan_plan.compile_plan(parameters_dict["trip_legs"])
+    time_zero = float(parameters_dict["time_zero"])
+
+    # Autoranging once goes to time zero before the first point
+    first_position = float(plan.positions[0]) + time_zero
+    if parameters_dict["autoranging_type"] == "Once at time zero":
+        first_position = time_zero
+    return first_position, float(plan.positions[-1]) + time_zero
+
+
+
+def order_jobs(jobs, start_position_ps=None, start_settings=None):
+    """
+    Orders jobs to change the lockin settings as little as possible and then move the stage as little
+    as possible between them, see module comment.
+
+    Parameters:
+        jobs: list of dict - Jobs of an ExperimentQueue.
+        start_position_ps: float or None - Absolute delay the stage is at, None if unknown.
+        start_settings: tuple or None - lockin_settings() the lockin has, None if unknown.
+
+    Returns:
+        list of dict: The same jobs, in the order to run them. Ties keep the order they had.
+    """
+    remaining = list(jobs)
+    ordered = []
+    position = start_position_ps
+    settings = start_settings
+
+    while remaining:
+        def cost(job):
+            settings_change = settings is not None and job["Lockin settings"] != settings
+            travel = 0.0 if position is None else abs(job["Stage path [ps]"][0] - position)
+            return settings_change, travel
+
+        job = min(remaining, key=cost)
+        remaining.remove(job)
+        ordered.append(job)
+        position = job["Stage path [ps]"][1]
+        settings = job["Lockin settings"]
+
+    return ordered
+
+
+
+def unique_experiment_name(output_folder, experiment_name, taken=()):
+    """
+    experiment_name, or experiment_name_2, _3... if there's a folder with that name in output_folder
+    or it's among the taken names.
+    """
+    name = experiment_name
+    suffix = 2
+    while name in taken or os.path.exists(os.path.join(output_folder, name)):
+        name = f"{experiment_name}_{suffix}"
+        suffix += 1
+    return name
+
+
+
+class ExperimentQueue:
+    """
+    Queue of experiment presets run one after the other, see module comment.
+
+    Parameters:
+        output_folder: str or None - Folder the experiments are saved in, Output/ next to this file by default.
+        keep_order: bool - Run the jobs in the order they were added.
+    """
+
+    def __init__(self, output_folder=None, keep_order=False):
+        if output_folder is None:
+            output_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Output")
+        self.output_folder = output_folder
+        self.keep_order = keep_order
+
+        # Every line printed while the queue runs, each job's lines also go to its experiment.log
+        self.log = log_view.ExperimentLog()
+
+        self.jobs = []
+        self.current_job = None
+        self.progress = None
+        self._running = False
+        self._stop = False
+        self._lock = threading.Lock()
+
+
+    def add(self, parameters_dict):
+        """
+        Queues an experiment, check it with preset_validation.preset_problems() first.
+
+        Returns:
+            dict: The job, with the experiment name changed if it was taken.
+        """
+        parameters_dict = json.loads(json.dumps(parameters_dict))  # A copy the caller can't change
+        plan = scan_plan.compile_plan(parameters_dict["trip_legs"])
+
+        with self._lock:
+            parameters_dict["experiment_name"] = unique_experiment_name(self.output_folder, parameters_dict["experiment_name"],
+                                                                        [job["Experiment name"] for job in self.jobs])
+            job = {
+                    "Experiment name": parameters_dict["experiment_name"],
+                    "Parameters": parameters_dict,
+                    "Status": "Waiting",
+                    "Points": len(plan),
+                    "Lockin settings": lockin_settings(parameters_dict),
+                    "Stage path [ps]": stage_path(parameters_dict, plan),
+                    "Estimated duration [s]": float(core_logic.estimate_experiment_duration(parameters_dict, plan)),
+                    "Started": None,
+                    "Finished": None,
+                    "Message": "",
+                  }
+            self.jobs.append(job)
+        return job
+
+
+    def remove(self, job):
+        """
+        Takes a waiting job off the queue.
+
+        Raises:
+            ValueError: If the job already ran or is running.
+        """
+        with self._lock:
+            if job["Status"] != "Waiting":
+                raise ValueError(f"{job['Experiment name']} is {job['Status'].lower()}, only waiting jobs can be removed")
+            self.jobs.remove(job)
+
+
+    def reorder(self, start_position_ps=None, start_settings=None):
+        """
+        Puts the waiting jobs in the order they'll run from a stage position and lockin settings
+        (see order_jobs()), nothing changes with keep_order.
+        """
+        with self._lock:
+            if self.keep_order:
+                return
+            waiting = [job for job in self.jobs if job["Status"] == "Waiting"]
+            self.jobs = [job for job in self.jobs if job["Status"] != "Waiting"] + order_jobs(waiting, start_position_ps, start_settings)
+
+
+    def is_running(self):
+        return self._running
+
+
+    def run(self, experiment_data_queue, abort_queue, renderer=None, start_position_ps=None, scan_store_directory=None):
+        """
+        Runs the waiting jobs one after the other until there are none left or stop() is called, blocks
+        until then. Devices must be initialized. Capture the prints with self.log.capture_output() to
+        get them in the log files.
+
+        Parameters:
+            experiment_data_queue, abort_queue, renderer, scan_store_directory: See run_experiment.run_experiment().
+            start_position_ps: float or None - Absolute delay the stage is at, see core_logic.current_delay_ps().
+        """
+        self._stop = False
+        self._running = True
+        position = start_position_ps
+        settings = None
+
+        try:
+            while not self._stop:
+                self.reorder(position, settings)
+                with self._lock:
+                    waiting = [job for job in self.jobs if job["Status"] == "Waiting"]
+                    if not waiting:
+                        break
+                    job = waiting[0]
+
+                    # Something else may have saved an experiment with this name since the job was queued
+                    taken = [other_job["Experiment name"] for other_job in self.jobs if other_job is not job]
+                    job["Experiment name"] = unique_experiment_name(self.output_folder, job["Experiment name"], taken)
+                    job["Parameters"]["experiment_name"] = job["Experiment name"]
+
+                    job["Status"] = "Running"
+                    job["Started"] = time.time()
+                    self.progress = run_experiment.Progress(int(job["Parameters"]["num_scans"]))
+                    self.current_job = job
+
+                self.log.open_file(os.path.join(self.output_folder, job["Experiment name"], log_view.log_file_name))
+                print(f"Starting {job['Experiment name']}, {len(waiting) - 1} experiments waiting after it")
+
+                try:
+                    stop_reason = run_experiment.run_experiment(job["Parameters"], experiment_data_queue, abort_queue, renderer,
+                                                                scan_store_directory=scan_store_directory)
+                    if stop_reason is None:
+                        job["Status"] = "Stopped"
+                        job["Message"] = "Stopped early, it can be resumed from the launcher or with run_experiment.py --resume"
+                    else:
+                        job["Status"] = "Done"
+                        job["Message"] = stop_reason
+
+                # A failed experiment doesn't stop the ones after it, its checkpoint is there to resume it
+                except Exception as e:
+                    job["Status"] = "Failed"
+                    job["Message"] = str(e)
+                    print(f"An error occured during {job['Experiment name']}:\n{e}")
+
+                job["Finished"] = time.time()
+                print(f"{job['Experiment name']}: {job['Status'].lower()}")
+                position = job["Stage path [ps]"][1]
+                settings = job["Lockin settings"]
+                self.current_job = None
+
+        finally:
+            self.current_job = None
+            self._running = False
+            self.log.close()
+
+            # A stop that came between two jobs mustn't abort the next experiment launched
+            while True:
+                try:
+                    abort_queue.get_nowait()
+                except queue.Empty:
+                    break
+
+
+    def stop(self, abort_queue):
+        """
+        Stops the running job after its current point and runs no more jobs, the waiting ones stay queued.
+        """
+        self._stop = True
+        if self.is_running():
+            abort_queue.put(True)
+
+
+    def update(self, packet):
+        """
+        Follows the packets of the running job for the finishing times, like run_experiment.Progress.
+        """
+        progress = self.progress
+        if progress is not None:
+            progress.update(packet)
+
+
+    def finishing_times(self):
+        """
+        When every job finished or should finish, see module comment.
+
+        Returns:
+            list of (job, datetime or None) in the order the jobs run, None for jobs stopped or failed.
+        """
+        with self._lock:
+            jobs = list(self.jobs)
+            current_job, progress = self.current_job, self.progress
+
+        # How much longer than estimated the jobs take on this setup
+        done = [job for job in jobs if job["Status"] == "Done" and job["Estimated duration [s]"] > 0]
+        pace = 1.0
+        if done:
+            pace = sum(job["Finished"] - job["Started"] for job in done) / sum(job["Estimated duration [s]"] for job in done)
+
+        now = time.time()
+        finishing_timestamp = now
+        finishing_times = []
+        for job in jobs:
+            if job["Finished"] is not None:
+                finishing_times.append((job, datetime.datetime.fromtimestamp(job["Finished"]) if job["Status"] == "Done" else None))
+                continue
+
+            if job is current_job and progress is not None:
+                remaining = progress.remaining_s()
+                if remaining is None:
+                    remaining = max(pace * job["Estimated duration [s]"] - (now - job["Started"]), 0.0)
+            else:
+                remaining = pace * job["Estimated duration [s]"]
+            finishing_timestamp += remaining
+            finishing_times.append((job, datetime.datetime.fromtimestamp(finishing_timestamp)))
+
+        return finishing_times
+
+
+    def message(self):
+        """
+        One line on the running job and when the queue finishes, empty when no job is running.
+        """
+        current_job, progress = self.current_job, self.progress
+        if current_job is None or progress is None:
+            return ""
+
+        message = f"{current_job['Experiment name']}: {progress.message() or 'starting'}"
+        finishing_times = [finishing_time for _, finishing_time in self.finishing_times() if finishing_time is not None]
+        if finishing_times:
+            message += f". Queue finishing at around {max(finishing_times).strftime('%d/%m/%Y %H:%M')}"
+        return message
+
+
+
+def main():
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+
+    parser = argparse.ArgumentParser(description="Run experiment presets one after the other without the GUI")
+    parser.add_argument("presets", nargs="+", help="Experiment presets to run")
+    parser.add_argument("--rules", default=os.path.join(current_dir, "Utils", "validation_rules.json"), help="Validation rules the presets are checked against")
+    parser.add_argument("--keep-order", action="store_true", help="Run the presets in the order given")
+    parser.add_argument("--log-level", default="Info", choices=log_view.log_levels, help="Lowest level of the log lines shown on the terminal")
+    parser.add_argument("--image-format", default="png", help="Format of the scan images, any format matplotlib saves")
+    parser.add_argument("--dpi", type=int, default=300, help="Resolution of the scan images")
+    parser.add_argument("--no-images", action="store_true", help="Don't save scan images")
+    parser.add_argument("--defer-images", action="store_true", help="Render the scan images at the end of every experiment")
+    parser.add_argument("--troubleshooting", action="store_true", help="Verbose device initialization")
+    args = parser.parse_args()
+
+    ### Validate every preset before the devices move
+    validation_rules = run_experiment.load_json(args.rules)
+    default_config = run_experiment.load_json(os.path.join(current_dir, "Utils", "default_config.json"))
+    presets = [run_experiment.load_json(preset_path) for preset_path in args.presets]
+
+    problems = run_experiment.device_config_problems(default_config, validation_rules)
+    for preset_path, preset in zip(args.presets, presets):
+        problems += [f"{preset_path}: {problem}" for problem in preset_validation.preset_problems(preset, validation_rules)]
+    if problems:
+        print("The queue can't be run:")
+        for problem in problems:
+            print(f"    ·{problem}")
+        sys.exit(1)
+
+    experiment_queue = ExperimentQueue(keep_order=args.keep_order)
+    for preset in presets:
+        experiment_queue.add(preset)
+
+    ### Devices, initialized once for the whole queue
+    core_logic.initialization(Troubleshooting=args.troubleshooting)
+
+    renderer = None
+    if not args.no_images:
+        # matplotlib is only needed for the images
+        import snapshot_renderer
+        renderer = snapshot_renderer.SnapshotRenderer(args.image_format, args.dpi, args.defer_images)
+
+    start_position_ps = core_logic.current_delay_ps()
+    experiment_queue.reorder(start_position_ps)
+    print(f"Running {len(experiment_queue.jobs)} experiments from {round(start_position_ps, 2)}ps:")
+    for job, finishing_time in experiment_queue.finishing_times():
+        time_constant, roll_off = job["Lockin settings"]
+        print(f"    ·{job['Experiment name']}: {job['Points']} points, {time_constant}s and {roll_off}dB/oct, "
+              f"finishing at around {finishing_time.strftime('%d/%m/%Y %H:%M')}")
+
+    ### Experiments
+    experiment_data_queue = queue.Queue()
+    abort_queue = queue.Queue()
+
+    # Exceptions dont propagate upwards from threads, the queue thread leaves them here
+    outcome = {"Error": None}
+    def experiment_queue_thread_logic():
+        try:
+            experiment_queue.run(experiment_data_queue, abort_queue, renderer, start_position_ps)
+        except Exception as e:
+            outcome["Error"] = e
+
+    experiment_queue.log.capture_output()
+    try:
+        experiment_queue_thread = threading.Thread(target=experiment_queue_thread_logic, daemon=True)
+        experiment_queue_thread.start()
+        run_experiment.stream_experiment(experiment_queue_thread, experiment_data_queue, experiment_queue.log, args.log_level,
+                                         experiment_queue, lambda: experiment_queue.stop(abort_queue))
+    finally:
+        sys.stdout = sys.__stdout__
+        sys.stderr = sys.__stderr__
+        experiment_queue.log.close()
+
+    if outcome["Error"] is not None:
+        print(f"An error occured while running the queue:\n{outcome['Error']}")
+
+    print("Queue finished:")
+    for job in experiment_queue.jobs:
+        print(f"    ·{job['Experiment name']}: {job['Status'].lower()}{'. ' + job['Message'] if job['Message'] else ''}")
+
+    statuses = [job["Status"] for job in experiment_queue.jobs]
+    if outcome["Error"] is not None or "Failed" in statuses:
+        sys.exit(1)
+    if "Stopped" in statuses or "Waiting" in statuses:
+        sys.exit(130)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+import queue
+import threading
+import tkinter as tk
+
+
+# Wakes the GUI up when a worker thread has something for it.
+#
+# The launcher used to poll its queues with after(): the monitoring window every 10ms, the initialization
+# window and the error check every 100ms, even when nothing happened. That costs idle CPU on the lab PC
+# and up to 100ms before an error dialog shows up. Now:
+#   · Queues the workers write to are NotifyingQueues, every put() notifies the GuiWakeups listening to them
+#   · A GuiWakeup runs its handler on the Tk thread through a virtual event. Notifying only sets a flag,
+#     a small forwarding thread generates the event, so the worker never waits for Tk (a call into Tk from
+#     another thread waits until the Tk thread gets to it). Notifications that arrive before the handler
+#     ran are served by that same run
+#   · A slow fallback poll (fallback_ms) still runs the handler, in case an event is lost or Tcl wasn't
+#     built with threads and can't take events from other threads
+#   · schedule() runs the handler after a delay, for work that's due later (e.g. a frame held back by
+#     the frame rate cap)
+
+
+class GuiWakeup:
+    """
+    Runs handler on the Tk thread when notified, see module comment.
+
+    Parameters:
+        widget: tk widget - Receives the virtual event, the wakeup stops working once it's destroyed.
+        handler: callable - Takes no arguments, runs on the Tk thread.
+        fallback_ms: int - Interval of the fallback poll, None for no fallback poll.
+    """
+
+    def __init__(self, widget, handler, fallback_ms=500):
+        self.widget = widget
+        self.handler = handler
+        self.fallback_ms = fallback_ms
+
+        self.sequence = f"<<Wakeup{id(self)}>>"
+        self.widget.bind(self.sequence, lambda event: self._run())
+
+        self._queues = []
+        self._stopped = False
+        self._requested = threading.Event()
+        self._scheduled = None
+
+        self._forwarder = threading.Thread(target=self._forward, daemon=True)
+        self._forwarder.start()
+        if fallback_ms is not None:
+            self.widget.after(fallback_ms, self._fallback)
+
+
+    def listen(self, notifying_queue):
+        """
+        Notifies this wakeup on every put() to notifying_queue.
+        """
+        notifying_queue.wakeups.append(self)
+        self._queues.append(notifying_queue)
+
+
+    def notify(self):
+        """
+        Asks for a run of the handler, safe to call from any thread and returns straight away.
+        """
+        self._requested.set()
+
+
+    def schedule(self, delay_s):
+        """
+        Runs the handler in delay_s seconds unless a run is already scheduled. Call it from the Tk thread.
+        """
+        if self._scheduled is None and not self._stopped:
+            self._scheduled = self.widget.after(max(1, int(1000 * delay_s)), self._run_scheduled)
+
+
+    def stop(self):
+        """
+        No more runs of the handler. Call it from the Tk thread.
+        """
+        self._stopped = True
+        self._requested.set()
+        for notifying_queue in self._queues:
+            if self in notifying_queue.wakeups:
+                notifying_queue.wakeups.remove(self)
+        self._queues = []
+        try:
+            self.widget.unbind(self.sequence)
+            if self._scheduled is not None:
+                self.widget.after_cancel(self._scheduled)
+        except tk.TclError:
+            pass  # The widget is gone already
+
+
+    def _forward(self):
+        while True:
+            self._requested.wait()
+            if self._stopped:
+                return
+            self._requested.clear()
+
+            # Blocks until the Tk thread takes the event, notifications in the meantime set the flag again
+            try:
+                self.widget.event_generate(self.sequence, when="tail")
+            except (RuntimeError, tk.TclError):
+                pass  # No main loop or no widget, the fallback poll takes over
+
+
+    def _run(self):
+        if not self._stopped:
+            self.handler()
+
+
+    def _run_scheduled(self):
+        self._scheduled = None
+        self._run()
+
+
+    def _fallback(self):
+        if self._stopped:
+            return
+        self._run()
+        if not self._stopped:
+            self.widget.after(self.fallback_ms, self._fallback)
+
+
+
+class NotifyingQueue(queue.Queue):
+    """
+    queue.Queue that notifies the GuiWakeups listening to it on every put().
+    """
+
+    def __init__(self, maxsize=0):
+        super().__init__(maxsize)
+        self.wakeups = []
+
+    def put(self, item, block=True, timeout=None):
+        super().put(item, block, timeout)
+        for wakeup in list(self.wakeups):
+            wakeup.notify()
@@ -0,0 +1,491 @@
+import time
+import numpy as np
+from matplotlib.ticker import MaxNLocator
+
+
+# Live graph of the monitoring window.
+#
+# monitor_experiment() used to run relim(), autoscale_view(), legend() and a full canvas.draw() for every
+# point, so with many scans on screen drawing took over the Tk thread and the log and the abort button
+# lagged behind. LivePlot draws with blitting instead:
+#   · A full draw renders everything that doesn't change (axes, ticks, legend, finished scans) and we
+#     keep a copy of it, the background
+#   · Every frame after that restores the background and draws only the artists that change: the line
+#     of the running scan, the average and the samples per point. These are "animated" so full draws
+#     leave them out of the background
+#   · Full draws only happen when a scan starts (its line joins the legend, the previous one becomes part
+#     of the background), when data leaves the view while autoscaling is on, or when the user zooms, pans
+#     or resizes (the toolbar redraws and we catch the draw event to copy the new background)
+#   · Frames are capped to max_fps, updates in between are drawn together in the next frame
+#
+# The figure and its lines are kept for the next experiment, reset() hides the lines and hands them out
+# again instead of plotting new ones every time.
+#
+# Sub-picosecond steps over the whole stage give lines of tens of thousands of points on a canvas about a
+# thousand pixels wide. The lines only get the points that make a difference on screen (see
+# minmax_decimate()), worked out again whenever the user zooms or pans, so drawing takes about the same
+# time however long the scans are. The full resolution data stays in _full_data, and the scan store
+# keeps everything that's saved.
+#
+# With 50+ scans a line per scan is unreadable and every full draw goes through all of them. For those
+# experiments reset() can turn on the heat map: one image of scan number × delay position below the
+# lines, preallocated for every scan plus a row for the running average and filled one cell per point.
+# The lines axes then only keep the running scan and the average, and a narrow panel next to the heat
+# map shows the drift of every scan: its mean deviation from the running average at the time each of
+# its points was measured. Drawing costs the same however many scans there are.
+
+
+class LivePlot:
+    """
+    Blitted live graph, see module comment.
+
+    Parameters:
+        figure: matplotlib Figure - Created once and reused, attach() it to the canvas of every monitoring window.
+        max_fps: float - Most frames drawn per second.
+
+    Attributes:
+        frames_drawn, full_draws: int - Blitted frames and full draws since the last reset().
+    """
+
+    # Layouts of the figure, [left, bottom, width, height] of every axes
+    heat_map_layout = {
+                        "Lines": [0.08, 0.58, 0.72, 0.37],
+                        "Heat map": [0.08, 0.1, 0.72, 0.38],
+                        "Drift": [0.82, 0.1, 0.08, 0.38],
+                        "Color bar": [0.93, 0.1, 0.015, 0.38],
+                      }
+
+    def __init__(self, figure, max_fps=20, heat_map_cmap="inferno"):
+        self.figure = figure
+        self.max_fps = max_fps
+
+        self.axes = figure.add_subplot(111)
+        self.axes.set_xlabel('t [ps]')
+        self.axes.set_ylabel('PD [Vrms]')
+        self._lines_position = self.axes.get_position()
+        self.heat_map_cmap = heat_map_cmap
+        self.heat_map_axes = None
+        self.drift_axes = None
+
+        self.average_line, = self.axes.plot([], [], linestyle='--', linewidth=3, color="deepskyblue", label="Average", animated=True)
+
+        # Samples averaged at every point go on a second y axis, only shown when the experiment asks for it
+        self.sample_count_axes = self.axes.twinx()
+        self.sample_count_axes.set_ylabel('Samples averaged')
+        self.sample_count_line, = self.sample_count_axes.plot([], [], drawstyle='steps-mid', linestyle=':', color="gray", animated=True)
+
+        self.scan_lines = []
+        self._spare_lines = []
+        self._full_data = {}
+
+        # Zooming and panning move the x limits of both axes, the lines get decimated for the new view
+        for axes in (self.axes, self.sample_count_axes):
+            axes.callbacks.connect("xlim_changed", self._on_view_changed)
+
+        self.canvas = None
+        self._draw_connection = None
+        self._background = None
+        self._needs_full_draw = True
+        self._dirty = False
+        self._last_frame_timestamp = 0.0
+
+        self.reset()
+
+
+    def attach(self, canvas):
+        """
+        Draws on a new canvas, e.g. the one of a new monitoring window.
+        """
+        if self.canvas is not None and self._draw_connection is not None:
+            self.canvas.mpl_disconnect(self._draw_connection)
+
+        self.canvas = canvas
+        self._draw_connection = canvas.mpl_connect("draw_event", self._on_draw)
+        canvas.mpl_connect("resize_event", lambda event: self._decimate_all())
+        self._background = None
+        self._needs_full_draw = True
+
+
+    def reset(self, show_sample_counts=False, heat_map_positions=None, num_scans=0):
+        """
+        Clears the graph for a new experiment, the scan lines are kept for reuse.
+
+        Parameters:
+            show_sample_counts: bool - Show the samples averaged at every point on a second axis.
+            heat_map_positions: array like or None - Positions of the averaging grid, to show the heat map.
+            num_scans: int - Rows of the heat map, not counting the average.
+        """
+        for line in self.scan_lines:
+            line.set_data([], [])
+            line.set_visible(False)
+            line.set_label("_nolegend_")
+            self._spare_lines.append(line)
+        self.scan_lines = []
+
+        self.average_line.set_data([], [])
+        self.average_line.set_visible(False)
+        self.sample_count_line.set_data([], [])
+        self.sample_count_axes.set_visible(show_sample_counts)
+        self._full_data = {}
+
+        for axes in (self.axes, self.sample_count_axes):
+            axes.set_autoscalex_on(True)
+            axes.set_autoscaley_on(True)
+
+        self.heat_map = heat_map_positions is not None
+        if self.heat_map:
+            self._reset_heat_map(heat_map_positions, num_scans)
+        else:
+            for axes in (self.axes, self.sample_count_axes):
+                axes.set_position(self._lines_position)
+            if self.heat_map_axes is not None:
+                for axes in (self.heat_map_axes, self.drift_axes, self.color_bar.ax):
+                    axes.set_visible(False)
+        self._update_legend()
+
+        self.frames_drawn = 0
+        self.full_draws = 0
+        self._needs_full_draw = True
+
+
+    def start_scan(self, color, label):
+        """
+        Adds the line of a new scan. The line of the previous scan won't change anymore, it becomes part
+        of the background. With the heat map on it's put away instead, the heat map shows it.
+        """
+        if self.scan_lines and self.heat_map:
+            line = self.scan_lines.pop()
+            line.set_visible(False)
+            line.set_label("_nolegend_")
+            self._full_data.pop(line, None)
+            self._spare_lines.append(line)
+        elif self.scan_lines:
+            self.scan_lines[-1].set_animated(False)
+
+        if self._spare_lines:
+            line = self._spare_lines.pop()
+            line.set_color(color)
+            line.set_label(label)
+            line.set_visible(True)
+        else:
+            line, = self.axes.plot([], [], linestyle='-', color=color, label=label)
+        line.set_animated(True)
+        self.scan_lines.append(line)
+
+        self._update_legend()
+        self._needs_full_draw = True
+
+
+    # --- Data updates, drawn with the next frame ---
+    def set_scan_data(self, positions, data):
+        if self.scan_lines:
+            self._set_line_data(self.scan_lines[-1], positions, data)
+            self._data_changed(self.axes, positions, data)
+
+
+    def set_average(self, positions, average):
+        if not self.average_line.get_visible():
+            self.average_line.set_visible(True)
+            self._update_legend()
+            self._needs_full_draw = True
+        self._set_line_data(self.average_line, positions, average)
+        self._data_changed(self.axes, positions, average)
+
+        # The top row of the heat map
+        if self.heat_map and len(average) == self.heat_map_image_data.shape[1]:
+            self.heat_map_image_data[-1] = average
+            self._heat_map_changed(average)
+
+
+    def set_sample_counts(self, positions, counts):
+        self._set_line_data(self.sample_count_line, positions, counts)
+        self._data_changed(self.sample_count_axes, positions, counts)
+
+
+    def _data_changed(self, axes, x, y):
+        self._dirty = True
+
+        # Rescale only when the data leaves the view, and not at all if the user zoomed or panned
+        # (the toolbar turns autoscaling off)
+        if self._needs_full_draw or not (axes.get_autoscalex_on() or axes.get_autoscaley_on()):
+            return
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        finite = np.isfinite(x) & np.isfinite(y)
+        if not np.any(finite):
+            return
+
+        x_low, x_high = axes.get_xlim()
+        y_low, y_high = axes.get_ylim()
+        if (np.min(x[finite]) < x_low or np.max(x[finite]) > x_high or
+                np.min(y[finite]) < y_low or np.max(y[finite]) > y_high):
+            self._needs_full_draw = True
+
+
+    # --- Heat map ---
+    def _reset_heat_map(self, positions, num_scans):
+        if self.heat_map_axes is None:
+            self.heat_map_axes = self.figure.add_axes(self.heat_map_layout["Heat map"])
+            self.heat_map_axes.set_xlabel('t [ps]')
+            self.heat_map_axes.set_ylabel('Scan')
+            self.heat_map_axes.xaxis.set_major_locator(MaxNLocator(integer=True))
+            self.heat_map_axes.yaxis.set_major_locator(MaxNLocator(integer=True))
+            self.heat_map_axes.xaxis.set_major_formatter(lambda value, tick: self._heat_map_tick_label(value))
+            self.heat_map_axes.yaxis.set_major_formatter(lambda value, tick: "Avg" if round(value) == self.heat_map_image_data.shape[0] - 1 else f"{round(value)}")
+            self.heat_map_image = self.heat_map_axes.imshow(np.full((2, 2), np.nan), aspect="auto", origin="lower",
+                                                            interpolation="nearest", cmap=self.heat_map_cmap, animated=True)
+            self.heat_map_separator = self.heat_map_axes.axhline(0, color="deepskyblue", linewidth=1)
+
+            self.drift_axes = self.figure.add_axes(self.heat_map_layout["Drift"], sharey=self.heat_map_axes)
+            self.drift_axes.set_xlabel('Drift [Vrms]')
+            self.drift_axes.tick_params(labelleft=False)
+            self.drift_axes.xaxis.set_major_locator(MaxNLocator(nbins=2))
+            self.drift_axes.axvline(0, color="gray", linewidth=1, linestyle=':')
+            self.drift_line, = self.drift_axes.plot([], [], marker='.', color="black", animated=True)
+
+            self.color_bar = self.figure.colorbar(self.heat_map_image, cax=self.figure.add_axes(self.heat_map_layout["Color bar"]))
+
+        for axes in (self.axes, self.sample_count_axes):
+            axes.set_position(self.heat_map_layout["Lines"])
+        for axes in (self.heat_map_axes, self.drift_axes, self.color_bar.ax):
+            axes.set_visible(True)
+
+        # Rows are the scans, the average goes on top, columns the positions of the averaging grid
+        self.heat_map_positions = np.asarray(positions, dtype=np.float64).copy()
+        self.heat_map_image_data = np.full((num_scans + 1, len(self.heat_map_positions)), np.nan)
+        self.heat_map_image.set_data(self.heat_map_image_data)
+        self.heat_map_image.set_extent((-0.5, len(self.heat_map_positions) - 0.5, -0.5, num_scans + 0.5))
+        self.heat_map_axes.set_xlim(-0.5, len(self.heat_map_positions) - 0.5)
+        self.heat_map_axes.set_ylim(-0.5, num_scans + 0.5)
+        self.heat_map_image.set_clim(0, 1)
+        self._heat_map_clim = None
+        self._heat_map_stale = False
+        self.heat_map_separator.set_ydata([num_scans - 0.5, num_scans - 0.5])
+
+        self.drift_sums = np.zeros(num_scans)
+        self.drift_counts = np.zeros(num_scans, dtype=np.int64)
+        self.drift_line.set_data([], [])
+        self.drift_axes.set_autoscalex_on(True)
+
+
+    def _heat_map_tick_label(self, value):
+        # Columns are grid positions, the ticks show the delay of the column
+        index = int(round(value))
+        if 0 <= index < len(self.heat_map_positions):
+            return f"{round(float(self.heat_map_positions[index]), 3):g}"
+        return ""
+
+
+    def set_heat_map_grid(self, positions):
+        """
+        Moves the heat map to a new averaging grid (adaptive experiments refine it after the pilot scan),
+        the cells measured so far are kept where the new grid has their position.
+        """
+        positions = np.asarray(positions, dtype=np.float64)
+        if not self.heat_map or (len(positions) == len(self.heat_map_positions) and np.allclose(positions, self.heat_map_positions)):
+            return
+
+        # Same matching as acquisition_policy.grid_indices(), on the sorted new grid
+        order = np.argsort(positions, kind="stable")
+        nearest = np.clip(np.searchsorted(positions[order], self.heat_map_positions), 0, len(positions) - 1)
+        nearest = np.where((nearest > 0) & (np.abs(positions[order][nearest - 1] - self.heat_map_positions) < np.abs(positions[order][nearest] - self.heat_map_positions)), nearest - 1, nearest)
+        on_grid = np.abs(positions[order][nearest] - self.heat_map_positions) <= 1e-6
+
+        image_data = np.full((self.heat_map_image_data.shape[0], len(positions)), np.nan)
+        image_data[:, order[nearest[on_grid]]] = self.heat_map_image_data[:, on_grid]
+        self.heat_map_positions = positions.copy()
+        self.heat_map_image_data = image_data
+        self.heat_map_image.set_data(self.heat_map_image_data)
+        self.heat_map_image.set_extent((-0.5, len(positions) - 0.5, -0.5, image_data.shape[0] - 0.5))
+        self.heat_map_axes.set_xlim(-0.5, len(positions) - 0.5)
+        self._needs_full_draw = True
+
+
+    def set_heat_map_point(self, scan, grid_index, value, average_value=None):
+        """
+        Fills the cell of a new point, and adds it to the drift of its scan when there's an average to compare with.
+        """
+        if not self.heat_map or scan >= len(self.drift_sums):
+            return
+        self.heat_map_image_data[scan, grid_index] = value
+        self._heat_map_changed([value])
+
+        if average_value is not None and np.isfinite(value) and np.isfinite(average_value):
+            self.drift_sums[scan] += value - average_value
+            self.drift_counts[scan] += 1
+            measured = np.flatnonzero(self.drift_counts)
+            drift = self.drift_sums[measured] / self.drift_counts[measured]
+            self.drift_line.set_data(drift, measured)
+            self._data_changed(self.drift_axes, drift, measured)
+
+
+    def _heat_map_changed(self, values):
+        # set_data() copies the array, so the image takes the new cells once per frame (see render())
+        self._dirty = True
+        self._heat_map_stale = True
+
+        # The color scale only grows, and then the color bar has to be drawn again
+        values = np.asarray(values, dtype=np.float64)
+        values = values[np.isfinite(values)]
+        if len(values) == 0:
+            return
+        low, high = values.min(), values.max()
+        if self._heat_map_clim is None or low < self._heat_map_clim[0] or high > self._heat_map_clim[1]:
+            if self._heat_map_clim is not None:
+                low, high = min(low, self._heat_map_clim[0]), max(high, self._heat_map_clim[1])
+            self._heat_map_clim = (low, high if high > low else low + 1e-12)
+            self.heat_map_image.set_clim(*self._heat_map_clim)
+            self._needs_full_draw = True
+
+
+    # --- Decimation ---
+    def _set_line_data(self, line, x, y):
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        self._full_data[line] = (x, y)
+        line.set_data(*self._decimated(line.axes, x, y))
+
+
+    def _decimated(self, axes, x, y):
+        # While autoscaling the view grows to take the whole line, decimating over the view alone would
+        # drop the points that make it grow
+        if axes.get_autoscalex_on():
+            finite = x[np.isfinite(x)]
+            if len(finite) == 0:
+                return x, y
+            x_low, x_high = finite.min(), finite.max()
+        else:
+            x_low, x_high = axes.get_xlim()
+        return minmax_decimate(x, y, x_low, x_high, int(axes.get_window_extent().width))
+
+
+    def _decimate_all(self):
+        for line, (x, y) in self._full_data.items():
+            line.set_data(*self._decimated(line.axes, x, y))
+
+
+    def _on_view_changed(self, axes):
+        # Both axes share x but only the one being zoomed or panned calls back, so every line is
+        # decimated again. The toolbar redraws afterwards and the new background comes with it
+        self._decimate_all()
+
+
+    def _update_legend(self):
+        handles = [line for line in self.scan_lines + [self.average_line] if line.get_visible()]
+        legend = self.axes.get_legend()
+        if legend is not None:
+            legend.remove()
+        if handles:
+            self.axes.legend(handles=handles)
+
+
+    # --- Drawing ---
+    def render(self, force=False):
+        """
+        Draws a frame if something changed and the frame rate allows it.
+
+        Returns:
+            bool: Whether a frame was drawn.
+        """
+        if self.canvas is None or not (self._dirty or self._needs_full_draw):
+            return False
+
+        now = time.perf_counter()
+        if not force and now - self._last_frame_timestamp < 1 / self.max_fps:
+            return False
+        self._last_frame_timestamp = now
+
+        if self.heat_map and self._heat_map_stale:
+            self.heat_map_image.set_data(self.heat_map_image_data)
+            self._heat_map_stale = False
+
+        if self._needs_full_draw or self._background is None:
+            for axes in (self.axes, self.sample_count_axes) + ((self.drift_axes,) if self.heat_map else ()):
+                axes.relim(visible_only=True)
+                axes.autoscale_view(scaley=axes is not self.drift_axes)
+            self._needs_full_draw = False
+            self.full_draws += 1
+
+            # Copies the background and draws the animated artists on top (see _on_draw)
+            self.canvas.draw()
+        else:
+            self.canvas.restore_region(self._background)
+            self._draw_animated()
+            self.canvas.blit(self.figure.bbox)
+
+        self._dirty = False
+        self.frames_drawn += 1
+        return True
+
+
+    def next_frame_in(self):
+        """
+        Seconds until render() can draw the changes the frame rate cap is holding back, None if there
+        are none.
+        """
+        if self.canvas is None or not (self._dirty or self._needs_full_draw):
+            return None
+        return max(0.0, 1 / self.max_fps - (time.perf_counter() - self._last_frame_timestamp))
+
+
+    def _on_draw(self, event):
+        # Every full draw, ours or the toolbar's, leaves out the animated artists: keep it as the background
+        # and put them back on top
+        self._background = self.canvas.copy_from_bbox(self.figure.bbox)
+        self._draw_animated()
+
+
+    def _draw_animated(self):
+        if self.scan_lines:
+            self.axes.draw_artist(self.scan_lines[-1])
+        if self.average_line.get_visible():
+            self.axes.draw_artist(self.average_line)
+        if self.sample_count_axes.get_visible():
+            self.sample_count_axes.draw_artist(self.sample_count_line)
+        if self.heat_map:
+            self.heat_map_axes.draw_artist(self.heat_map_image)
+            self.drift_axes.draw_artist(self.drift_line)
+
+
+
+def minmax_decimate(x, y, x_low, x_high, num_columns):
+    """
+    Points of a line that look the same as the whole line when drawn num_columns pixels wide between
+    x_low and x_high: for every pixel column the first, lowest, highest and last point in it, plus the
+    points right outside the view so the line still runs to its edges.
+
+    Lines that fit in the columns already, or whose x isn't sorted, are returned as they are.
+
+    Parameters:
+        x, y: float64 arrays - The line, x sorted.
+        x_low, x_high: float - Range of x the line is drawn over.
+        num_columns: int - Pixel columns of that range.
+
+    Returns:
+        tuple: (x, y) of the points kept, in their original order.
+    """
+    if num_columns < 1 or not x_high > x_low or len(x) <= 4 * num_columns or np.any(np.diff(x) < 0):
+        return x, y
+
+    first = max(int(np.searchsorted(x, x_low, side="left")) - 1, 0)
+    last = min(int(np.searchsorted(x, x_high, side="right")) + 1, len(x))
+    x = x[first:last]
+    y = y[first:last]
+    if len(x) <= 4 * num_columns:
+        return x, y
+
+    # x is sorted, so the points of every column come one after another
+    columns = np.clip(np.floor((x - x_low) / (x_high - x_low) * num_columns).astype(np.int64), -1, num_columns)
+    starts = np.flatnonzero(np.r_[True, columns[1:] != columns[:-1]])
+    ends = np.r_[starts[1:], len(x)] - 1
+
+    # First point of every column holding its lowest and its highest value, NaNs (gaps of the line) left out
+    lengths = ends - starts + 1
+    extremes = []
+    for reduce, blank in ((np.minimum, np.inf), (np.maximum, -np.inf)):
+        values = np.where(np.isnan(y), blank, y)
+        at_extreme = np.flatnonzero(values == np.repeat(reduce.reduceat(values, starts), lengths))
+        extremes.append(at_extreme[np.searchsorted(at_extreme, starts)])
+
+    keep = np.unique(np.concatenate([starts, ends] + extremes))
+    return x[keep], y[keep]
@@ -0,0 +1,193 @@
+import os
+import sys
+import queue
+import logging
+from logging.handlers import RotatingFileHandler, QueueListener
+from collections import deque
+import tkinter as tk
+
+
+# Experiment log of the monitoring window.
+#
+# core_logic prints about six lines per point, every one of them used to be a listbox.insert() plus a
+# listbox.see() and the Listbox kept every line of the run, so Tk got slower and slower over a multi hour
+# experiment. Now:
+#   · ExperimentLog takes the prints (capture_output() points stdout and stderr at it), files every
+#     line under a level and hands it to the GUI through a queue, calling on_line to wake the GUI up.
+#     If it has a file path every line also goes to a rotating log file, written by a QueueListener on
+#     its own thread so the disk never holds up the experiment or the GUI
+#   · LogView shows the newest max_lines lines only: they're kept in a ring buffer, the lines that
+#     arrived since the last GUI tick are inserted in one go and the oldest ones dropped from the top.
+#     The level filter hides the lines below the level picked, the whole log is still in the file
+#
+# Levels: "Detail" for the indented "    ·Delay set to ..." lines of every step, "Info" for the rest of
+# what's printed and "Error" for whatever goes to stderr.
+
+
+log_levels = ("Detail", "Info", "Error")
+_logging_levels = {"Detail": logging.DEBUG, "Info": logging.INFO, "Error": logging.ERROR}
+
+log_file_name = "experiment.log"
+
+
+class LogStream:
+    """
+    File like object that sends what's written to it to an ExperimentLog, to replace sys.stdout and sys.stderr.
+    """
+
+    def __init__(self, log, level):
+        self.log = log
+        self.level = level
+
+    def write(self, message):
+        self.log.add(message, self.level)
+
+    def flush(self):
+        pass  # Required for compatibility
+
+
+
+class ExperimentLog:
+    """
+    Collects the log lines of an experiment for a LogView and, optionally, a rotating log file.
+
+    Parameters:
+        file_path: str or None - Log file, None to keep the log in the GUI only.
+        max_file_bytes: int - Size at which the log file is rotated.
+        backup_count: int - Rotated files kept next to it (experiment.log.1, .2 ...).
+    """
+
+    def __init__(self, file_path=None, max_file_bytes=5 * 1024 * 1024, backup_count=5):
+        self.file_path = None
+        self.max_file_bytes = max_file_bytes
+        self.backup_count = backup_count
+        self._incoming = queue.SimpleQueue()
+
+        # Called from the thread that adds every line, e.g. GuiWakeup.notify (see gui_wakeup.py)
+        self.on_line = None
+
+        self._file_queue = None
+        self._listener = None
+        if file_path is not None:
+            self.open_file(file_path)
+
+
+    def open_file(self, file_path):
+        """
+        Writes the lines from now on to file_path instead of the current log file, e.g. for the next
+        experiment of a queue (see experiment_queue.py).
+        """
+        self.close()
+        self.file_path = file_path
+        os.makedirs(os.path.dirname(os.path.abspath(file_path)), exist_ok=True)
+        handler = RotatingFileHandler(file_path, maxBytes=self.max_file_bytes, backupCount=self.backup_count, encoding="utf-8")
+        handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(message)s"))
+        self._file_queue = queue.SimpleQueue()
+        self._listener = QueueListener(self._file_queue, handler)
+        self._listener.start()
+
+
+    def add(self, message, level="Info"):
+        """
+        Adds a line, safe to call from any thread.
+        """
+        text = message.rstrip()
+        if not text.strip():
+            return  # Avoid empty lines
+
+        if level == "Info" and text.lstrip().startswith("·"):
+            level = "Detail"
+
+        self._incoming.put((level, text))
+        if self.on_line is not None:
+            self.on_line()
+        if self._listener is not None:
+            self._file_queue.put(logging.makeLogRecord({"msg": text, "levelname": level, "levelno": _logging_levels[level]}))
+
+
+    def drain(self):
+        """
+        Every line added since the last call, as (level, text) tuples.
+        """
+        lines = []
+        while True:
+            try:
+                lines.append(self._incoming.get_nowait())
+            except queue.Empty:
+                return lines
+
+
+    def capture_output(self):
+        """
+        Sends prints (stdout) and errors (stderr) to the log, restore them with sys.stdout = sys.__stdout__
+        and sys.stderr = sys.__stderr__.
+        """
+        sys.stdout = LogStream(self, "Info")
+        sys.stderr = LogStream(self, "Error")
+
+
+    def close(self):
+        """
+        Writes what's left to the log file and stops its thread.
+        """
+        if self._listener is not None:
+            self._listener.stop()
+            for handler in self._listener.handlers:
+                handler.close()
+            self._listener = None
+
+
+
+class LogView:
+    """
+    Shows an ExperimentLog on a Listbox, see module comment. Call update() once per GUI tick.
+
+    Parameters:
+        listbox: tk.Listbox
+        log: ExperimentLog
+        max_lines: int - Lines kept in the ring buffer and on the Listbox.
+        level: str - Lowest level shown, one of log_levels.
+    """
+
+    def __init__(self, listbox, log, max_lines=2000, level="Detail"):
+        self.listbox = listbox
+        self.log = log
+        self.max_lines = max_lines
+        self.level = level
+        self.lines = deque(maxlen=max_lines)
+
+
+    def _shown(self, level):
+        return log_levels.index(level) >= log_levels.index(self.level)
+
+
+    def update(self):
+        """
+        Adds the lines that arrived since the last call with a single insert.
+        """
+        new_lines = self.log.drain()
+        if not new_lines:
+            return
+
+        self.lines.extend(new_lines)
+        shown = [text for level, text in new_lines[-self.max_lines:] if self._shown(level)]
+        if not shown:
+            return
+
+        self.listbox.insert(tk.END, *shown)
+        excess = self.listbox.size() - self.max_lines
+        if excess > 0:
+            self.listbox.delete(0, excess - 1)
+        self.listbox.see(tk.END)  # Auto-scroll to the bottom
+
+
+    def set_level(self, level):
+        """
+        Shows the lines of the ring buffer from level up.
+        """
+        self.level = level
+        self.listbox.delete(0, tk.END)
+        shown = [text for line_level, text in self.lines if self._shown(line_level)]
+        if shown:
+            self.listbox.insert(tk.END, *shown)
+            self.listbox.see(tk.END)
@@ -0,0 +1,151 @@
+import numpy as np
+
+
+# Host side noise estimation. Instead of asking the lockin for X noise and Y noise (two extra queries
+# per point that also depend on autoscale being set properly, see autoscale() docstring) we grab a short
+# burst of R samples at every point and compute the error bar ourselves.
+#
+# All functions take the samples along the last axis, so they work both for a single burst of shape (K,)
+# and for a whole scan of bursts of shape (points, K) in one vectorized call.
+#
+# Samples taken faster than the lockin time constant are correlated: the output filter has memory, so
+# K samples are worth fewer than K independent measurements. The plain standard error underestimates the
+# error in that case, autocorrelation_corrected_error() accounts for it and is what we store in the CSV.
+# The correction can only go so far, a burst read within one time constant is nearly constant and its
+# autocorrelation can't be told from the noise. That's why perform_experiment() spaces the samples by
+# the filter's correlation time (see request_sample_interval() in core_logic.py).
+
+
+def standard_error(samples):
+    """
+    Standard error of the mean assuming independent samples.
+
+    Parameters:
+        samples: array like - Samples along the last axis.
+
+    Returns:
+        ndarray: Standard error for each burst (0 for bursts with less than 2 samples).
+    """
+    samples = np.asarray(samples, dtype=np.float64)
+    num_samples = samples.shape[-1]
+    if num_samples < 2:
+        return np.zeros(samples.shape[:-1])
+
+    return np.std(samples, axis=-1, ddof=1) / np.sqrt(num_samples)
+
+
+
+def allan_deviation(samples, averaging_factor=1):
+    """
+    Non overlapping Allan deviation of the samples for a given averaging factor m: samples are
+    averaged in consecutive blocks of m and the deviation is computed from differences between
+    neighbouring blocks. Unlike the standard deviation it's insensitive to slow drifts of the signal
+    during the burst (laser power, stage settling).
+
+    Parameters:
+        samples: array like - Samples along the last axis.
+        averaging_factor: int - Number of samples averaged into each block.
+
+    Returns:
+        ndarray: Allan deviation for each burst (NaN if there are less than 2 blocks).
+    """
+    samples = np.asarray(samples, dtype=np.float64)
+    num_blocks = samples.shape[-1] // averaging_factor
+    if num_blocks < 2:
+        return np.full(samples.shape[:-1], np.nan)
+
+    # Reshape the trailing axis into (blocks, m) and average each block
+    trimmed = samples[..., :num_blocks * averaging_factor]
+    blocks = trimmed.reshape(samples.shape[:-1] + (num_blocks, averaging_factor)).mean(axis=-1)
+
+    return np.sqrt(0.5 * np.mean(np.diff(blocks, axis=-1) ** 2, axis=-1))
+
+
+
+def autocorrelation(samples):
+    """
+    Normalized autocorrelation of each burst for lags 0 to K-1, computed with an FFT.
+
+    Parameters:
+        samples: array like - Samples along the last axis.
+
+    Returns:
+        ndarray: Autocorrelation with the same shape as samples, lag 0 is always 1
+        (or 0 for constant bursts).
+    """
+    samples = np.asarray(samples, dtype=np.float64)
+    num_samples = samples.shape[-1]
+    centered = samples - samples.mean(axis=-1, keepdims=True)
+
+    # Zero pad to twice the length so the circular correlation of the FFT becomes a linear one
+    size = 2 * num_samples
+    spectrum = np.fft.rfft(centered, n=size, axis=-1)
+    correlation = np.fft.irfft(spectrum * np.conj(spectrum), n=size, axis=-1)[..., :num_samples]
+
+    variance = correlation[..., :1]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        normalized = np.where(variance > 0, correlation / variance, 0.0)
+
+    return normalized
+
+
+
+def integrated_autocorrelation_time(samples):
+    """
+    Integrated autocorrelation time tau_int = 1 + 2 * sum(rho_k) in units of the sampling interval.
+    The sum stops at the first lag where the autocorrelation drops to zero or below, past that point
+    the estimate is dominated by noise. Independent samples give tau_int = 1.
+
+    Parameters:
+        samples: array like - Samples along the last axis.
+
+    Returns:
+        ndarray: tau_int for each burst, clipped between 1 and K.
+    """
+    samples = np.asarray(samples, dtype=np.float64)
+    num_samples = samples.shape[-1]
+    rho = autocorrelation(samples)[..., 1:]
+
+    # Mask out every lag after the first non positive one, a cumulative product does it without loops
+    positive_run = np.cumprod(rho > 0, axis=-1)
+    tau_int = 1 + 2 * np.sum(rho * positive_run, axis=-1)
+
+    return np.clip(tau_int, 1, num_samples)
+
+
+
+def autocorrelation_corrected_error(samples):
+    """
+    Standard error of the mean corrected for correlation between samples: the effective number of
+    independent samples is K / tau_int.
+
+    Parameters:
+        samples: array like - Samples along the last axis.
+
+    Returns:
+        ndarray: Corrected standard error for each burst.
+    """
+    samples = np.asarray(samples, dtype=np.float64)
+    return standard_error(samples) * np.sqrt(integrated_autocorrelation_time(samples))
+
+
+
+def estimate_noise(samples):
+    """
+    Computes every estimator at once for a burst or a stack of bursts.
+
+    Parameters:
+        samples: array like - Samples along the last axis.
+
+    Returns:
+        dict: "Mean", "Standard error", "Allan deviation", "Autocorrelation time" and
+        "Corrected error", each an array with the leading shape of samples.
+    """
+    samples = np.asarray(samples, dtype=np.float64)
+    return {
+        "Mean": samples.mean(axis=-1),
+        "Standard error": standard_error(samples),
+        "Allan deviation": allan_deviation(samples),
+        "Autocorrelation time": integrated_autocorrelation_time(samples),
+        "Corrected error": autocorrelation_corrected_error(samples),
+    }
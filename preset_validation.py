@@ -0,0 +1,96 @@
+# Checks experiment parameters against the limits of Utils/validation_rules.json, without any GUI.
+#
+# The launcher checks what's on screen with is_value_valid() and tells the user with a message box,
+# run_experiment.py checks a preset file and prints what's wrong. Both go through check_value() so a
+# preset is accepted by one exactly when it's accepted by the other.
+#
+# Every parameter has a dict of rules:
+#   · "type": "float" parses the value (values typed on screen are strings), other types are taken as they are
+#   · "max_rel"/"min_rel": limits on the value itself
+#   · "max_abs"/"min_abs": limits on absolute delays. The trip legs are given relative to time zero so
+#     time zero is substracted from the limit before comparing (see help file on absolute and relative time)
+# "type" has to come before the limits in the rules dict, the limits compare the parsed value.
+
+
+# Keys every preset needs, the rest have defaults (see create_experiment_gui_from_dict() in the launcher)
+required_keys = ("experiment_name", "time_constant", "roll_off", "error_measurement_type", "autoranging_type",
+                 "time_zero", "num_scans", "trip_legs")
+
+
+def check_value(parameter_name, parameter_value, parameter_rules, time_zero=0.0):
+    """
+    Checks a value against its rules.
+
+    Parameters:
+        parameter_name: str - Only used in the message.
+        parameter_value: Value to check, a string is parsed if the rules give a type.
+        parameter_rules: dict - Rules of the parameter in validation_rules.json, may be empty.
+        time_zero: float - Time zero in ps, for the absolute limits.
+
+    Returns:
+        tuple: (parsed value, None) if the value follows every rule, (None, message saying why not) otherwise.
+    """
+    for rule_type, rule_value in parameter_rules.items():
+
+        if rule_type == "type" and rule_value == "float":
+            try:
+                parameter_value = float(parameter_value)
+            except (TypeError, ValueError):
+                return None, f"Parameter {parameter_name} is not a valid floating point number, please use .  as decimal separator"
+
+        if rule_type == "max_abs" and parameter_value > rule_value - time_zero:
+            return None, f"Parameter {parameter_name} is above maximum limit: {rule_value - time_zero}"
+
+        if rule_type == "min_abs" and parameter_value < rule_value - time_zero:
+            return None, f"Parameter {parameter_name} is below minimum limit: {rule_value - time_zero}"
+
+        if rule_type == "max_rel" and parameter_value > rule_value:
+            return None, f"Parameter {parameter_name} is above maximum limit: {rule_value}"
+
+        if rule_type == "min_rel" and parameter_value < rule_value:
+            return None, f"Parameter {parameter_name} is below minimum limit: {rule_value}"
+
+    return parameter_value, None
+
+
+
+def preset_problems(preset, validation_rules):
+    """
+    Everything wrong with an experiment preset: missing keys, values out of the validation rules and
+    trip legs that don't compile to a scan (see scan_plan.py).
+
+    Parameters:
+        preset: dict - Experiment preset, as saved in Utils/experiment_preset.json.
+        validation_rules: dict - Contents of Utils/validation_rules.json.
+
+    Returns:
+        list of str: One message per problem, empty if the preset can be run.
+    """
+    missing = [key for key in required_keys if key not in preset]
+    if missing:
+        return [f"The preset is missing {', '.join(missing)}"]
+
+    # Time zero first, every absolute limit is relative to it
+    time_zero, problem = check_value("time_zero", preset["time_zero"], validation_rules.get("time_zero", {}))
+    if problem is not None:
+        return [problem]
+
+    problems = []
+    for leg_number, leg_parameters in preset["trip_legs"].items():
+        for parameter_name, value in leg_parameters.items():
+            _, problem = check_value(parameter_name, value, validation_rules.get(parameter_name, {}), time_zero)
+            if problem is not None:
+                problems.append(f"Trip leg {leg_number}: {problem}")
+
+    if int(preset["num_scans"]) < 1:
+        problems.append("The experiment needs at least 1 scan")
+
+    if not problems:
+        # numpy comes with scan_plan, importing it lazily keeps it out of the launcher's startup
+        import scan_plan
+        try:
+            scan_plan.compile_plan(preset["trip_legs"])
+        except ValueError as e:
+            problems.append(f"The trip legs don't make a valid scan: {e}")
+
+    return problems
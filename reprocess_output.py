@@ -0,0 +1,351 @@
+import os
+import re
+import sys
+import json
+import time
+import argparse
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+import scan_statistics
+import acquisition_policy
+
+
+# Batch reprocessing of everything under Output/.
+#
+# Every scan perform_experiment() finishes ends up in Output/<experiment>/scan_number_<n>/<experiment>_scan_number_<n>.csv,
+# starting with a two line parameter header:
+#
+#   # Date: 18h_17min_19d_10m_2026y,Experiment parameters
+#     time zero: 0.0ps,time constant: 1e-06s,Filter slope: 6dB/Oct,Input range:     ·Current Voltage Range: 30 mV
+#
+# (yes, only the first line is commented). This script finds every experiment, reads all of its scans,
+# averages them the way average_scans() used to (every position averaged over the scans that reached it,
+# with the plain mean unless --estimator picks another one from scan_statistics.py) and writes the
+# results to Output/<experiment>/reprocessed/:
+#
+#   <experiment>_average.csv    positions, average, standard error across scans, averaged lockin error
+#   <experiment>_average.npz    same arrays plus every scan, if "npz" is among the --formats
+#   <experiment>_summary.json   parsed headers, scan and point counts and the source files
+#
+# Experiments run in parallel on a process pool. The summary remembers the size and modification time
+# of every CSV it was built from, experiments whose CSVs haven't changed since are skipped (--force to
+# redo them anyway).
+#
+# Run from the project folder:
+#   python reprocess_output.py
+#   python reprocess_output.py Output --workers 4 --formats csv npz --force
+#   python reprocess_output.py --estimator "Sigma-clipped"
+
+
+reprocessed_folder_name = "reprocessed"
+
+scan_file_pattern = re.compile(r"^(?P<experiment>.+)_scan_number_(?P<scan>\d+)\.csv$")
+
+
+def discover_experiments(output_folder):
+    """
+    Finds every experiment under output_folder holding at least one finished scan.
+
+    Returns:
+        dict: experiment name -> list of (scan number, csv path) sorted by scan number.
+    """
+    experiments = {}
+    if not os.path.isdir(output_folder):
+        return experiments
+
+    for experiment_name in sorted(os.listdir(output_folder)):
+        experiment_folder = os.path.join(output_folder, experiment_name)
+        if not os.path.isdir(experiment_folder):
+            continue
+
+        scans = []
+        for scan_folder in os.listdir(experiment_folder):
+            if not scan_folder.startswith("scan_number_"):
+                continue
+
+            for file_name in os.listdir(os.path.join(experiment_folder, scan_folder)):
+                match = scan_file_pattern.match(file_name)
+                if match and match.group("experiment") == experiment_name:
+                    scans.append((int(match.group("scan")), os.path.join(experiment_folder, scan_folder, file_name)))
+
+        if scans:
+            experiments[experiment_name] = sorted(scans)
+
+    return experiments
+
+
+def parse_header(first_line, second_line):
+    """
+    Parses the two parameter lines perform_experiment() writes at the top of every scan CSV.
+
+    Returns:
+        dict with "Date" (ISO format, None if it can't be parsed), "Time zero [ps]", "Time constant [s]",
+        "Filter slope [dB/Oct]" and "Input range". Values that are missing are None.
+    """
+    header = {"Date": None, "Time zero [ps]": None, "Time constant [s]": None, "Filter slope [dB/Oct]": None, "Input range": None}
+
+    date_match = re.search(r"Date:\s*([^,]+)", first_line)
+    if date_match:
+        try:
+            header["Date"] = datetime.strptime(date_match.group(1).strip(), "%Hh_%Mmin_%dd_%mm_%Yy").isoformat()
+        except ValueError:
+            header["Date"] = None
+
+    numbers = {
+        "Time zero [ps]": r"time zero:\s*([-+0-9.eE]+)ps",
+        "Time constant [s]": r"time constant:\s*([-+0-9.eE]+)s",
+        "Filter slope [dB/Oct]": r"Filter slope:\s*([-+0-9.eE]+)dB/Oct",
+    }
+    for key, pattern in numbers.items():
+        match = re.search(pattern, second_line)
+        if match:
+            header[key] = float(match.group(1))
+
+    # The input range is whatever request_range() returned, keep the text
+    range_match = re.search(r"Input range:\s*(.*)$", second_line)
+    if range_match:
+        header["Input range"] = range_match.group(1).strip().lstrip("·").strip()
+
+    return header
+
+
+def read_scan(csv_path):
+    """
+    Reads a scan CSV.
+
+    Returns:
+        header: dict - see parse_header()
+        columns: dict - "Positions", "Signal" and "Signal error" (None if the scan has no error column)
+            as float64 arrays, plus "Signal units" (e.g. "[Vrms]")
+
+    Raises:
+        ValueError: If the CSV has no signal or position column.
+    """
+    # pandas is only needed here, the workers import it on their own
+    import pandas as pd
+
+    with open(csv_path, "r", encoding="utf-8") as file:
+        first_line = file.readline()
+        second_line = file.readline()
+    header = parse_header(first_line, second_line)
+
+    # The pyarrow reader is a lot faster on big files, it's optional though
+    try:
+        import pyarrow
+        engine = "pyarrow"
+    except ImportError:
+        engine = "c"
+    data_df = pd.read_csv(csv_path, skiprows=2, engine=engine)
+
+    # CSVs written by something else (or without the two header lines) may not have the columns we need
+    signal_column = next((column for column in data_df.columns if column.startswith("Signal level")), None)
+    if signal_column is None:
+        raise ValueError(f"{os.path.basename(csv_path)} has no \"Signal level\" column")
+    if "Absolute Time [ps]" not in data_df.columns:
+        raise ValueError(f"{os.path.basename(csv_path)} has no \"Absolute Time [ps]\" column")
+    error_columns = [column for column in data_df.columns if column.startswith("Signal error")]
+    units_match = re.search(r"\[[^\]]*\]$", signal_column)
+
+    columns = {
+        "Positions": data_df["Absolute Time [ps]"].to_numpy(dtype=np.float64),
+        "Signal": data_df[signal_column].to_numpy(dtype=np.float64),
+        "Signal error": data_df[error_columns[0]].to_numpy(dtype=np.float64) if error_columns else None,
+        "Signal units": units_match.group(0) if units_match else "",
+    }
+    return header, columns
+
+
+def source_signature(scans):
+    """
+    Size and modification time of every scan CSV, used to tell whether an experiment changed.
+    """
+    signature = {}
+    for scan_number, csv_path in scans:
+        file_stats = os.stat(csv_path)
+        signature[os.path.basename(csv_path)] = [file_stats.st_size, file_stats.st_mtime]
+    return signature
+
+
+def summary_path(output_folder, experiment_name):
+    return os.path.join(output_folder, experiment_name, reprocessed_folder_name, experiment_name + "_summary.json")
+
+
+def is_up_to_date(output_folder, experiment_name, scans, estimator="Mean"):
+    try:
+        with open(summary_path(output_folder, experiment_name), "r") as json_file:
+            summary = json.load(json_file)
+    except (OSError, ValueError):
+        return False
+
+    return summary.get("Source files") == source_signature(scans) and summary.get("Averaging estimator", "Mean") == estimator
+
+
+def reprocess_experiment(output_folder, experiment_name, scans, formats=("csv",), estimator="Mean"):
+    """
+    Averages all scans of an experiment and writes the results (see module comment). Runs on the
+    process pool, so it only takes and returns plain data.
+
+    Returns:
+        dict with "Experiment", "Scans" (averaged) and "Points".
+    """
+    import pandas as pd
+
+    signature = source_signature(scans)
+
+    headers = {}
+    scan_columns = {}
+    signal_units = ""
+    for scan_number, csv_path in scans:
+        header, columns = read_scan(csv_path)
+        headers[str(scan_number)] = header
+        scan_columns[scan_number] = columns
+        signal_units = columns["Signal units"]
+
+    # Scans are usually the same length, if not the longest one holds every position. Adaptive
+    # experiments (see adaptive_grid.py) measure the pilot scan on a different grid than the rest and
+    # target relative error experiments (see acquisition_policy.py) revisit only some of the positions,
+    # so every scan is matched to the grid by position value and only scans lying on it are averaged
+    def indices_on(grid, scan_positions):
+        indices = acquisition_policy.grid_indices(grid, scan_positions)
+        return indices if np.all(indices >= 0) else None
+
+    positions = scan_columns[scans[-1][0]]["Positions"]
+    for columns in scan_columns.values():
+        if len(columns["Positions"]) > len(positions) and indices_on(columns["Positions"], positions) is not None:
+            positions = columns["Positions"]
+
+    scan_indices = {scan_number: indices_on(positions, columns["Positions"]) for scan_number, columns in scan_columns.items()}
+    averaged_scans = [scan_number for scan_number, indices in scan_indices.items() if indices is not None]
+    other_grid_scans = [scan_number for scan_number in scan_columns if scan_number not in averaged_scans]
+    signals = [scan_columns[scan_number]["Signal"] for scan_number in averaged_scans]
+    signal_errors = [scan_columns[scan_number]["Signal error"] for scan_number in averaged_scans]
+    indices = [scan_indices[scan_number] for scan_number in averaged_scans]
+
+    # Same semantics as the old average_scans(): each position is averaged over the scans that reached it,
+    # with whichever estimator was asked for (see scan_statistics.py)
+    running_average = scan_statistics.create_estimator(estimator, len(positions))
+    for signal, signal_error, scan_index in zip(signals, signal_errors, indices):
+        if np.array_equal(scan_index, np.arange(len(signal))):
+            running_average.update_scan(signal, signal_error)
+            continue
+        for point, grid_index in enumerate(scan_index):
+            running_average.update(grid_index, signal[point], np.nan if signal_error is None else signal_error[point])
+
+    average = np.array(running_average.mean(len(positions)))
+    standard_error = np.array(running_average.standard_error(len(positions)))
+    scans_per_point = np.array(running_average.count[:len(positions)])
+
+    # The lockin errors of independent scans add in quadrature, NaN where a scan has no error column
+    squared_errors = np.zeros(len(positions))
+    for signal_error, scan_index in zip(signal_errors, indices):
+        if signal_error is None:
+            squared_errors[:] = np.nan
+            break
+        squared_errors[scan_index] += signal_error ** 2
+    with np.errstate(invalid="ignore", divide="ignore"):
+        lockin_error = np.sqrt(squared_errors) / scans_per_point
+
+    reprocessed_folder = os.path.join(output_folder, experiment_name, reprocessed_folder_name)
+    os.makedirs(reprocessed_folder, exist_ok=True)
+
+    if "csv" in formats:
+        average_df = pd.DataFrame({
+            "Absolute Time [ps]": positions,
+            "Average signal " + signal_units: average,
+            "Standard error across scans " + signal_units: standard_error,
+            "Averaged lockin error " + signal_units: lockin_error,
+            "Scans averaged": scans_per_point,
+        }, copy=False)
+        average_df.to_csv(os.path.join(reprocessed_folder, experiment_name + "_average.csv"), index=False, lineterminator="\n")
+
+    if "npz" in formats:
+        all_scans = np.full((len(signals), len(positions)), np.nan)
+        for row, (signal, scan_index) in enumerate(zip(signals, indices)):
+            all_scans[row, scan_index] = signal
+        np.savez(os.path.join(reprocessed_folder, experiment_name + "_average.npz"), positions=positions,
+                 average=average, standard_error=standard_error, lockin_error=lockin_error,
+                 scans_per_point=scans_per_point, scans=all_scans)
+
+    # The summary goes last, it's what marks the experiment as processed
+    summary = {
+        "Experiment": experiment_name,
+        "Processed on": datetime.now().isoformat(timespec="seconds"),
+        "Scans": len(scans),
+        "Scans averaged": averaged_scans,
+        "Scans on a different grid": other_grid_scans,
+        "Points": len(positions),
+        "Signal units": signal_units,
+        "Averaging estimator": estimator,
+        "Headers": headers,
+        "Source files": signature,
+    }
+    temporary_path = summary_path(output_folder, experiment_name) + ".tmp"
+    with open(temporary_path, "w") as json_file:
+        json.dump(summary, json_file, indent=4)
+    os.replace(temporary_path, summary_path(output_folder, experiment_name))
+
+    return {"Experiment": experiment_name, "Scans": len(averaged_scans), "Points": len(positions)}
+
+
+def reprocess_output(output_folder, workers=None, formats=("csv",), force=False, estimator="Mean"):
+    """
+    Reprocesses every experiment under output_folder on a process pool, printing progress as they finish.
+
+    Returns:
+        dict with the lists of "Processed", "Skipped" and "Failed" experiment names.
+    """
+    experiments = discover_experiments(output_folder)
+    results = {"Processed": [], "Skipped": [], "Failed": []}
+
+    pending = {}
+    for experiment_name, scans in experiments.items():
+        if not force and is_up_to_date(output_folder, experiment_name, scans, estimator):
+            results["Skipped"].append(experiment_name)
+        else:
+            pending[experiment_name] = scans
+
+    print(f"Found {len(experiments)} experiments in {output_folder}, {len(results['Skipped'])} already processed, {len(pending)} to go")
+    if not pending:
+        return results
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(reprocess_experiment, output_folder, experiment_name, scans, formats, estimator): experiment_name
+                   for experiment_name, scans in pending.items()}
+
+        for finished, future in enumerate(as_completed(futures), start=1):
+            experiment_name = futures[future]
+            try:
+                result = future.result()
+                results["Processed"].append(experiment_name)
+                status = f"{result['Scans']} scans x {result['Points']} points"
+            except Exception as e:
+                results["Failed"].append(experiment_name)
+                status = f"failed: {e}"
+
+            elapsed = time.perf_counter() - start
+            print(f"    ·[{finished}/{len(pending)}] {experiment_name}: {status} ({elapsed:.1f}s elapsed)")
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-average every experiment under Output/ and write summary files")
+    parser.add_argument("output_folder", nargs="?", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "Output"))
+    parser.add_argument("--workers", type=int, default=None, help="Processes to use, defaults to one per CPU")
+    parser.add_argument("--formats", nargs="+", default=["csv"], choices=["csv", "npz"])
+    parser.add_argument("--force", action="store_true", help="Reprocess experiments even if nothing changed")
+    parser.add_argument("--estimator", default="Mean", choices=list(scan_statistics.estimators), help="How scans are averaged")
+    args = parser.parse_args()
+
+    results = reprocess_output(args.output_folder, args.workers, tuple(args.formats), args.force, args.estimator)
+    print(f"Processed {len(results['Processed'])}, skipped {len(results['Skipped'])}, failed {len(results['Failed'])}")
+    if results["Failed"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
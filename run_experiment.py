@@ -0,0 +1,346 @@
+import os
+import sys
+import json
+import time
+import queue
+import datetime
+import argparse
+import threading
+import numpy as np
+
+import log_view
+import preset_validation
+import core_logic
+import scan_plan
+import scan_store
+import scan_statistics
+import acquisition_policy
+import checkpoint
+
+
+# Runs an experiment preset without the GUI, e.g. from a script or over SSH.
+#
+# The launcher reads the parameters from its entries and runs the experiment behind the monitoring
+# window. This does the same from a preset file (Utils/experiment_preset.json by default, the one
+# "Save parameters" writes):
+#   1. The preset is checked against Utils/validation_rules.json (see preset_validation.py) before
+#      anything moves, and the stage speed of Utils/default_config.json like the initialize button does
+#   2. The devices are initialized with core_logic.initialization()
+#   3. The scans run through core_logic.perform_experiment() with the acquisition policy of the preset,
+#      exactly as the launcher runs them, so the Output/<experiment> folder ends up the same: the scan
+#      CSVs, the images (rendered by snapshot_renderer.py, no window involved), the binary container,
+#      checkpoints and experiment.log
+#
+# What perform_experiment() prints goes to experiment.log, and to the terminal from --log-level up,
+# together with a progress line with the finishing time every progress_every_s seconds.
+# Ctrl+C stops the experiment after the current point, like the "Stop experiment early" button, and
+# the experiment can be resumed with --resume. A second Ctrl+C quits straight away.
+#
+# Run from the project folder:
+#   python run_experiment.py
+#   python run_experiment.py Utils/my_preset.json --log-level Detail
+#   python run_experiment.py Utils/my_preset.json --resume --image-format svg
+
+
+# Seconds between progress lines on the terminal
+progress_every_s = 10
+
+
+def load_json(file_path):
+    try:
+        with open(file_path, "r") as json_file:
+            return json.load(json_file)
+    except Exception as e:
+        raise Exception(f"An error occured when opening {file_path}\n{e}")
+
+
+
+def device_config_problems(default_config, validation_rules):
+    """
+    Stage speed of Utils/default_config.json out of the validation rules, as checked by the initialize button.
+    """
+    problems = []
+    for parameter_name in ("Acceleration_mm_per_s2", "MaxVelocity_mm_per_s"):
+        _, problem = preset_validation.check_value(parameter_name, default_config["Delay Stage Default Config Params"][parameter_name],
+                                                   validation_rules.get(parameter_name, {}))
+        if problem is not None:
+            problems.append(f"Delay stage config: {problem}")
+    return problems
+
+
+
+def run_experiment(parameters_dict, experiment_data_queue, abort_queue, renderer=None, resume_checkpoint=None, scan_store_directory=None):
+    """
+    Runs every scan of an experiment on initialized devices, what experiment_thread_logic() does for
+    the launcher. Blocks until the experiment is over.
+
+    Parameters:
+        parameters_dict: dict - Validated experiment preset.
+        experiment_data_queue: queue.Queue - Gets the "Scan start" and "Point" packets of perform_experiment().
+        abort_queue: queue.Queue - Put True on it to stop after the current point.
+        renderer: SnapshotRenderer or None - Renders the scan images, None for no images.
+        resume_checkpoint: dict or None - Checkpoint to pick the experiment up from (see checkpoint.py).
+        scan_store_directory: str or None - Folder to keep the scans in, see scan_store.py.
+
+    Returns:
+        str or None: Why the acquisition policy stopped, None if the experiment was aborted.
+    """
+    output_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Output")
+
+    # Same as launch_experiment(): empty store and average, or the scans measured before an interruption
+    plan = scan_plan.compile_plan(parameters_dict["trip_legs"])
+    Scan_store = scan_store.ScanStore(scan_store_directory)
+    Running_average = scan_statistics.create_estimator(parameters_dict.get("averaging_estimator", "Mean"))
+    if resume_checkpoint is not None:
+        plan = checkpoint.restore_checkpoint(resume_checkpoint, Scan_store, Running_average)
+
+    if renderer is not None:
+        renderer.start_experiment()
+
+    policy = acquisition_policy.create_policy(parameters_dict)
+    experiment_start = checkpoint.experiment_start(resume_checkpoint)
+    num_scans = int(parameters_dict["num_scans"])
+    error_measurement_type = str(parameters_dict["error_measurement_type"])
+    autoranging_type = str(parameters_dict["autoranging_type"])
+
+    try:
+        for scan, position_indices, start_index in checkpoint.resumed_passes(policy, Running_average, resume_checkpoint, experiment_start):
+
+            abort_queue.put(False)  # before we start the scan we reset the abort flag to false
+            result = core_logic.perform_experiment(parameters_dict,
+                                                   experiment_data_queue,
+                                                   abort_queue,
+                                                   renderer,
+                                                   scan,
+                                                   num_scans,
+                                                   error_measurement_type,
+                                                   autoranging_type,
+                                                   Scan_store,
+                                                   Running_average,
+                                                   position_indices,
+                                                   plan,
+                                                   start_index,
+                                                   resume_checkpoint,
+                                                   experiment_start)
+
+            # Aborted, the checkpoint stays to resume it
+            if isinstance(result, int):
+                return None
+
+        print(policy.stop_reason)
+
+        # Nothing left to resume
+        checkpoint.clear_checkpoint(checkpoint.checkpoint_folder(output_folder, parameters_dict["experiment_name"]))
+        return policy.stop_reason
+
+    finally:
+        # Images still rendering, or all of them if they wait for the end of the experiment
+        if renderer is not None:
+            renderer.finish()
+
+
+
+class Progress:
+    """
+    Follows the packets of perform_experiment() to tell how far the experiment is and when it should finish.
+    The finishing time extrapolates the pace of the points measured so far, in the target relative error
+    acquisition mode it's when the last pass allowed would finish.
+
+    Parameters:
+        num_scans: int - Scans (or passes at most) of the experiment.
+    """
+
+    def __init__(self, num_scans):
+        self.num_scans = num_scans
+        self.scan = 0
+        self.points_in_scan = 0
+        self.points_measured = 0
+        self.start_timestamp = time.time()
+        self.start_fraction = None
+        self.fraction = 0.0
+
+
+    def update(self, packet):
+        if packet["Packet type"] == "Scan start":
+            self.scan = packet["Scan number"]
+            self.points_in_scan = len(packet["Positions"])
+            self.points_measured = int(np.count_nonzero(~np.isnan(packet["Scan data"])))  # Resumed scans start with some
+        else:
+            self.points_measured = packet["Index"] + 1
+
+        if self.points_in_scan > 0:
+            self.fraction = (self.scan + self.points_measured / self.points_in_scan) / self.num_scans
+
+        # A resumed experiment doesn't start from 0, only what's measured here tells the pace
+        if self.start_fraction is None:
+            self.start_fraction = self.fraction
+            self.start_timestamp = time.time()
+
+
+    def remaining_s(self):
+        """
+        Seconds left at the pace so far, None until a point was measured.
+        """
+        if self.start_fraction is None or self.fraction <= self.start_fraction:
+            return None
+        elapsed = time.time() - self.start_timestamp
+        return elapsed * (1 - self.fraction) / (self.fraction - self.start_fraction)
+
+
+    def message(self):
+        if self.points_in_scan == 0:
+            return ""  # Nothing measured yet
+        message = f"Progress: scan {self.scan}/{self.num_scans}, point {self.points_measured}/{self.points_in_scan} ({round(100 * self.fraction)}%)"
+        remaining = self.remaining_s()
+        if remaining is not None:
+            finishing_time = datetime.datetime.now() + datetime.timedelta(seconds=remaining)
+            message += f", finishing at around {finishing_time.strftime('%d/%m/%Y %H:%M')}"
+        return message
+
+
+
+def stream_experiment(experiment_thread, experiment_data_queue, experiment_log, level, progress, abort):
+    """
+    Shows the log lines from level up and the progress on the terminal until the experiment thread is
+    over. The log has to capture the prints (see log_view.py), the terminal is written through sys.__stdout__.
+
+    Parameters:
+        progress: Progress - Or anything else with its update(packet) and message() methods.
+        abort: callable - Stops the experiment, called on Ctrl+C.
+
+    Returns:
+        bool: True if the experiment was stopped with Ctrl+C.
+    """
+    shown_levels = log_view.log_levels[log_view.log_levels.index(level):]
+    aborted = False
+    last_progress_timestamp = time.time()
+
+    while True:
+        try:
+            finished = not experiment_thread.is_alive()
+
+            # Packets only feed the progress, the CSVs and images are written by the experiment thread
+            try:
+                progress.update(experiment_data_queue.get(timeout=0.1))
+                while True:
+                    progress.update(experiment_data_queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            message = progress.message()
+            if time.time() - last_progress_timestamp >= progress_every_s and message:
+                # Straight to the terminal, print() would end up in experiment.log as Info and be hidden by --log-level
+                sys.__stdout__.write(message + "\n")
+                last_progress_timestamp = time.time()
+
+            for line_level, text in experiment_log.drain():
+                if line_level in shown_levels:
+                    sys.__stdout__.write(text + "\n")
+            sys.__stdout__.flush()
+
+            if finished:
+                return aborted
+
+        except KeyboardInterrupt:
+            if aborted:
+                raise
+            aborted = True
+            sys.__stdout__.write("Stopping experiment after the current point, press Ctrl+C again to quit right away\n")
+            sys.__stdout__.flush()
+            abort()
+
+
+
+def main():
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+
+    parser = argparse.ArgumentParser(description="Run an experiment preset without the GUI")
+    parser.add_argument("preset", nargs="?", default=os.path.join(current_dir, "Utils", "experiment_preset.json"), help="Experiment preset to run")
+    parser.add_argument("--rules", default=os.path.join(current_dir, "Utils", "validation_rules.json"), help="Validation rules the preset is checked against")
+    parser.add_argument("--resume", action="store_true", help="Resume the experiment if it was interrupted")
+    parser.add_argument("--log-level", default="Info", choices=log_view.log_levels, help="Lowest level of the log lines shown on the terminal")
+    parser.add_argument("--image-format", default="png", help="Format of the scan images, any format matplotlib saves")
+    parser.add_argument("--dpi", type=int, default=300, help="Resolution of the scan images")
+    parser.add_argument("--no-images", action="store_true", help="Don't save scan images")
+    parser.add_argument("--defer-images", action="store_true", help="Render the scan images at the end of the experiment")
+    parser.add_argument("--troubleshooting", action="store_true", help="Verbose device initialization")
+    args = parser.parse_args()
+
+    ### Validate everything before the devices move
+    experiment_parameters = load_json(args.preset)
+    validation_rules = load_json(args.rules)
+    default_config = load_json(os.path.join(current_dir, "Utils", "default_config.json"))
+
+    problems = preset_validation.preset_problems(experiment_parameters, validation_rules) + device_config_problems(default_config, validation_rules)
+    if problems:
+        print(f"{args.preset} can't be run:")
+        for problem in problems:
+            print(f"    ·{problem}")
+        sys.exit(1)
+
+    # An existing folder is only used again to resume the experiment it holds
+    output_folder = os.path.join(current_dir, "Output")
+    experiment_name = experiment_parameters["experiment_name"]
+    resume_checkpoint = None
+    if os.path.exists(os.path.join(output_folder, experiment_name)):
+        resume_checkpoint = checkpoint.load_checkpoint(checkpoint.checkpoint_folder(output_folder, experiment_name))
+        if resume_checkpoint is None:
+            print(f"Output/{experiment_name} already exists, running the experiment would overwrite its data. Please change experiment name")
+            sys.exit(1)
+        if not args.resume:
+            print(f"Output/{experiment_name} was interrupted at scan {resume_checkpoint['Current scan']} after {resume_checkpoint['Points measured']} "
+                  f"of its points (saved on {resume_checkpoint['Saved on']}). Run again with --resume to resume it or change experiment name")
+            sys.exit(1)
+
+        # The experiment goes on with its own parameters, whatever the preset says now
+        experiment_parameters = resume_checkpoint["Experiment parameters"]
+        print(f"Resuming {experiment_name} at scan {resume_checkpoint['Current scan']}")
+
+    ### Devices
+    core_logic.initialization(Troubleshooting=args.troubleshooting)
+
+    renderer = None
+    if not args.no_images:
+        # matplotlib is only needed for the images
+        import snapshot_renderer
+        renderer = snapshot_renderer.SnapshotRenderer(args.image_format, args.dpi, args.defer_images)
+
+    ### Experiment
+    experiment_data_queue = queue.Queue()
+    abort_queue = queue.Queue()
+    experiment_log = log_view.ExperimentLog(os.path.join(output_folder, experiment_name, log_view.log_file_name))
+    progress = Progress(int(experiment_parameters["num_scans"]))
+
+    # Exceptions dont propagate upwards from threads, the experiment thread leaves them here
+    outcome = {"Stop reason": None, "Error": None}
+    def experiment_thread_logic():
+        try:
+            outcome["Stop reason"] = run_experiment(experiment_parameters, experiment_data_queue, abort_queue, renderer, resume_checkpoint)
+        except Exception as e:
+            outcome["Error"] = e
+
+    experiment_log.capture_output()
+    try:
+        experiment_thread = threading.Thread(target=experiment_thread_logic, daemon=True)
+        experiment_thread.start()
+        aborted = stream_experiment(experiment_thread, experiment_data_queue, experiment_log, args.log_level, progress, lambda: abort_queue.put(True))
+    finally:
+        sys.stdout = sys.__stdout__
+        sys.stderr = sys.__stderr__
+        experiment_log.close()
+
+    if outcome["Error"] is not None:
+        print(f"An error occured during the experiment:\n{outcome['Error']}")
+        if checkpoint.load_checkpoint(checkpoint.checkpoint_folder(output_folder, experiment_name)) is not None:
+            print(f"Run again with --resume to resume it from its last checkpoint")
+        sys.exit(1)
+
+    if aborted or outcome["Stop reason"] is None:
+        print(f"Experiment stopped early, run again with --resume to resume it")
+        sys.exit(130)
+
+    print(f"Experiment completed, data is in Output/{experiment_name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+import numpy as np
+
+import core_logic_functions as clfun
+
+
+# Scan plan: the delay positions an experiment measures, compiled once from the trip legs.
+#
+# The positions used to be built in perform_experiment() by adding the step over and over in a while
+# loop, which drifts after a few thousand steps (0.1 added ten times isn't 1.0) and could then add the
+# end position a second time right next to the last step. Legs that overlap measured the shared
+# positions twice, and estimate_experiment_timespan() counted the points on its own with ceil(), which
+# didn't always agree with what was measured.
+#
+# compile_plan() turns the trip legs into a ScanPlan once: every leg is generated as start + i * step
+# in one go, rounded to a fixed number of decimals, positions repeated across legs are dropped (the
+# first leg that reaches them keeps them) and the legs are checked on the way. The engine, the time
+# estimate, the conversion to stage positions and the GUI preview all read the same plan.
+
+
+# Positions are rounded to this many decimals of a ps, way below the smallest stage step (6.68E-4ps)
+position_decimals = 9
+
+
+
+class ScanPlan:
+    """
+    Read only positions of an experiment, see compile_plan().
+
+    Attributes:
+        positions: float64 array - Delay positions in ps relative to time zero, in measuring order.
+        leg_numbers: int array - Trip leg every position comes from.
+        points_per_leg: dict - Leg number: number of positions it adds (after removing repeated ones).
+        duplicates_removed: int - Positions dropped because an earlier leg already measures them.
+    """
+
+    def __init__(self, positions, leg_numbers, points_per_leg, duplicates_removed):
+        positions = np.array(positions, dtype=np.float64)
+        leg_numbers = np.array(leg_numbers, dtype=np.int64)
+        positions.flags.writeable = False
+        leg_numbers.flags.writeable = False
+
+        self._positions = positions
+        self._leg_numbers = leg_numbers
+        self._points_per_leg = dict(points_per_leg)
+        self._duplicates_removed = int(duplicates_removed)
+
+
+    @property
+    def positions(self):
+        return self._positions
+
+
+    @property
+    def leg_numbers(self):
+        return self._leg_numbers
+
+
+    @property
+    def points_per_leg(self):
+        return dict(self._points_per_leg)
+
+
+    @property
+    def duplicates_removed(self):
+        return self._duplicates_removed
+
+
+    def __len__(self):
+        return len(self._positions)
+
+
+    def stage_positions_mm(self, time_zero):
+        """
+        Stage position in mm for every point, the same conversion move_to_position() applies before
+        handing the position to the stage in device units.
+        """
+        return clfun.delay_ps_to_stage_mm(self._positions + time_zero)
+
+
+    def summary(self):
+        """
+        One line description for the GUI and the log.
+        """
+        message = f"{len(self)} points"
+        if len(self) > 0:
+            message += f" from {self._positions.min()}ps to {self._positions.max()}ps"
+        if self._duplicates_removed > 0:
+            message += f", {self._duplicates_removed} repeated positions removed"
+        return message
+
+
+
+def leg_positions(start_position, end_position, step_size):
+    """
+    Positions of a single trip leg, start + i * step up to the end position, which is always included.
+
+    Raises:
+        ValueError: If the leg goes backwards, the step isn't positive or a value isn't a number.
+    """
+    if not all(np.isfinite([start_position, end_position, step_size])):
+        raise ValueError("start, end and step must be numbers")
+    if step_size <= 0:
+        raise ValueError(f"step must be positive, got {step_size}ps")
+    if end_position < start_position:
+        raise ValueError(f"end ({end_position}ps) is before start ({start_position}ps)")
+
+    # The small tolerance keeps (end - start) / step = 9.999999999 from losing the last step
+    num_steps = int(np.floor((end_position - start_position) / step_size + 1e-9))
+    positions = np.round(start_position + np.arange(num_steps + 1) * step_size, position_decimals)
+
+    # Add the end position unless the last step already landed on it
+    end_position = round(end_position, position_decimals)
+    if positions[-1] < end_position:
+        positions = np.append(positions, end_position)
+    else:
+        positions[-1] = end_position
+
+    return positions
+
+
+
+def compile_plan(trip_legs):
+    """
+    Builds the ScanPlan for a trip legs dict, as found in the experiment presets.
+
+    Parameters:
+        trip_legs: dict - Leg number: {"abs time start [ps]", "abs time end [ps]", "step [ps]"}.
+
+    Returns:
+        ScanPlan
+
+    Raises:
+        ValueError: If there are no legs or a leg is not valid, the message says which one.
+    """
+    if len(trip_legs) == 0:
+        raise ValueError("The experiment has no trip legs")
+
+    all_positions = []
+    all_leg_numbers = []
+    for leg_number, leg_parameters in trip_legs.items():
+        try:
+            positions = leg_positions(float(leg_parameters["abs time start [ps]"]),
+                                      float(leg_parameters["abs time end [ps]"]),
+                                      float(leg_parameters["step [ps]"]))
+        except ValueError as e:
+            raise ValueError(f"Trip leg {leg_number}: {e}")
+
+        all_positions.append(positions)
+        all_leg_numbers.append(np.full(len(positions), int(leg_number)))
+
+    positions = np.concatenate(all_positions)
+    leg_numbers = np.concatenate(all_leg_numbers)
+
+    # Positions are already rounded, so repeated ones compare equal. np.unique gives the first time
+    # each one shows up, sorting those keeps the measuring order of the legs
+    _, first_index = np.unique(positions, return_index=True)
+    first_index = np.sort(first_index)
+    duplicates_removed = len(positions) - len(first_index)
+
+    positions = positions[first_index]
+    leg_numbers = leg_numbers[first_index]
+    points_per_leg = {leg_number: int(np.count_nonzero(leg_numbers == int(leg_number))) for leg_number in trip_legs}
+
+    return ScanPlan(positions, leg_numbers, points_per_leg, duplicates_removed)
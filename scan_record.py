@@ -0,0 +1,137 @@
+import numpy as np
+
+
+# Container for the data of a single scan.
+#
+# perform_experiment() used to grow Python lists point by point and copy them into every data packet.
+# A ScanRecord preallocates float64 arrays for the whole scan as soon as we know how many positions
+# it has and fills them through a cursor. Every slot is written exactly once, so a view of the measured
+# part ([:cursor]) never changes after it's taken: the GUI, the averaging and the CSV export can all
+# read views of these arrays instead of copies.
+
+
+class ScanRecord:
+    """
+    Preallocated arrays holding one scan.
+
+    Parameters:
+        positions: array like - Scan positions in ps relative to time zero.
+        scan_number: int - Index of the scan in the experiment.
+        position_error: float - On axis error of the stage in ps, the same for every point.
+        data, errors: float64 arrays or None - Buffers to write the scan into instead of allocating new
+            ones, e.g. a row of a ScanStore (see scan_store.py). They are reset to NaN.
+
+    Attributes:
+        positions, data, errors, position_errors, stage_readbacks, timestamps: float64 arrays of
+            length len(positions), unmeasured points are NaN. stage_readbacks is where the stage
+            reported it ended up (relative to time zero) and timestamps are seconds since the epoch.
+        timings: dict mapping each profiling step to a float64 array of durations in seconds.
+        peak_memory: float64 array - Peak memory of the process in bytes after each point (profiling).
+        cursor: int - Number of points measured so far.
+    """
+
+    # Steps of the scanning loop we profile, see perform_experiment()
+    timing_steps = ("Moving", "Settling", "Autoscaling", "Autoranging", "Capturing", "Estimating", "Total")
+
+    def __init__(self, positions, scan_number=0, position_error=0.0, data=None, errors=None):
+        self.positions = np.array(positions, dtype=np.float64)
+        self.positions.flags.writeable = False
+        self.scan_number = scan_number
+
+        num_positions = len(self.positions)
+        self.data = self._buffer(data, num_positions)
+        self.errors = self._buffer(errors, num_positions)
+        self.position_errors = np.full(num_positions, position_error, dtype=np.float64)
+        self.stage_readbacks = np.full(num_positions, np.nan)
+        self.timestamps = np.full(num_positions, np.nan)
+        self.timings = {step: np.full(num_positions, np.nan) for step in self.timing_steps}
+        self.peak_memory = np.full(num_positions, np.nan)
+        self.cursor = 0
+
+
+    @staticmethod
+    def _buffer(buffer, num_positions):
+        if buffer is None:
+            return np.full(num_positions, np.nan)
+
+        if len(buffer) != num_positions:
+            raise ValueError(f"Buffer holds {len(buffer)} points but the scan has {num_positions} positions")
+        buffer[:] = np.nan
+        return buffer
+
+
+    def __len__(self):
+        return len(self.positions)
+
+
+    @property
+    def is_complete(self):
+        return self.cursor == len(self.positions)
+
+
+    def append(self, value, error=np.nan, stage_readback=np.nan, timestamp=np.nan):
+        """
+        Stores the measurement for the next position and returns its index.
+        """
+        if self.cursor >= len(self.positions):
+            raise IndexError(f"Scan {self.scan_number} already holds all of its {len(self.positions)} points")
+
+        index = self.cursor
+        self.data[index] = value
+        self.errors[index] = error
+        self.stage_readbacks[index] = stage_readback
+        self.timestamps[index] = timestamp
+        self.cursor += 1
+        return index
+
+
+    def resume(self, data, errors, stage_readbacks=np.nan, timestamps=np.nan):
+        """
+        Puts back the first points of a scan that was interrupted (see checkpoint.py), the next append()
+        goes right after them.
+        """
+        num_points = len(data)
+        self.data[:num_points] = data
+        self.errors[:num_points] = errors
+        self.stage_readbacks[:num_points] = stage_readbacks
+        self.timestamps[:num_points] = timestamps
+        self.cursor = num_points
+
+
+    def record_timing(self, index, step, seconds):
+        self.timings[step][index] = seconds
+
+
+    def record_peak_memory(self, index, peak_bytes):
+        self.peak_memory[index] = peak_bytes
+
+
+    def mean_timing(self, step):
+        """
+        Average duration of a profiling step over the measured points, NaN if it was never recorded.
+        """
+        durations = self.timings[step][:self.cursor]
+        if np.all(np.isnan(durations)):
+            return np.nan
+        return float(np.nanmean(durations))
+
+
+    # --- Views of the measured part, no copies ---
+    @property
+    def measured_positions(self):
+        return self.positions[:self.cursor]
+
+
+    @property
+    def measured_data(self):
+        return self.data[:self.cursor]
+
+
+    @property
+    def measured_errors(self):
+        return self.errors[:self.cursor]
+
+
+    @property
+    def measured_position_errors(self):
+        return self.position_errors[:self.cursor]
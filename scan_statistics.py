@@ -0,0 +1,541 @@
+import bisect
+import numpy as np
+
+
+# Statistics accumulated over the scans of an experiment, point by point.
+#
+# The live average used to be recomputed from scratch after every point by average_scans(), which
+# converted every completed scan to an array and summed them, O(scans x points) work per point.
+# RunningAverage keeps a running sum per position instead (Welford's algorithm, which also gives us the
+# variance without the cancellation problems of summing squares) so each new point costs O(1).
+#
+# The semantics match the old average_scans(): positions the current scan has already measured are
+# averaged over all scans including the current one, positions it hasn't reached yet are averaged
+# over the completed scans only. That falls out naturally from keeping a count per position.
+#
+# A plain mean lets a single glitchy scan (laser dropout...) drag the whole average, so there are a few
+# other estimators with the same interface, selected with "averaging_estimator" in the experiment preset:
+#
+#   · "Mean"                       RunningAverage, the plain mean
+#   · "Inverse-variance weighted"  WeightedAverage, points weighted by 1/error^2 using the lockin errors
+#   · "Sigma-clipped"              SigmaClippedAverage, mean of the values close to the median
+#   · "Median of means"            MedianOfMeans, median of the means of a few groups of scans
+#
+# They all keep the Welford statistics of RunningAverage (count, variance) and cache their estimate per
+# position, so reading the live average never recomputes anything and adding a point only updates the
+# estimate at that position.
+
+
+class RunningAverage:
+    """
+    Per position running mean and variance over scans.
+
+    Parameters:
+        num_positions: int - Number of positions to preallocate for, more are added on demand.
+
+    Usage:
+        running_average = RunningAverage(len(Positions))
+        running_average.update(index, value)   # after every point
+        running_average.mean()                 # live average, an array view
+    """
+
+    name = "Mean"
+
+    def __init__(self, num_positions=0):
+        self.count = np.zeros(num_positions, dtype=np.int64)
+        self._mean = np.zeros(num_positions, dtype=np.float64)
+        self._M2 = np.zeros(num_positions, dtype=np.float64)
+
+
+    def __len__(self):
+        return len(self.count)
+
+
+    def reserve(self, num_positions):
+        """
+        Makes sure there is room for num_positions, keeps whatever was accumulated so far.
+        """
+        missing = num_positions - len(self.count)
+        if missing > 0:
+            self.count = np.concatenate([self.count, np.zeros(missing, dtype=np.int64)])
+            self._mean = np.concatenate([self._mean, np.zeros(missing, dtype=np.float64)])
+            self._M2 = np.concatenate([self._M2, np.zeros(missing, dtype=np.float64)])
+
+
+    def reset(self):
+        self.count[:] = 0
+        self._mean[:] = 0.0
+        self._M2[:] = 0.0
+
+
+    def update(self, index, value, error=np.nan):
+        """
+        Adds a new measurement at position index. O(1). The error is only used by WeightedAverage.
+        """
+        if index >= len(self.count):
+            # Grow geometrically so repeated growth stays amortized O(1)
+            self.reserve(max(index + 1, 2 * len(self.count)))
+
+        self.count[index] += 1
+        delta = value - self._mean[index]
+        self._mean[index] += delta / self.count[index]
+        self._M2[index] += delta * (value - self._mean[index])
+
+
+    def update_scan(self, values, errors=None):
+        """
+        Adds a whole scan at once, vectorized. Equivalent to calling update() for every point.
+        """
+        values = np.asarray(values, dtype=np.float64)
+        num_values = len(values)
+        self.reserve(num_values)
+
+        self.count[:num_values] += 1
+        delta = values - self._mean[:num_values]
+        self._mean[:num_values] += delta / self.count[:num_values]
+        self._M2[:num_values] += delta * (values - self._mean[:num_values])
+
+
+    def mean(self, stop=None):
+        """
+        Running mean for positions [0, stop), returned as a read only view (no copy).
+        """
+        view = self._mean[:stop]
+        view.flags.writeable = False
+        return view
+
+
+    def variance(self, stop=None):
+        """
+        Sample variance across scans for positions [0, stop), NaN where there are less than 2 scans.
+        """
+        count = self.count[:stop]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(count > 1, self._M2[:stop] / (count - 1), np.nan)
+
+
+    def standard_error(self, stop=None):
+        """
+        Standard error of the running mean for positions [0, stop).
+        """
+        with np.errstate(invalid="ignore"):
+            return np.sqrt(self.variance(stop) / self.count[:stop])
+
+
+
+class WeightedAverage(RunningAverage):
+    """
+    Inverse-variance weighted mean per position: every point is weighted by 1/error^2 so noisy points
+    (and noisy scans) count less. O(1) per point.
+
+    Points without a usable error (NaN or 0, e.g. error_measurement_type "Never") get the average weight
+    of the points already at that position, or 1 if there are none, so without errors this is the plain
+    mean.
+    """
+
+    name = "Inverse-variance weighted"
+
+    def __init__(self, num_positions=0):
+        super().__init__(num_positions)
+        self._sum_weights = np.zeros(num_positions, dtype=np.float64)
+        self._sum_weighted_values = np.zeros(num_positions, dtype=np.float64)
+        self._estimate = np.zeros(num_positions, dtype=np.float64)
+        self._unweighted_count = np.zeros(num_positions, dtype=np.int64)
+
+
+    def reserve(self, num_positions):
+        missing = num_positions - len(self.count)
+        super().reserve(num_positions)
+        if missing > 0:
+            self._sum_weights = np.concatenate([self._sum_weights, np.zeros(missing)])
+            self._sum_weighted_values = np.concatenate([self._sum_weighted_values, np.zeros(missing)])
+            self._estimate = np.concatenate([self._estimate, np.zeros(missing)])
+            self._unweighted_count = np.concatenate([self._unweighted_count, np.zeros(missing, dtype=np.int64)])
+
+
+    def reset(self):
+        super().reset()
+        self._sum_weights[:] = 0.0
+        self._sum_weighted_values[:] = 0.0
+        self._estimate[:] = 0.0
+        self._unweighted_count[:] = 0
+
+
+    def _weights(self, index, errors):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            weights = 1.0 / np.asarray(errors, dtype=np.float64) ** 2
+            fallback = np.where(self.count[index] > 0, self._sum_weights[index] / np.maximum(self.count[index], 1), 1.0)
+        usable = np.isfinite(weights) & (weights > 0)
+        return np.where(usable, weights, fallback), ~usable
+
+
+    def update(self, index, value, error=np.nan):
+        if index >= len(self.count):
+            self.reserve(max(index + 1, 2 * len(self.count)))
+
+        weight, unweighted = self._weights(index, error)
+        self._sum_weights[index] += weight
+        self._sum_weighted_values[index] += weight * value
+        self._unweighted_count[index] += int(unweighted)
+        self._estimate[index] = self._sum_weighted_values[index] / self._sum_weights[index]
+        super().update(index, value)
+
+
+    def update_scan(self, values, errors=None):
+        values = np.asarray(values, dtype=np.float64)
+        num_values = len(values)
+        self.reserve(num_values)
+        if errors is None:
+            errors = np.full(num_values, np.nan)
+
+        positions = np.arange(num_values)
+        weights, unweighted = self._weights(positions, errors[:num_values])
+        self._sum_weights[:num_values] += weights
+        self._sum_weighted_values[:num_values] += weights * values
+        self._unweighted_count[:num_values] += unweighted
+        self._estimate[:num_values] = self._sum_weighted_values[:num_values] / self._sum_weights[:num_values]
+        super().update_scan(values)
+
+
+    def mean(self, stop=None):
+        view = self._estimate[:stop]
+        view.flags.writeable = False
+        return view
+
+
+    def standard_error(self, stop=None):
+        """
+        1/sqrt(sum of weights) where every point had an error, the scatter based error otherwise.
+        """
+        with np.errstate(divide="ignore"):
+            weighted_error = 1.0 / np.sqrt(self._sum_weights[:stop])
+        return np.where(self._unweighted_count[:stop] == 0, weighted_error, super().standard_error(stop))
+
+
+
+class _SortedValues:
+    """
+    Values of one position kept sorted, with the sum and the sum of squares of any range of ranks in
+    O(log n). Used by SigmaClippedAverage, whose kept values are always a range of ranks.
+
+    The values are split into sorted blocks of block_size to 2 * block_size values, like a B-tree with
+    a single level. Fenwick trees indexed by block hold the count, sum and sum of squares of the blocks
+    before each one, so a prefix of ranks is a Fenwick query plus the part of a single block. Inserting
+    updates one block and the three trees, a block that grows too big is split in two and the trees are
+    rebuilt from the block totals, which happens once every block_size insertions.
+
+    Summing squares loses precision when the values are far from zero compared to their spread (see the
+    top of the file), so everything is stored relative to the first value, close to where they all are.
+    """
+
+    block_size = 32
+
+    def __init__(self):
+        self._offset = None
+        self._blocks = []
+        self._block_sums = []
+        self._block_squares = []
+        self._maxes = []
+        self._counts = []
+        self._sums = []
+        self._squares = []
+        self._length = 0
+
+
+    def __len__(self):
+        return self._length
+
+
+    @staticmethod
+    def _fenwick_build(values):
+        tree = [0] + list(values)
+        for node in range(1, len(tree)):
+            parent = node + (node & -node)
+            if parent < len(tree):
+                tree[parent] += tree[node]
+        return tree
+
+
+    @staticmethod
+    def _fenwick_add(tree, block, delta):
+        node = block + 1
+        while node < len(tree):
+            tree[node] += delta
+            node += node & -node
+
+
+    @staticmethod
+    def _fenwick_prefix(tree, block):
+        # Total of the blocks before block
+        total = 0
+        node = block
+        while node > 0:
+            total += tree[node]
+            node -= node & -node
+        return total
+
+
+    def _rebuild(self):
+        self._maxes = [block[-1] for block in self._blocks]
+        self._counts = self._fenwick_build(len(block) for block in self._blocks)
+        self._sums = self._fenwick_build(self._block_sums)
+        self._squares = self._fenwick_build(self._block_squares)
+
+
+    def _locate(self, rank):
+        # Block holding the value of that rank and its position in the block, by descending the count tree
+        block = 0
+        step = 1 << (len(self._counts) - 1).bit_length()
+        while step > 0:
+            node = block + step
+            if node < len(self._counts) and self._counts[node] <= rank:
+                block = node
+                rank -= self._counts[node]
+            step >>= 1
+        return block, rank
+
+
+    def add(self, value):
+        if self._offset is None:
+            self._offset = value
+        value = value - self._offset
+        self._length += 1
+
+        if not self._blocks:
+            self._blocks.append([value])
+            self._block_sums.append(value)
+            self._block_squares.append(value * value)
+            self._rebuild()
+            return
+
+        block = min(bisect.bisect_left(self._maxes, value), len(self._blocks) - 1)
+        bisect.insort(self._blocks[block], value)
+        self._block_sums[block] += value
+        self._block_squares[block] += value * value
+        if len(self._blocks[block]) > 2 * self.block_size:
+            half = self._blocks[block][self.block_size:]
+            del self._blocks[block][self.block_size:]
+            self._blocks.insert(block + 1, half)
+            self._block_sums[block:block + 1] = [sum(self._blocks[block]), sum(half)]
+            self._block_squares[block:block + 1] = [sum(value * value for value in self._blocks[block]),
+                                                    sum(value * value for value in half)]
+            self._rebuild()
+            return
+
+        self._maxes[block] = self._blocks[block][-1]
+        self._fenwick_add(self._counts, block, 1)
+        self._fenwick_add(self._sums, block, value)
+        self._fenwick_add(self._squares, block, value * value)
+
+
+    def __getitem__(self, rank):
+        block, position = self._locate(rank)
+        return self._blocks[block][position] + self._offset
+
+
+    def bisect_left(self, value):
+        value = value - self._offset
+        block = bisect.bisect_left(self._maxes, value)
+        if block == len(self._blocks):
+            return self._length
+        return self._fenwick_prefix(self._counts, block) + bisect.bisect_left(self._blocks[block], value)
+
+
+    def bisect_right(self, value):
+        value = value - self._offset
+        block = bisect.bisect_right(self._maxes, value)
+        if block == len(self._blocks):
+            return self._length
+        return self._fenwick_prefix(self._counts, block) + bisect.bisect_right(self._blocks[block], value)
+
+
+    def _prefix_sums(self, rank):
+        # Sum and sum of squares of the values of the first rank ranks
+        if rank >= self._length:
+            return self._fenwick_prefix(self._sums, len(self._blocks)), self._fenwick_prefix(self._squares, len(self._blocks))
+        block, position = self._locate(rank)
+        head = self._blocks[block][:position]
+        return (self._fenwick_prefix(self._sums, block) + sum(head),
+                self._fenwick_prefix(self._squares, block) + sum(value * value for value in head))
+
+
+    def mean_and_variance(self, low, high):
+        """
+        Mean and sample variance (NaN with a single value) of the values of ranks low to high - 1.
+        """
+        num_values = high - low
+        low_sum, low_squares = self._prefix_sums(low)
+        high_sum, high_squares = self._prefix_sums(high)
+        total = high_sum - low_sum
+        mean = total / num_values
+        if num_values < 2:
+            return mean + self._offset, np.nan
+        variance = max(0.0, (high_squares - low_squares - total * mean) / (num_values - 1))
+        return mean + self._offset, variance
+
+
+
+class SigmaClippedAverage(RunningAverage):
+    """
+    Mean of the values within sigma robust standard deviations of the median at each position, so a
+    glitchy scan is left out of the average instead of dragging it.
+
+    Values are kept sorted per position (see _SortedValues). The median and the spread (from the
+    interquartile range, which outliers don't inflate) come straight from the sorted values, the clipping
+    bounds are found by bisection and the mean and variance of the kept values from prefix sums, so adding
+    a point costs O(log n), n being the number of scans. Until there are min_count values at a position
+    nothing is clipped.
+    """
+
+    name = "Sigma-clipped"
+
+    def __init__(self, num_positions=0, sigma=3.0, min_count=4):
+        super().__init__(num_positions)
+        self.sigma = sigma
+        self.min_count = min_count
+        self._values = [_SortedValues() for _ in range(num_positions)]
+        self._estimate = np.zeros(num_positions, dtype=np.float64)
+        self._kept_error = np.full(num_positions, np.nan)
+        self.clipped = np.zeros(num_positions, dtype=np.int64)
+
+
+    def reserve(self, num_positions):
+        missing = num_positions - len(self.count)
+        super().reserve(num_positions)
+        if missing > 0:
+            self._values.extend(_SortedValues() for _ in range(missing))
+            self._estimate = np.concatenate([self._estimate, np.zeros(missing)])
+            self._kept_error = np.concatenate([self._kept_error, np.full(missing, np.nan)])
+            self.clipped = np.concatenate([self.clipped, np.zeros(missing, dtype=np.int64)])
+
+
+    def reset(self):
+        super().reset()
+        self._values = [_SortedValues() for _ in range(len(self.count))]
+        self._estimate[:] = 0.0
+        self._kept_error[:] = np.nan
+        self.clipped[:] = 0
+
+
+    def update(self, index, value, error=np.nan):
+        if index >= len(self.count):
+            self.reserve(max(index + 1, 2 * len(self.count)))
+        super().update(index, value)
+
+        values = self._values[index]
+        values.add(float(value))
+        num_values = len(values)
+
+        # Nothing to clip against yet
+        if num_values < self.min_count:
+            low, high = 0, num_values
+        else:
+            median = 0.5 * (values[(num_values - 1) // 2] + values[num_values // 2])
+            spread = (values[(3 * num_values) // 4] - values[num_values // 4]) / 1.349
+            low = values.bisect_left(median - self.sigma * spread)
+            high = values.bisect_right(median + self.sigma * spread)
+
+        num_kept = high - low
+        kept_mean, kept_variance = values.mean_and_variance(low, high)
+        self._estimate[index] = kept_mean
+        self.clipped[index] = num_values - num_kept
+        self._kept_error[index] = np.sqrt(kept_variance / num_kept)
+
+
+    def update_scan(self, values, errors=None):
+        for index, value in enumerate(values):
+            self.update(index, value)
+
+
+    def mean(self, stop=None):
+        view = self._estimate[:stop]
+        view.flags.writeable = False
+        return view
+
+
+    def standard_error(self, stop=None):
+        """
+        Standard error of the mean of the values that were kept.
+        """
+        return self._kept_error[:stop].copy()
+
+
+
+class MedianOfMeans(RunningAverage):
+    """
+    Scans are dealt round robin into num_groups groups at each position, the estimate is the median
+    of the group means. A glitchy scan only spoils the mean of its own group, which the median then
+    ignores. O(num_groups) per point, with num_groups fixed that's O(1).
+    """
+
+    name = "Median of means"
+
+    def __init__(self, num_positions=0, num_groups=5):
+        super().__init__(num_positions)
+        self.num_groups = num_groups
+        self._group_count = np.zeros((num_positions, num_groups), dtype=np.int64)
+        self._group_mean = np.full((num_positions, num_groups), np.nan)
+        self._estimate = np.zeros(num_positions, dtype=np.float64)
+
+
+    def reserve(self, num_positions):
+        missing = num_positions - len(self.count)
+        super().reserve(num_positions)
+        if missing > 0:
+            self._group_count = np.concatenate([self._group_count, np.zeros((missing, self.num_groups), dtype=np.int64)])
+            self._group_mean = np.concatenate([self._group_mean, np.full((missing, self.num_groups), np.nan)])
+            self._estimate = np.concatenate([self._estimate, np.zeros(missing)])
+
+
+    def reset(self):
+        super().reset()
+        self._group_count[:] = 0
+        self._group_mean[:] = np.nan
+        self._estimate[:] = 0.0
+
+
+    def update(self, index, value, error=np.nan):
+        if index >= len(self.count):
+            self.reserve(max(index + 1, 2 * len(self.count)))
+
+        # The count before this point decides the group, scans go round robin
+        group = self.count[index] % self.num_groups
+        super().update(index, value)
+
+        self._group_count[index, group] += 1
+        if self._group_count[index, group] == 1:
+            self._group_mean[index, group] = value
+        else:
+            self._group_mean[index, group] += (value - self._group_mean[index, group]) / self._group_count[index, group]
+
+        self._estimate[index] = np.median(self._group_mean[index, :min(self.count[index], self.num_groups)])
+
+
+    def update_scan(self, values, errors=None):
+        for index, value in enumerate(values):
+            self.update(index, value)
+
+
+    def mean(self, stop=None):
+        view = self._estimate[:stop]
+        view.flags.writeable = False
+        return view
+
+
+
+# Names as they appear in the experiment preset and the GUI
+estimators = {
+    RunningAverage.name: RunningAverage,
+    WeightedAverage.name: WeightedAverage,
+    SigmaClippedAverage.name: SigmaClippedAverage,
+    MedianOfMeans.name: MedianOfMeans,
+}
+
+
+def create_estimator(name="Mean", num_positions=0):
+    """
+    Creates the estimator selected in the experiment preset by its name, see estimators.
+    """
+    if name not in estimators:
+        raise ValueError(f"Unknown averaging estimator '{name}', choose one of: {', '.join(estimators)}")
+    return estimators[name](num_positions)
@@ -0,0 +1,197 @@
+import os
+import sys
+import tempfile
+from datetime import datetime
+import numpy as np
+
+import scan_record
+
+
+# Single scans x positions store for the whole experiment.
+#
+# Completed scans used to be kept three times over: the Scans list handed to perform_experiment(), the
+# previous_scans dicts (data_df.to_dict()) in the launcher and the line artists of the live graph. Now
+# the engine writes every point straight into a row of this store (the ScanRecord of each scan is
+# backed by its row) and everybody else reads views of it: the GUI, the averaging and the exporters.
+#
+# By default the arrays live in RAM. Given a directory, they are .npy files opened as memory maps
+# instead, so overnight runs with many scans don't keep everything resident: the OS pages rows in
+# and out as they are read. Every store gets a folder of its own in there, the live plot may still map
+# the files of the previous experiment when the next one starts (and Windows won't reopen those).
+
+
+def peak_memory_bytes():
+    """
+    Peak resident memory of this process since it started, in bytes. NaN if the platform doesn't
+    tell us.
+    """
+    try:
+        if sys.platform == "win32":
+            import ctypes
+            from ctypes import wintypes
+
+            class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+                _fields_ = [("cb", wintypes.DWORD),
+                            ("PageFaultCount", wintypes.DWORD),
+                            ("PeakWorkingSetSize", ctypes.c_size_t),
+                            ("WorkingSetSize", ctypes.c_size_t),
+                            ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+                            ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                            ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                            ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                            ("PagefileUsage", ctypes.c_size_t),
+                            ("PeakPagefileUsage", ctypes.c_size_t)]
+
+            counters = PROCESS_MEMORY_COUNTERS()
+            counters.cb = ctypes.sizeof(PROCESS_MEMORY_COUNTERS)
+            process = ctypes.windll.kernel32.GetCurrentProcess()
+            if not ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+                return np.nan
+            return float(counters.PeakWorkingSetSize)
+
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        # Linux reports kilobytes, macOS bytes
+        if sys.platform == "darwin":
+            return float(peak)
+        return float(peak) * 1024
+
+    except Exception:
+        return np.nan
+
+
+
+def experiment_shape(parameters_dict, num_plan_positions):
+    """
+    Scans x positions that hold every scan an experiment can take, so the store is reserved once and
+    never grows while the GUI holds views of its rows. Adaptive scans after the pilot may have as many
+    points as the point budget, passes of the target relative error mode revisit part of the plan.
+
+    Parameters:
+        parameters_dict: dict - Experiment parameters, as given to perform_experiment().
+        num_plan_positions: int - Positions of the scan plan (see scan_plan.py).
+
+    Returns:
+        tuple: (num_scans, num_positions)
+    """
+    num_positions = num_plan_positions
+    if parameters_dict.get("scan_mode", "Uniform") == "Adaptive":
+        num_positions = max(num_positions, int(parameters_dict.get("adaptive_point_budget", 0)))
+    return int(parameters_dict["num_scans"]), num_positions
+
+
+
+class ScanStore:
+    """
+    scans x positions arrays shared by the experiment thread and the GUI.
+
+    Parameters:
+        directory: str or None - Folder for the memory mapped .npy files (in a subfolder of their own),
+            None keeps the arrays in RAM.
+
+    Attributes:
+        positions, data, errors: float64 arrays of shape (scans, positions), NaN where nothing was
+            measured. Empty until reserve() is called.
+        scans_completed: int - Number of rows holding a finished scan.
+    """
+
+    datasets = ("positions", "data", "errors")
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.positions = np.full((0, 0), np.nan)
+        self.data = np.full((0, 0), np.nan)
+        self.errors = np.full((0, 0), np.nan)
+        self.scans_completed = 0
+        self._store_folder = None
+
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in self.datasets)
+
+
+    @property
+    def is_memory_mapped(self):
+        return isinstance(self.data, np.memmap)
+
+
+    def _allocate(self, name, num_scans, num_positions):
+        if self.directory is None:
+            return np.full((num_scans, num_positions), np.nan)
+
+        # Growing a memory map means a new file, reserve() copies the old rows over
+        if self._store_folder is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._store_folder = tempfile.mkdtemp(prefix=f"scan_store_{datetime.now().strftime('%Y%m%d_%H%M%S')}_", dir=self.directory)
+        file_path = os.path.join(self._store_folder, f"{name}_{num_scans}x{num_positions}.npy")
+        array = np.lib.format.open_memmap(file_path, mode="w+", dtype=np.float64, shape=(num_scans, num_positions))
+        array[:] = np.nan
+        return array
+
+
+    def reserve(self, num_scans, num_positions):
+        """
+        Makes sure the store holds at least num_scans x num_positions, keeping what's already in it.
+        Call it before the experiment starts with experiment_shape(), growing replaces the arrays so
+        views taken earlier would go stale.
+        """
+        old_scans, old_positions = self.shape
+        if num_scans <= old_scans and num_positions <= old_positions:
+            return
+
+        num_scans = max(num_scans, old_scans)
+        num_positions = max(num_positions, old_positions)
+
+        for name in self.datasets:
+            old_array = getattr(self, name)
+            new_array = self._allocate(name, num_scans, num_positions)
+            new_array[:old_scans, :old_positions] = old_array
+            setattr(self, name, new_array)
+
+            # Windows won't delete a file that is still mapped somewhere (e.g. a view the GUI holds),
+            # in that case the old file just stays in the folder
+            if isinstance(old_array, np.memmap):
+                file_path = old_array.filename
+                del old_array
+                try:
+                    os.remove(file_path)
+                except OSError:
+                    pass
+
+
+    def record(self, scan, positions, position_error=0.0):
+        """
+        ScanRecord for a scan whose data and errors are written straight into row scan of the store.
+        """
+        self.reserve(scan + 1, len(positions))
+        num_positions = len(positions)
+        self.positions[scan, :num_positions] = positions
+        return scan_record.ScanRecord(positions, scan_number=scan, position_error=position_error,
+                                      data=self.data[scan, :num_positions], errors=self.errors[scan, :num_positions])
+
+
+    def complete_scan(self, scan):
+        self.scans_completed = max(self.scans_completed, scan + 1)
+        if self.is_memory_mapped:
+            for name in self.datasets:
+                getattr(self, name).flush()
+
+
+    # --- Views, no copies ---
+    def scan_data(self, scan):
+        return self.data[scan]
+
+
+    def scan_errors(self, scan):
+        return self.errors[scan]
+
+
+    def completed_data(self):
+        return self.data[:self.scans_completed]
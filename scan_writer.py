@@ -0,0 +1,103 @@
+import os
+import time
+
+
+# Crash safe writer for the data of a scan.
+#
+# perform_experiment() used to keep everything in memory and only write the CSV at the very end of the
+# scan, so a crash, a power cut or pressing abort three hours in lost the whole scan. This writer appends
+# every point to an open ".csv.partial" file as soon as it's measured (position, value, error, timestamp
+# and where the stage actually ended up). Writes are buffered and flushed to disk in batches, fsync makes
+# sure the OS has actually put them on the drive.
+#
+# At the end of the scan finalize() writes the usual CSV (header comment + DataFrame, same layout as
+# always) next to it and removes the partial file. If the scan never finishes the partial file stays
+# there with everything measured up to the last flush.
+
+
+class StreamingScanWriter:
+    """
+    Appends scan points to a partial CSV file as they are measured.
+
+    Parameters:
+        file_path: str - Path of the partial file, by convention the final CSV path + ".partial".
+        flush_every: int - Points buffered before writing them to the file.
+        fsync_every: int - Points between fsyncs, forcing the data onto the drive.
+    """
+
+    columns = ("Index", "Absolute Time [ps]", "Stage readback [ps]", "Signal", "Signal error", "Timestamp [s]")
+
+    def __init__(self, file_path, flush_every=1, fsync_every=10):
+        self.file_path = file_path
+        self.flush_every = flush_every
+        self.fsync_every = fsync_every
+
+        self.file = open(file_path, "w", buffering=1024 * 64)
+        self.file.write(f"# Partial scan data, written point by point while the scan runs ({time.strftime('%Y-%m-%d %H:%M:%S')})\n")
+        self.file.write(",".join(self.columns) + "\n")
+
+        self.points_written = 0
+        self._unflushed = 0
+        self._unsynced = 0
+
+
+    def write_point(self, index, position, readback, value, error, timestamp):
+        # repr of a float is the shortest string that reads back to the exact same value
+        numbers = (repr(float(number)) for number in (position, readback, value, error, timestamp))
+        self.file.write(f"{int(index)}," + ",".join(numbers) + "\n")
+        self.points_written += 1
+        self._unflushed += 1
+        self._unsynced += 1
+
+        if self._unflushed >= self.flush_every:
+            self.flush(fsync=self._unsynced >= self.fsync_every)
+
+
+    def write_record_point(self, record, index):
+        """
+        Writes point index of a ScanRecord (see scan_record.py).
+        """
+        self.write_point(index, record.positions[index], record.stage_readbacks[index], record.data[index],
+                         record.errors[index], record.timestamps[index])
+
+
+    def flush(self, fsync=False):
+        if self.file.closed:
+            return
+
+        self.file.flush()
+        self._unflushed = 0
+        if fsync:
+            os.fsync(self.file.fileno())
+            self._unsynced = 0
+
+
+    def close(self):
+        """
+        Flushes everything to the drive and closes the file, the partial file is kept.
+        Safe to call more than once.
+        """
+        if self.file.closed:
+            return
+
+        self.flush(fsync=True)
+        self.file.close()
+
+
+    def finalize(self, csv_path, header_comment, data_df):
+        """
+        Writes the final CSV with the header comment and the scan DataFrame and removes the partial
+        file. The CSV is written to a temporary file first and moved in place, so an existing CSV is
+        never left half written.
+        """
+        self.close()
+
+        temporary_path = csv_path + ".tmp"
+        with open(temporary_path, "w") as file:
+            file.write(f"# {header_comment}\n")
+            data_df.to_csv(file, index=False, lineterminator="\n")
+            file.flush()
+            os.fsync(file.fileno())
+
+        os.replace(temporary_path, csv_path)
+        os.remove(self.file_path)
@@ -0,0 +1,146 @@
+import os
+import queue
+import threading
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib import colormaps
+
+
+# Images of the scans, saved next to every scan CSV.
+#
+# perform_experiment() used to call savefig() on the live figure of the monitoring window at the end of
+# every scan: the acquisition stood still while a 300 DPI image rendered, and the GUI thread was redrawing
+# that same figure at the same time. Now the experiment thread only hands over copies of the data with
+# submit_scan() and a worker thread renders them on its own Agg figure, which nothing else touches.
+#
+# The image looks like the live graph did at the end of the scan: every scan so far with the inferno
+# colors of the live plot, the average as a thick dashed line and, when given, the samples averaged at
+# every point on a second axis. Rows of finished scans don't change, so every scan only copies the
+# rows the renderer hasn't seen yet and the images share them.
+#
+# With defer_until_end the images are only queued and get rendered when finish() is called at the end
+# of the experiment, so not even the worker competes with the acquisition.
+
+
+class SnapshotRenderer:
+    """
+    Renders scan images on a worker thread, see module comment.
+
+    Parameters:
+        image_format: str - Any format matplotlib saves, "png", "svg", "pdf"...
+        dpi: int - Resolution of the images.
+        defer_until_end: bool - Render everything when finish() is called instead of as scans come.
+        figsize: tuple - Size of the figure in inches, the same as the live graph.
+    """
+
+    def __init__(self, image_format="png", dpi=300, defer_until_end=False, figsize=(10, 5)):
+        self.image_format = image_format
+        self.dpi = dpi
+        self.defer_until_end = defer_until_end
+        self.figsize = figsize
+
+        self._jobs = queue.Queue()
+        self._deferred = []
+        self._rows = []
+        self._worker = None
+        self.images_rendered = 0
+
+
+    def start_experiment(self):
+        """
+        Forgets the scans of the previous experiment.
+        """
+        self._rows = []
+
+
+    def submit_scan(self, file_path, scan, num_scans, Scan_store, average_positions=None, average=None, sample_counts=None):
+        """
+        Hands the data of a finished scan over for rendering, returns straight away. Call it from the
+        thread filling the scan store.
+
+        Parameters:
+            file_path: str - Image path without extension, image_format is appended.
+            scan: int - Scan that just finished, the image shows scans 0 to scan.
+            num_scans: int - Scans of the experiment, for the line colors.
+            Scan_store: ScanStore - Store holding the scans (see scan_store.py).
+            average_positions, average: array like or None - Average of the scans so far.
+            sample_counts: array like or None - Samples averaged at every average position.
+        """
+        # Rows the renderer already has don't change anymore, copy only the new ones. A resumed
+        # experiment starts from a later scan, so its first image copies every row before it
+        self._rows = self._rows[:scan]
+        for row in range(len(self._rows), scan + 1):
+            measured = ~np.isnan(Scan_store.positions[row]) & ~np.isnan(Scan_store.data[row])
+            self._rows.append((Scan_store.positions[row][measured].copy(), Scan_store.data[row][measured].copy()))
+
+        job = {
+                "File path": f"{file_path}.{self.image_format}",
+                "Scan number": scan,
+                "Number of scans": num_scans,
+                "Rows": tuple(self._rows[:scan + 1]),
+                "Average positions": None if average_positions is None else np.array(average_positions, dtype=np.float64),
+                "Average": None if average is None else np.array(average, dtype=np.float64),
+                "Sample counts": None if sample_counts is None else np.array(sample_counts, dtype=np.float64),
+              }
+
+        if self.defer_until_end:
+            self._deferred.append(job)
+        else:
+            self._queue(job)
+
+
+    def finish(self):
+        """
+        Renders whatever is deferred or still queued and waits until every image is saved.
+        """
+        for job in self._deferred:
+            self._queue(job)
+        self._deferred = []
+        self._jobs.join()
+
+
+    def _queue(self, job):
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(target=self._work, daemon=True)
+            self._worker.start()
+        self._jobs.put(job)
+
+
+    def _work(self):
+        figure = Figure(figsize=self.figsize, dpi=100)
+        FigureCanvasAgg(figure)
+        cmap = colormaps["inferno"]
+
+        while True:
+            job = self._jobs.get()
+            try:
+                self._render(figure, cmap, job)
+                self.images_rendered += 1
+            # A failed image must not take the worker down with the images still queued
+            except Exception as e:
+                print(f"Could not save the image of scan {job['Scan number']} to {job['File path']}: {e}")
+            finally:
+                self._jobs.task_done()
+
+
+    def _render(self, figure, cmap, job):
+        figure.clear()
+        axes = figure.add_subplot(111)
+        axes.set_xlabel('t [ps]')
+        axes.set_ylabel('PD [Vrms]')
+
+        for scan, (positions, data) in enumerate(job["Rows"]):
+            axes.plot(positions, data, linestyle='-', color=cmap(scan / job["Number of scans"]), label=f"scan {scan}")
+
+        if job["Average"] is not None:
+            axes.plot(job["Average positions"], job["Average"], linestyle='--', linewidth=3, color="deepskyblue", label="Average")
+        axes.legend()
+
+        if job["Sample counts"] is not None:
+            sample_count_axes = axes.twinx()
+            sample_count_axes.set_ylabel('Samples averaged')
+            sample_count_axes.plot(job["Average positions"], job["Sample counts"], drawstyle='steps-mid', linestyle=':', color="gray")
+
+        os.makedirs(os.path.dirname(os.path.abspath(job["File path"])), exist_ok=True)
+        figure.savefig(job["File path"], dpi=self.dpi, format=self.image_format)
@@ -0,0 +1,402 @@
+import os
+import time
+import select
+import random
+import threading
+from math import sqrt, exp, pi, sin, cos
+
+
+# Pseudo-terminal emulator of the SR860 lock-in amplifier. The idea is to have something realistic
+# to talk to when we are not at the lab: it opens a pty pair, core_logic_functions.initialize_connection()
+# opens the slave end exactly like it would open COM5 and this module answers from the master end with
+# the same command set we use on the real instrument.
+#
+# Usage:
+#
+#   with SR860Emulator(latency=5e-3, jitter=1e-3) as emulator:
+#       adapter = clfun.initialize_connection(port=emulator.port, baudrate=115200, timeout=1)
+#       print(clfun.request_R(adapter))
+#
+# Pseudo terminals only exist on POSIX systems so this won't run on the lab PC, it's meant for
+# development machines and benchmarks (see Benchmarks folder).
+
+
+# Tables copied from the SR860 manual, indices are what the instrument sends and receives
+sensitivity_table = [1.0, 500e-3, 200e-3, 100e-3, 50e-3, 20e-3, 10e-3, 5e-3, 2e-3, 1e-3, 500e-6, 200e-6,
+                     100e-6, 50e-6, 20e-6, 10e-6, 5e-6, 2e-6, 1e-6, 500e-9, 200e-9, 100e-9, 50e-9, 20e-9,
+                     10e-9, 5e-9, 2e-9, 1e-9]
+time_constant_table = [1e-6, 3e-6, 10e-6, 30e-6, 100e-6, 300e-6, 1e-3, 3e-3, 10e-3, 30e-3, 100e-3, 300e-3,
+                       1, 3, 10, 30, 100, 300, 1e3, 3e3, 10e3, 30e3]
+filter_slope_table = [6, 12, 18, 24] # In dB/Oct
+input_range_table = [1.0, 300e-3, 100e-3, 30e-3, 10e-3] # In V
+
+# Equivalent noise bandwidth of the output low pass filter in multiples of 1/tau, one entry for each
+# filter slope (6, 12, 18 and 24 dB/oct). Used to turn an input noise density into X noise and Y noise
+noise_bandwidth_tau_multiples = [1/4, 1/8, 3/32, 5/64]
+
+
+def pump_probe_signal(delay_ps, time_zero=0.0, amplitude=10e-3, rise_ps=0.5, decay_ps=50.0):
+    """
+    Toy pump probe transient used as the default input signal: an error function rise at time zero
+    followed by an exponential decay. delay_ps is relative to time zero, same as scan positions.
+    """
+    t = delay_ps - time_zero
+    if t < -5 * rise_ps:
+        return 0.0
+    rise = 0.5 * (1 + _erf(t / rise_ps))
+    decay = exp(-t / decay_ps) if t > 0 else 1.0
+    return amplitude * rise * decay
+
+
+def _erf(x):
+    # Abramowitz and Stegun approximation, plenty good for a fake signal and saves us the scipy dependency
+    sign = 1 if x >= 0 else -1
+    x = abs(x)
+    t = 1 / (1 + 0.3275911 * x)
+    y = 1 - (((((1.061405429 * t - 1.453152027) * t) + 1.421413741) * t - 0.284496736) * t + 0.254829592) * t * exp(-x * x)
+    return sign * y
+
+
+
+class SR860Emulator:
+    """
+    Emulates the subset of the SR860 command set used by core_logic_functions over a pseudo terminal.
+
+    Parameters:
+        latency: float - Mean time in seconds the emulator takes before answering each command.
+        jitter: float - Standard deviation in seconds of a gaussian added to the latency.
+        signal_amplitude: float - Peak amplitude in Vrms of the emulated pump probe transient.
+        noise_density: float - Input noise density in Vrms/sqrt(Hz), this sets XNOise, YNOise and
+            the scatter of R.
+        phase: float - Phase in radians between the signal and the reference, splits R into X and Y.
+        signal: callable - Optional function of the delay in ps returning the input amplitude in V,
+            defaults to pump_probe_signal().
+        seed: int - Seed for the random number generator so runs are repeatable.
+
+    The input the lock-in sees is a function of the delay, set_delay() lets a stage emulator (or a
+    benchmark) tell the lock-in where the stage is. The output low pass filter is emulated as a cascade
+    of first order sections with the configured time constant, one per 6 dB/oct of roll-off, so waiting
+    less than the settling time after a move returns a value that has not settled yet.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, signal_amplitude=10e-3, noise_density=1e-6, phase=0.0, signal=None, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.signal_amplitude = signal_amplitude
+        self.noise_density = noise_density
+        self.phase = phase
+        self.signal = signal if signal is not None else (lambda delay_ps: pump_probe_signal(delay_ps, amplitude=signal_amplitude))
+        self.random = random.Random(seed)
+
+        # Instrument state, indices follow the manual tables. Power on defaults
+        self.sensitivity_index = 0
+        self.time_constant_index = 12
+        self.filter_slope_index = 0
+        self.input_range_index = 0
+        self.harmonic = 1
+        self.reference_source = 0
+        self.reference_trigger = 0
+        self.reference_impedance = 1
+        self.input_mode = 0
+        self.input_source = 0
+
+        # Filter state, one value per 6dB/oct section
+        self.delay_ps = 0.0
+        self.filter_state = [0.0] * 4
+        self.noise_state = 0.0
+        self.filter_timestamp = time.perf_counter()
+
+        # Counters used by benchmarks
+        self.commands_received = 0
+        self.queries_answered = 0
+
+        self.master_fd = None
+        self.slave_fd = None
+        self.port = None
+        self._thread = None
+        self._running = False
+        self._lock = threading.Lock()
+
+
+    # --- Start and stop ---
+    def start(self):
+        """
+        Opens the pseudo terminal pair and starts answering commands on a background thread.
+        Returns the path of the port to feed initialize_connection().
+        """
+        try:
+            import tty
+        except ImportError:
+            raise Exception("SR860Emulator needs pseudo terminals which are only available on POSIX systems")
+
+        self.master_fd, self.slave_fd = os.openpty()
+
+        # Raw mode so the terminal does not echo our commands back or translate line endings
+        tty.setraw(self.master_fd)
+        tty.setraw(self.slave_fd)
+        self.port = os.ttyname(self.slave_fd)
+
+        self._running = True
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+        return self.port
+
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+        for fd in (self.master_fd, self.slave_fd):
+            if fd is not None:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+        self.master_fd = None
+        self.slave_fd = None
+
+
+    def __enter__(self):
+        self.start()
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+    # --- Input signal ---
+    def set_delay(self, delay_ps):
+        """
+        Tells the emulator the delay the stage is at, the input signal steps to the new value and
+        the output filter starts settling towards it.
+        """
+        with self._lock:
+            self._advance_filter()
+            self.delay_ps = delay_ps
+
+
+    def _input_amplitude(self):
+        return self.signal(self.delay_ps)
+
+
+    def _advance_filter(self):
+        # Integrate each first order section analytically over the time elapsed since the last call,
+        # sections are chained so the n-th one follows the output of the (n-1)-th
+        now = time.perf_counter()
+        dt = now - self.filter_timestamp
+        self.filter_timestamp = now
+
+        tau = time_constant_table[self.time_constant_index]
+        decay = exp(-dt / tau) if tau > 0 else 0.0
+        sections = self.filter_slope_index + 1
+        target = self._input_amplitude()
+        for section in range(0, sections):
+            self.filter_state[section] = target + (self.filter_state[section] - target) * decay
+            target = self.filter_state[section]
+
+        # Output noise is filtered too, so samples closer than a time constant apart are correlated.
+        # Modelled as an Ornstein-Uhlenbeck process with the filter's time constant
+        sigma = self._output_noise()
+        self.noise_state = self.noise_state * decay + sigma * sqrt(max(0.0, 1 - decay ** 2)) * self.random.gauss(0, 1)
+
+
+    def _output_noise(self):
+        # Noise after the low pass filter: density times the square root of the filter bandwidth
+        tau = time_constant_table[self.time_constant_index]
+        bandwidth = noise_bandwidth_tau_multiples[self.filter_slope_index] / tau
+        return self.noise_density * sqrt(bandwidth)
+
+
+    def _R(self):
+        self._advance_filter()
+        R = self.filter_state[self.filter_slope_index] + self.noise_state
+        return abs(R)
+
+
+    def _signal_level(self):
+        # 0 (lowest) to 4 (overload) depending on how much of the input range the signal fills
+        fraction = self._input_amplitude() * sqrt(2) / input_range_table[self.input_range_index]
+        if fraction > 1.0:
+            return 4
+        for level, threshold in enumerate([0.1, 0.3, 0.6, 0.9]):
+            if fraction < threshold:
+                return level
+        return 3
+
+
+    # --- Command handling ---
+    def _serve(self):
+        buffer = b""
+        while self._running:
+            try:
+                # Wake up every now and then to check whether stop() was called
+                readable, _, _ = select.select([self.master_fd], [], [], 0.1)
+                if not readable:
+                    continue
+                chunk = os.read(self.master_fd, 1024)
+            except (OSError, ValueError):
+                break
+            if not chunk:
+                break
+
+            buffer += chunk
+            while b"\n" in buffer:
+                line, buffer = buffer.split(b"\n", 1)
+                command = line.decode(errors="replace").strip()
+                if not command:
+                    continue
+
+                response = self.handle(command)
+
+                # Emulate the time the instrument takes to parse and answer
+                delay = self.latency + (self.random.gauss(0, self.jitter) if self.jitter > 0 else 0.0)
+                if delay > 0:
+                    time.sleep(delay)
+
+                if response is not None:
+                    os.write(self.master_fd, (response + "\n").encode())
+
+
+    def handle(self, command):
+        """
+        Processes a single command line and returns the response string, or None for commands
+        that don't answer. Public so benchmarks can measure the emulator alone without the pty.
+        """
+        with self._lock:
+            self.commands_received += 1
+
+            # A missing or malformed argument (SENS with no value, RSRC FOO...) is ignored like the real
+            # instrument does, instead of killing the serve thread and leaving every later read to time out
+            try:
+                response = self._dispatch(command)
+            except (TypeError, ValueError, AttributeError):
+                response = None
+            if response is not None:
+                self.queries_answered += 1
+            return response
+
+
+    def _dispatch(self, command):
+        parts = command.split()
+        header = parts[0].upper()
+        argument = parts[1] if len(parts) > 1 else None
+
+        if header == "*IDN?":
+            return "Stanford_Research_Systems,SR860,000000,v1.51 (emulated)"
+
+        if header == "*CLS":
+            return None
+
+        ### Sensitivity, time constant and filter slope
+        if header == "SCAL":
+            self.sensitivity_index = int(argument)
+            return None
+        if header == "SCAL?":
+            return str(self.sensitivity_index)
+
+        if header == "OFLT":
+            self._advance_filter()
+            self.time_constant_index = int(argument)
+            return None
+        if header == "OFLT?":
+            return str(self.time_constant_index)
+
+        if header == "OFSL":
+            self._advance_filter()
+            self.filter_slope_index = int(argument)
+            return None
+        if header == "OFSL?":
+            return str(self.filter_slope_index)
+
+        ### Input range
+        if header == "ARNG":
+            # Smallest range that fits the input peak, same thing the front panel button does
+            peak = self._input_amplitude() * sqrt(2)
+            self.input_range_index = 0
+            for index, input_range in enumerate(input_range_table):
+                if peak < input_range:
+                    self.input_range_index = index
+            return None
+        if header == "ASCL":
+            # Smallest sensitivity above the current R
+            R = self._R()
+            self.sensitivity_index = 0
+            for index, sensitivity in enumerate(sensitivity_table):
+                if R < sensitivity:
+                    self.sensitivity_index = index
+            return None
+        if header == "IRNG":
+            self.input_range_index = int(argument)
+            return None
+        if header == "IRNG?":
+            return str(self.input_range_index)
+        if header == "ILVL?":
+            return str(self._signal_level())
+
+        ### Outputs
+        if header == "SNAP?":
+            # Simultaneous snapshot of up to three outputs, answered comma separated
+            outputs = "".join(parts[1:]).split(",")
+            R = self._R()
+            values = {"0": R * cos(self.phase), "X": R * cos(self.phase),
+                      "1": R * sin(self.phase), "Y": R * sin(self.phase),
+                      "2": R, "R": R,
+                      "3": self.phase * 180 / pi, "THETA": self.phase * 180 / pi}
+            return ",".join(f"{values.get(output.upper(), 0.0):.6e}" for output in outputs)
+
+        if header == "OUTP?":
+            output = argument.upper() if argument is not None else ""
+            if output in ("2", "R"):
+                return f"{self._R():.6e}"
+            if output in ("0", "X"):
+                return f"{self._R() * cos(self.phase):.6e}"
+            if output in ("1", "Y"):
+                return f"{self._R() * sin(self.phase):.6e}"
+            if output in ("3", "THETA"):
+                return f"{self.phase * 180 / pi:.6e}"
+            if output.startswith("XNO") or output.startswith("YNO"):
+                # Noise is split evenly between the quadratures
+                return f"{self._output_noise() / sqrt(2):.6e}"
+            return None
+
+        ### Reference and input configuration from configure_lockin()
+        if header == "HARM":
+            self.harmonic = int(argument)
+            return None
+        if header == "HARM?":
+            return str(self.harmonic)
+
+        if header == "RSRC":
+            self.reference_source = {"INT": 0, "EXT": 1, "DUAL": 2, "CHOP": 3}.get(argument.upper()[:4], 0) if not argument.isdigit() else int(argument)
+            return None
+        if header == "RSRC?":
+            return str(self.reference_source)
+
+        if header == "RTRG":
+            self.reference_trigger = {"SIN": 0, "POS": 1, "NEG": 2}.get(argument.upper()[:3], 0) if not argument.isdigit() else int(argument)
+            return None
+        if header == "RTRG?":
+            return str(self.reference_trigger)
+
+        if header == "REFZ":
+            # 0 or 50 (Ohms) for 50 Ohms, 1 or 1M (eg) for 1 MOhm, like the real instrument
+            self.reference_impedance = {"0": 0, "50": 0, "1": 1, "1M": 1}.get(argument.upper()[:2], 1)
+            return None
+        if header == "REFZ?":
+            return str(self.reference_impedance)
+
+        if header == "IVMD":
+            self.input_mode = 0 if argument.upper().startswith("VOLT") or argument == "0" else 1
+            return None
+        if header == "IVMD?":
+            return str(self.input_mode)
+
+        if header == "ISRC":
+            self.input_source = {"A": 0, "A-B": 1}.get(argument.upper(), 0) if not argument.isdigit() else int(argument)
+            return None
+        if header == "ISRC?":
+            return str(self.input_source)
+
+        # The real instrument ignores unknown commands and sets an error bit, we just ignore them
+        return None
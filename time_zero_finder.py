@@ -0,0 +1,216 @@
+import math
+import numpy as np
+
+import scan_plan
+
+
+# Automatic time zero search.
+#
+# time_zero used to be found by hand with throwaway scans, and a wrong value costs a whole experiment
+# when autoranging "Once at time zero" sets the range there. The search runs in two stages:
+#   1. Coarse sweep over the search window with a short time constant, quick and rough
+#   2. Refinement around what the coarse sweep found, with the time constant of the experiment:
+#       "Edge": time zero is where the pump probe signal rises. We sweep finely around the steepest
+#           part of the coarse sweep and fit an error function edge a + b * erf((t - t0) / w) to it
+#       "Peak": time zero is the maximum of R (e.g. a cross correlation). Golden section search for
+#           the maximum between the neighbours of the coarse maximum
+#
+# The measuring is done by the callables handed to find_time_zero(), core_logic.search_time_zero()
+# drives the real devices with them. The search window is clipped to the time zero limits of
+# Utils/validation_rules.json so the stage never goes where an experiment couldn't.
+
+
+search_modes = ("Edge", "Peak")
+
+# (sqrt(5) - 1) / 2, the bracket shrinks by this factor at every golden section step
+golden_ratio = (math.sqrt(5) - 1) / 2
+
+_erf = np.vectorize(math.erf, otypes=[np.float64])
+
+
+# Time constants the SR860 offers, 1 and 3 of every decade from 1us to 30ks
+lockin_time_constants = [multiple * 10.0 ** exponent for exponent in range(-6, 5) for multiple in (1, 3)]
+
+
+def coarse_time_constant(time_constant, factor=10):
+    """
+    Longest lockin time constant at least factor times shorter than time_constant, for the coarse sweep.
+    """
+    shorter = [value for value in lockin_time_constants if value <= time_constant / factor * (1 + 1e-9)]
+    return shorter[-1] if shorter else lockin_time_constants[0]
+
+
+
+def search_limits(validation_rules):
+    """
+    Lowest and highest time zero the validation rules allow, in ps.
+    """
+    rules = validation_rules["time_zero"]
+    return float(rules.get("min_rel", -np.inf)), float(rules.get("max_rel", np.inf))
+
+
+
+def clip_search_window(search_start_ps, search_end_ps, limits):
+    """
+    Clips the search window to the limits of search_limits().
+
+    Raises:
+        ValueError: If nothing is left of the window.
+    """
+    search_start_ps = max(search_start_ps, limits[0])
+    search_end_ps = min(search_end_ps, limits[1])
+    if search_end_ps <= search_start_ps:
+        raise ValueError(f"The search window is empty within the time zero limits {limits}")
+
+    return search_start_ps, search_end_ps
+
+
+
+def golden_section_maximum(function, low, high, tolerance):
+    """
+    Position of the maximum of a function that has a single maximum between low and high, found to
+    within tolerance. Every step costs a single new evaluation.
+    """
+    inner_low = high - golden_ratio * (high - low)
+    inner_high = low + golden_ratio * (high - low)
+    value_low = function(inner_low)
+    value_high = function(inner_high)
+
+    while high - low > tolerance:
+        if value_low >= value_high:
+            high, inner_high, value_high = inner_high, inner_low, value_low
+            inner_low = high - golden_ratio * (high - low)
+            value_low = function(inner_low)
+        else:
+            low, inner_low, value_low = inner_low, inner_high, value_high
+            inner_high = low + golden_ratio * (high - low)
+            value_high = function(inner_high)
+
+    return (low + high) / 2
+
+
+
+def edge_residual(positions, signal, center, width):
+    """
+    Sum of squared residuals of the best a + b * erf((t - center) / width) through the points, a and b
+    come from a linear least squares fit.
+    """
+    design = np.column_stack([np.ones(len(positions)), _erf((positions - center) / width)])
+    coefficients, _, _, _ = np.linalg.lstsq(design, signal, rcond=None)
+    return float(np.sum((design @ coefficients - signal) ** 2))
+
+
+
+def fit_edge(positions, signal, num_widths=16, num_centers=64, tolerance=None):
+    """
+    Fits an error function edge to a sweep across the rise of the signal.
+
+    Parameters:
+        positions, signal: array like - Sweep across the edge.
+        num_widths, num_centers: int - Size of the grid the best fit is first looked for on.
+        tolerance: float or None - How precisely the center is found, 1/100 of the smallest step by default.
+
+    Returns:
+        tuple: (center, width) in ps.
+    """
+    positions = np.asarray(positions, dtype=np.float64)
+    signal = np.asarray(signal, dtype=np.float64)
+    span = positions.max() - positions.min()
+    smallest_step = np.min(np.diff(np.sort(positions)))
+    if tolerance is None:
+        tolerance = smallest_step / 100
+
+    # Grid search for a starting point, edges from a fraction of a step to the whole sweep wide
+    widths = np.geomspace(smallest_step / 4, span, num_widths)
+    centers = np.linspace(positions.min(), positions.max(), num_centers)
+    residuals = np.array([[edge_residual(positions, signal, center, width) for center in centers] for width in widths])
+    width_index, center_index = np.unravel_index(np.argmin(residuals), residuals.shape)
+    width = widths[width_index]
+
+    # Then refine the center between the neighbouring grid points
+    center_step = centers[1] - centers[0]
+    low = max(centers[center_index] - center_step, positions.min())
+    high = min(centers[center_index] + center_step, positions.max())
+    center = golden_section_maximum(lambda center: -edge_residual(positions, signal, center, width), low, high, tolerance)
+    return center, width
+
+
+
+def find_time_zero(measure_coarse, measure_fine, search_start_ps, search_end_ps, coarse_step_ps, mode="Edge",
+                   fine_points=21, tolerance_ps=None, limits=(-np.inf, np.inf)):
+    """
+    Searches time zero between search_start_ps and search_end_ps, see module comment.
+
+    Parameters:
+        measure_coarse, measure_fine: callables - Take an absolute delay in ps, move there and return R.
+            The coarse one runs with a short time constant.
+        search_start_ps, search_end_ps: float - Search window in absolute delay.
+        coarse_step_ps: float - Step of the coarse sweep.
+        mode: str - "Edge" or "Peak".
+        fine_points: int - Points of the fine sweep across the edge.
+        tolerance_ps: float or None - Precision of the refinement, 1/100 of the coarse step by default.
+        limits: tuple - Lowest and highest delay the stage may go to, see search_limits().
+
+    Returns:
+        dict with "Time zero [ps]", "Mode", "Coarse positions", "Coarse signal", "Fine positions",
+        "Fine signal" and "Edge width [ps]" (NaN in peak mode).
+
+    Raises:
+        ValueError: If the mode is unknown or the window is empty after clipping it to the limits.
+    """
+    if mode not in search_modes:
+        raise ValueError(f"Unknown search mode '{mode}', pick one of {search_modes}")
+
+    search_start_ps, search_end_ps = clip_search_window(search_start_ps, search_end_ps, limits)
+    if tolerance_ps is None:
+        tolerance_ps = coarse_step_ps / 100
+
+    ### Coarse sweep
+    coarse_positions = scan_plan.leg_positions(search_start_ps, search_end_ps, coarse_step_ps)
+    if len(coarse_positions) < 3:
+        raise ValueError("The coarse sweep needs at least 3 points, make the step smaller")
+
+    print(f"Coarse sweep over {len(coarse_positions)} points from {search_start_ps}ps to {search_end_ps}ps")
+    coarse_signal = np.array([measure_coarse(position) for position in coarse_positions])
+
+    # The refinement brackets the best coarse point with its neighbours, two on each side for the
+    # edge so the fit sees where the rise starts and ends
+    if mode == "Edge":
+        best = int(np.argmax(np.abs(np.gradient(coarse_signal, coarse_positions))))
+        reach = 2
+    else:
+        best = int(np.argmax(coarse_signal))
+        reach = 1
+    low = coarse_positions[max(best - reach, 0)]
+    high = coarse_positions[min(best + reach, len(coarse_positions) - 1)]
+    print(f"Coarse sweep points to {round(float(coarse_positions[best]), 4)}ps, refining between {round(float(low), 4)}ps and {round(float(high), 4)}ps")
+
+    ### Refinement
+    fine_positions = []
+    fine_signal = []
+
+    def measure_and_keep(position):
+        value = measure_fine(position)
+        fine_positions.append(position)
+        fine_signal.append(value)
+        return value
+
+    edge_width = np.nan
+    if mode == "Edge":
+        for position in np.linspace(low, high, fine_points):
+            measure_and_keep(position)
+        time_zero, edge_width = fit_edge(fine_positions, fine_signal, tolerance=tolerance_ps)
+    else:
+        time_zero = golden_section_maximum(measure_and_keep, low, high, tolerance_ps)
+
+    print(f"Time zero found at {round(time_zero, 4)}ps")
+
+    return {
+            "Time zero [ps]": float(time_zero),
+            "Mode": mode,
+            "Coarse positions": coarse_positions,
+            "Coarse signal": coarse_signal,
+            "Fine positions": np.array(fine_positions),
+            "Fine signal": np.array(fine_signal),
+            "Edge width [ps]": float(edge_width),
+           }